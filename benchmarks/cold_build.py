@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Cold build benchmark for "precompiled_headers" / "unity_build" profile options
+#
+# Configures the profile in temporary build directories as is and without
+# these options, builds targets from scratch (compiler cache disabled)
+# and compares wall time.
+#
+# Usage: benchmarks/cold_build.py -p Release [--targets lib task_...] [--runs 3]
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+CLIENT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, CLIENT_DIR)
+
+from clippy.build import Build  # noqa: E402
+from clippy.course import CourseClient  # noqa: E402
+
+BENCHMARKED_OPTIONS = ["precompiled_headers", "unity_build"]
+
+
+def variants(profile):
+    options = dict(profile.options)
+    options["compiler_cache"] = False
+    options["compile_stats"] = False
+
+    baseline = dict(options)
+    for name in BENCHMARKED_OPTIONS:
+        baseline[name] = False
+
+    return [
+        Build.Profile("baseline", profile.entries, baseline),
+        Build.Profile("optimized", profile.entries, options),
+    ]
+
+
+# Returns cold build time, seconds
+def cold_build(client, profile, targets):
+    with tempfile.TemporaryDirectory(prefix="clippy-cold-build-") as build_dir:
+        build = Build(client.repo_dir, client.config, build_dir, client.toolchain)
+        build.profiles = [profile]
+        build.cmake_profile(profile.name, force=True)
+
+        start = time.monotonic()
+        build.build_targets(os.path.join(build_dir, profile.name), targets)
+        return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--profile", required=True)
+    parser.add_argument("--targets", nargs="+", default=["all"])
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    client = CourseClient()
+    profile = client.build.find_profile(args.profile)
+
+    if not any(profile.options.get(name) for name in BENCHMARKED_OPTIONS):
+        print("Profile {} has no {} options".format(args.profile, BENCHMARKED_OPTIONS))
+        sys.exit(1)
+
+    results = {}
+    for variant in variants(profile):
+        results[variant.name] = [
+            cold_build(client, variant, args.targets) for _ in range(args.runs)]
+
+    print()
+    for name, samples in results.items():
+        print("{}: median {:.2f} s, min {:.2f} s".format(
+            name, statistics.median(samples), min(samples)))
+
+    speedup = statistics.median(results["baseline"]) / statistics.median(results["optimized"])
+    print("speedup: {:.2f}x".format(speedup))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Import time regression benchmark for `clippy help`
+#
+# Runs `python -X importtime client.py help` several times and checks
+# cumulative import time of the clippy package against the budget below.
+# Heavy dependencies must only be imported by the commands that use them.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Budget for cumulative import time of the `clippy` package, microseconds
+CLIPPY_IMPORT_BUDGET_US = 80000
+
+# Must not be imported by `clippy help`
+DEFERRED_MODULES = [
+    "git",
+    "gitlab",
+    "requests",
+    "urllib3",
+    "click",
+    "termcolor",
+    "distutils",
+]
+
+CLIENT_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "client.py")
+
+
+def _is_clippy(module):
+    return module == "clippy" or module.startswith("clippy.")
+
+
+# Returns {module: cumulative import time, us} and cumulative import time
+# of the clippy package, us: package exports are imported lazily, so its
+# modules may also show up as top-level entries
+def measure_imports(python, command):
+    cmd = [python, "-X", "importtime", CLIENT_PATH] + command
+    result = subprocess.run(
+        cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+
+    imports = {}
+    clippy_us = 0
+    for line in result.stderr.decode("utf-8").splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # header
+        module = fields[2].strip()
+        imports[module] = int(fields[1])
+
+        top_level = fields[2].startswith(" ") and not fields[2].startswith("  ")
+        if top_level and _is_clippy(module):
+            clippy_us += int(fields[1])
+    return imports, clippy_us
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--python", default=sys.executable)
+    args = parser.parse_args()
+
+    # Warm up bytecode cache
+    measure_imports(args.python, ["help"])
+
+    samples = []
+    for _ in range(args.runs):
+        imports, clippy_us = measure_imports(args.python, ["help"])
+
+        leaked = [m for m in DEFERRED_MODULES if m in imports]
+        if leaked:
+            print("FAILED: heavy modules imported by `clippy help`: {}".format(leaked))
+            sys.exit(1)
+
+        samples.append(clippy_us)
+
+    median = statistics.median(samples)
+
+    print("clippy import time: median {:.1f} ms, min {:.1f} ms, budget {:.1f} ms".format(
+        median / 1000, min(samples) / 1000, CLIPPY_IMPORT_BUDGET_US / 1000))
+
+    if median > CLIPPY_IMPORT_BUDGET_US:
+        print("FAILED: import time budget exceeded")
+        sys.exit(1)
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
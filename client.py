@@ -1,19 +1,46 @@
 #!/usr/bin/env python3
 
+import os
+import sys
+
+from clippy import daemon
+
+TOOL_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Commands that always run in-process
+NOT_FORWARDED = ["serve", "gdb"]
+
+
+# Returns exit code or None if there is no running daemon
+def forward_to_daemon(argv):
+    if "CLIPPY_NO_DAEMON" in os.environ:
+        return None
+    if argv and argv[0] in NOT_FORWARDED:
+        return None
+    return daemon.forward(daemon.socket_path(TOOL_DIR), argv)
+
+
+# Thin client: with running daemon the rest of clippy is not imported
+if __name__ == "__main__":
+    _exit_code = forward_to_daemon(sys.argv[1:])
+    if _exit_code is not None:
+        sys.exit(_exit_code)
+
 import clippy
-from clippy import ClangCxxCompiler, CourseClient
+from clippy import CourseClient
+from clippy import call
 from clippy import echo
 from clippy.exceptions import ClientError
+from clippy.stress import StressOptions
 from clippy import highlight
 from clippy import greeting
+from clippy.trace import tracer
 
 import argparse
 import datetime
 import getpass
 import logging
-import os
 import platform
-import sys
 import traceback
 
 logging.basicConfig(
@@ -47,9 +74,9 @@ def print_platform():
             platform.python_implementation(),
             highlight.path(sys.executable)))
 
-def print_compilers(config):
+def print_compilers(client):
     try:
-        compiler = ClangCxxCompiler.locate(config.get("cxx_compiler_binaries"))
+        compiler = client.compiler
     except clippy.exceptions.ToolNotFound as error:
         echo.error(str(error))
         sys.exit(1)
@@ -73,15 +100,28 @@ def print_headers():
     print_platform()
 
 
-print_headers()
-
 # --------------------------------------------------------------------
 
+# Client parts are opened on demand, see bootstrap
 client = CourseClient()
 
-print_compilers(client.config)
-print_local_repo(client.repo)
-echo.blank_line()
+# Bootstrap parts that command may declare as needed
+REPO = "repo"
+BUILD = "build"
+SOLUTIONS = "solutions"
+COMPILER = "compiler"
+
+
+def bootstrap(needs):
+    if COMPILER in needs:
+        print_compilers(client)
+    if REPO in needs:
+        print_local_repo(client.repo)
+    if BUILD in needs:
+        _ = client.build
+    if SOLUTIONS in needs:
+        _ = client.solutions
+    echo.blank_line()
 
 # --------------------------------------------------------------------
 
@@ -100,12 +140,12 @@ def current_dir_task_or_die():
 
 
 def update_command(args):
-    client.update(with_cmake=not args.no_cmake)
+    client.update(with_cmake=not args.no_cmake, jobs=args.jobs, force=args.force)
     echo.done()
 
 
 def cmake_command(args):
-    client.cmake(args.clean, args.profile)
+    client.cmake(args.clean, args.profile, jobs=args.jobs, force=args.force)
     echo.done()
 
 
@@ -114,11 +154,28 @@ def warmup_command(args):
     echo.done()
 
 
+def cache_stats_command(args):
+    client.print_compiler_cache_stats()
+    echo.done()
+
+
+def build_stats_command(args):
+    client.print_build_stats(args.profile, top=args.top, as_json=args.json)
+    if not args.json:
+        echo.done()
+
+
 def status_command(args):
     client.print_current_task()
     echo.done()
 
 
+def tasks_list_command(args):
+    client.print_tasks(args.topic, as_json=args.json)
+    if not args.json:
+        echo.done()
+
+
 def attach_command(args):
     client.attach_remote_solutions(args.url, args.local_name)
     echo.done()
@@ -145,16 +202,44 @@ def config_command(args):
     echo.done()
 
 
+def stress_options(args):
+    if args.repeat is None:
+        return None
+    return StressOptions(
+        args.repeat, jobs=args.jobs, seed=args.seed, seed_arg=args.seed_arg,
+        stop_on_failure=args.fail_fast, config=client.config)
+
+
 def test_command(args):
     current_task = current_dir_task_or_die()
-    client.test(current_task, args.config, censor = not args.no_censor)
-    echo.done()
+    # Censor changes working directory
+    report_path = os.path.abspath(args.report) if args.report else None
+    stress = stress_options(args)
+
+    def run():
+        client.test(current_task, args.config, censor = not args.no_censor,
+                    parallel=args.parallel, use_cache=not args.no_cache, report_path=report_path,
+                    interactive=not args.watch, stress=stress, affected=args.affected)
+        echo.done()
+
+    if args.watch:
+        client.watch(current_task, run)
+    else:
+        run()
 
 
 def target_command(args):
     current_task = current_dir_task_or_die()
-    client.target(current_task, args.target, args.profile, args.target_args)
-    echo.done()
+    stress = stress_options(args)
+
+    def run():
+        client.target(current_task, args.target, args.profile, args.target_args, stress=stress)
+        echo.done()
+
+    if args.watch:
+        client.watch(current_task, run)
+    else:
+        run()
 
 
 def gdb_command(args):
@@ -232,33 +317,112 @@ def merge_command(args):
 def hi_command(args):
     client.hi()
 
+
+def serve_command(args):
+    def reload():
+        global client
+        client = CourseClient()
+        try:
+            client.open_all()
+        except ClientError as error:
+            echo.error(str(error))
+        # Daemon keeps running with broken config, commands report the error
+        try:
+            return client.config_files()
+        except (ClientError, OSError) as error:
+            echo.error(str(error))
+            return []
+
+    def run(argv):
+        sys.argv = sys.argv[:1] + argv
+        highlight.reset()
+        main(argv)
+
+    daemon.Server(daemon.socket_path(TOOL_DIR), reload, run).serve()
+
 # --------------------------------------------------------------------
 
+def add_stress_arguments(parser):
+    parser.add_argument(
+        "--repeat", metavar="N", type=int, default=None,
+        help="Run each target N times with distinct seeds (CLIPPY_SEED), report failure rate")
+    parser.add_argument(
+        "-j", "--jobs", metavar="J", type=int, default=None,
+        help="Concurrent repeated runs, default: number of usable CPUs")
+    parser.add_argument(
+        "--seed", type=int, default=None, help="Seed of the first repeated run, default: random")
+    parser.add_argument(
+        "--seed-arg", metavar="TEMPLATE", default=None,
+        help="Also pass seed as argument, e.g. --seed-arg='--seed={seed}'")
+    parser.add_argument(
+        "--fail-fast", action="store_true", default=False,
+        help="Do not start new repeated runs after the first failure")
+
+
 def create_cmdline_parser():
     parser = argparse.ArgumentParser(prog="clippy")
 
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        default=os.environ.get("CLIPPY_TRACE"),
+        help="Write Chrome trace of clippy phases to PATH (also CLIPPY_TRACE)")
+
+    parser.add_argument(
+        "--quiet-build",
+        action="store_true",
+        default="CLIPPY_QUIET_BUILD" in os.environ,
+        help="Show only progress of build tools, full output goes to build/logs/build.log.gz "
+             "(also CLIPPY_QUIET_BUILD)")
+
     def help_command(args):
         parser.print_help()
 
     subparsers = parser.add_subparsers()
 
     help = subparsers.add_parser("help", help="print help")
-    help.set_defaults(cmd=help_command)
+    help.set_defaults(cmd=help_command, needs=[])
 
     update = subparsers.add_parser("update", help="Update local repo (+ submodules)", aliases=["up"])
     update.add_argument("--no-cmake", action="store_true", default=False)
-    update.set_defaults(cmd=update_command)
+    update.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="Number of build profiles configured concurrently")
+    update.add_argument(
+        "--force", action="store_true", default=False,
+        help="Re-configure build profiles even if nothing changed")
+    update.set_defaults(cmd=update_command, needs=[COMPILER, REPO, BUILD])
 
     cmake = subparsers.add_parser("cmake", help="Generate build scripts")
-    cmake.set_defaults(cmd=cmake_command)
+    cmake.set_defaults(cmd=cmake_command, needs=[COMPILER, REPO, BUILD])
     cmake.add_argument(
         "--clean",
         action="store_true",
         help="Remove all existing build scripts in build directory")
     cmake.add_argument('-p', "--profile", required=False, default=None)
+    cmake.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="Number of build profiles configured concurrently")
+    cmake.add_argument(
+        "--force", action="store_true", default=False,
+        help="Re-configure build profiles even if nothing changed")
 
     warmup = subparsers.add_parser("warmup", help="Warm up build")
-    warmup.set_defaults(cmd=warmup_command)
+    warmup.set_defaults(cmd=warmup_command, needs=[COMPILER, REPO, BUILD])
+
+    build = subparsers.add_parser("build", help="Build directory tools")
+    build_subparsers = build.add_subparsers()
+
+    cache_stats = build_subparsers.add_parser(
+        "cache-stats", help="Print compiler cache (ccache / sccache) statistics")
+    cache_stats.set_defaults(cmd=cache_stats_command, needs=[BUILD])
+
+    build_stats = subparsers.add_parser(
+        "build-stats", help="Print compile-time statistics: slowest translation units, targets, headers")
+    build_stats.set_defaults(cmd=build_stats_command, needs=[BUILD])
+    build_stats.add_argument('-p', "--profile", required=False, default=None)
+    build_stats.add_argument("--top", type=int, default=10, help="Number of entries in each list")
+    build_stats.add_argument("--json", action="store_true", default=False, help="Machine-readable output")
 
     # Task-related commands
 
@@ -266,62 +430,90 @@ def create_cmdline_parser():
         "status",
         help="Print current task",
         aliases=["st"])
-    status.set_defaults(cmd=status_command)
+    status.set_defaults(cmd=status_command, needs=[])
+
+    tasks = subparsers.add_parser("tasks", help="Query course tasks")
+    tasks_subparsers = tasks.add_subparsers()
+
+    tasks_list = tasks_subparsers.add_parser("list", help="List tasks")
+    tasks_list.add_argument("--topic", required=False, default=None, help="List tasks of given topic")
+    tasks_list.add_argument("--json", action="store_true", default=False, help="Machine-readable output")
+    tasks_list.set_defaults(cmd=tasks_list_command, needs=[])
 
     test = subparsers.add_parser("test", help="Run tests for current task")
-    test.set_defaults(cmd=test_command)
+    test.set_defaults(cmd=test_command, needs=[COMPILER, REPO, BUILD])
     test.add_argument("--config", required=False, help="Config with test pipeline description")
     test.add_argument("--no-censor", action="store_true", default=False, help="Skip censoring")
+    test.add_argument(
+        "--parallel", action="store_true", default=False,
+        help="Build all profiles concurrently, run (group, profile, target) units on worker pool")
+    test.add_argument(
+        "--no-cache", action="store_true", default=False,
+        help="Rerun tests that passed before with the same binaries")
+    test.add_argument(
+        "--report", metavar="PATH", default=None,
+        help="Write test report with timings and resource usage: junit.xml or results.json")
+    test.add_argument(
+        "--affected", action="store_true", default=False,
+        help="Skip targets whose sources and headers did not change since their last green run")
+    test.add_argument(
+        "--watch", action="store_true", default=False,
+        help="Rerun on changes of task files until interrupted")
+    add_stress_arguments(test)
 
     target = subparsers.add_parser("target", help="Build and run target for current task")
-    target.set_defaults(cmd=target_command)
+    target.set_defaults(cmd=target_command, needs=[COMPILER, REPO, BUILD])
+    target.add_argument(
+        "--watch", action="store_true", default=False,
+        help="Rerun on changes of task files until interrupted")
+    add_stress_arguments(target)
     target.add_argument("target", help="Task target")
     target.add_argument("profile", help="Build profile")
     target.add_argument("target_args", nargs=argparse.REMAINDER)
 
     gdb = subparsers.add_parser("gdb", help="Build target for current task and run gdb on it")
-    gdb.set_defaults(cmd=gdb_command)
+    gdb.set_defaults(cmd=gdb_command, needs=[COMPILER, REPO, BUILD])
     gdb.add_argument("target", help="Task target")
     gdb.add_argument("profile", help="Build profile")
     gdb.add_argument("target_args", nargs=argparse.REMAINDER)
 
     benchmark = subparsers.add_parser(
         "benchmark", help="Run benchmark for current task", aliases=["bench"])
-    benchmark.set_defaults(cmd=benchmark_command)
+    benchmark.set_defaults(cmd=benchmark_command, needs=[COMPILER, REPO, BUILD])
 
     format = subparsers.add_parser("format", help="Apply clang-format to current task sources")
-    format.set_defaults(cmd=format_command)
+    format.set_defaults(cmd=format_command, needs=[])
 
     tidy = subparsers.add_parser("tidy", help="Apply clang-tidy to current task sources")
-    tidy.set_defaults(cmd=tidy_command)
+    tidy.set_defaults(cmd=tidy_command, needs=[])
 
     lint = subparsers.add_parser(
         "lint",
         help="Apply linters (clang-format and clang-tidy) to current task sources", aliases=["style"])
-    lint.set_defaults(cmd=lint_command)
+    lint.set_defaults(cmd=lint_command, needs=[])
 
     censor = subparsers.add_parser("censor", help="Search forbidden patterns")
-    censor.set_defaults(cmd=censor_command)
+    censor.set_defaults(cmd=censor_command, needs=[])
 
     validate = subparsers.add_parser(
         "validate",
         help="Validate current task sources (linters, forbidden patterns)")
-    validate.set_defaults(cmd=validate_command)
+    validate.set_defaults(cmd=validate_command, needs=[])
 
     test_perf = subparsers.add_parser(
         "test-perf-ci",
         help="Run performance test for current task")
-    test_perf.set_defaults(cmd=test_perf_command)
+    test_perf.set_defaults(cmd=test_perf_command, needs=[COMPILER, REPO, BUILD])
 
     config = subparsers.add_parser(
         "config", help="Set client config attributes")
     config.add_argument("attr", help="E.g. path.to.attr")
     config.add_argument("value")
-    config.set_defaults(cmd=config_command)
+    config.set_defaults(cmd=config_command, needs=[SOLUTIONS])
 
     show_config = subparsers.add_parser(
         "show-config", help="Show client config content")
-    show_config.set_defaults(cmd=show_config_command)
+    show_config.set_defaults(cmd=show_config_command, needs=[SOLUTIONS])
 
     attach = subparsers.add_parser(
         "attach", help="Attach remote solutions repo")
@@ -331,56 +523,79 @@ def create_cmdline_parser():
     attach.add_argument(
         "--local-name", help="Local copy name", default=None
     )
-    attach.set_defaults(cmd=attach_command)
+    attach.set_defaults(cmd=attach_command, needs=[REPO])
 
     attach_local = subparsers.add_parser(
         "attach-local", help="Attach local solutions repo")
     attach_local.add_argument(
         "repo_dir",
         help="Path to local repo")
-    attach_local.set_defaults(cmd=attach_local_command)
+    attach_local.set_defaults(cmd=attach_local_command, needs=[REPO])
 
     commit = subparsers.add_parser(
         "commit", help="Commit current task solution to solutions repo", aliases=["ci"])
     commit.add_argument("-m", "--message", help="Commit message")
     commit.add_argument("--no-lint", action="store_true", default=False)
     commit.add_argument("--bump", action="store_true", default=False)
-    commit.set_defaults(cmd=commit_command)
+    commit.set_defaults(cmd=commit_command, needs=[REPO, SOLUTIONS])
 
     apply = subparsers.add_parser(
         "apply", help="Apply solution from solutions repo to current task")
     apply.add_argument("-c", "--commit", help="Commit hash", default=None)
     apply.add_argument("-f", "--force", action="store_true", default=False)
-    apply.set_defaults(cmd=apply_command)
+    apply.set_defaults(cmd=apply_command, needs=[REPO, SOLUTIONS])
 
     push = subparsers.add_parser(
         "push", help="Push task branch commits to remote solutions repo")
-    push.set_defaults(cmd=push_command)
+    push.set_defaults(cmd=push_command, needs=[REPO, SOLUTIONS])
 
     merge = subparsers.add_parser(
         "merge-request", help="Create merge request for current task", aliases=["mr"])
-    merge.set_defaults(cmd=merge_command)
+    merge.set_defaults(cmd=merge_command, needs=[REPO, SOLUTIONS])
 
     solutions_info = subparsers.add_parser(
         "solutions", help="Print solutions repository info")
-    solutions_info.set_defaults(cmd=solutions_info_command)
+    solutions_info.set_defaults(cmd=solutions_info_command, needs=[SOLUTIONS])
 
     hi = subparsers.add_parser("hi", help="Hi, Clippy!")
-    hi.set_defaults(cmd=hi_command)
+    hi.set_defaults(cmd=hi_command, needs=[])
+
+    serve = subparsers.add_parser(
+        "serve", help="Run resident clippy daemon, commands are forwarded to it")
+    serve.set_defaults(cmd=serve_command, needs=[])
 
     return parser
 
 
-def main():
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
     parser = create_cmdline_parser()
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if "cmd" not in args:
         parser.print_help()
         sys.exit(2)
 
+    if args.trace:
+        tracer.start(args.trace)
+
+    call.set_quiet_build(args.quiet_build)
+
+    # Keep machine-readable output clean
+    quiet = getattr(args, "json", False)
+
+    if not quiet:
+        print_headers()
+
     try:
-        args.cmd(args)
+        with tracer.span("clippy", argv=argv):
+            if not quiet:
+                with tracer.span("bootstrap", needs=args.needs):
+                    bootstrap(args.needs)
+            with tracer.span(args.cmd.__name__):
+                args.cmd(args)
     except KeyboardInterrupt:
         echo.error("Exiting on user request\n")
         sys.exit(1)
@@ -392,6 +607,8 @@ def main():
         print(e, file=sys.stderr)
         traceback.print_exc()
         sys.exit(1)
+    finally:
+        tracer.save()
 
 # --------------------------------------------------------------------
 
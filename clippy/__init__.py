@@ -1,4 +1,17 @@
-from .call import check_call
-from .compiler import ClangCxxCompiler
+import importlib
+
 from .echo import echo
-from .course import CourseClient
+
+# Exports are imported on first access: thin client forwarding
+# a command to resident daemon (see client.py) needs clippy.daemon only
+_LAZY_EXPORTS = {
+    "check_call": ".call",
+    "ClangCxxCompiler": ".compiler",
+    "CourseClient": ".course",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_EXPORTS:
+        return getattr(importlib.import_module(_LAZY_EXPORTS[name], __name__), name)
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
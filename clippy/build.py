@@ -1,26 +1,56 @@
-import contextlib
+import hashlib
+import json
+import logging
 import os
 import shutil
+import sys
 
-from .call import check_call
+from .call import check_build_call, call_to_log
 from .compiler import ClangCxxCompiler, ClangCCompiler
 from .echo import echo
 from .exceptions import ClientError
+from .jobserver import JobServer
 from . import helpers
+from . import build_stats
+from . import build_tool
+from . import compiler_cache
 from . import highlight
+from . import impact
+from . import parallelism
+from . import pool
+from .trace import tracer
 
 
 # Build directory ("build" directory in course repo)
 
+# Hash of cmake inputs for profile (see Build._cmake_stamp) and whether
+# clippy set compiler launchers, JSON
+STAMP_FILE_NAME = ".clippy-cmake-stamp"
+
+COMPILE_TIMER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "compile_timer.py")
+
+TIME_TRACE_FLAG = "-ftime-trace"
+
+BUILD_OPTIONS_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "cmake", "clippy_build_options.cmake")
+
+DEFAULT_UNITY_BATCH_SIZE = 8
+
+# Build tools output of the last run in quiet build mode
+QUIET_LOG_NAME = "build.log.gz"
+
 class Build:
     class Profile:
-        def __init__(self, name, entries):
+        def __init__(self, name, entries, options=None):
             self.name = name
             self.entries = entries
+            # e.g. "generator"
+            self.options = options if options is not None else {}
 
-    def __init__(self, git_repo, config, build_dir):
+    def __init__(self, repo_dir, config, build_dir, toolchain=None):
         self.config = config
-        self.repo_path = git_repo.working_tree_dir
+        self.toolchain = toolchain
+        self.repo_path = repo_dir
         self.path = build_dir
         self._reload_profiles()
 
@@ -28,7 +58,8 @@ class Build:
         return os.path.join(self.repo_path, '.clippy-build-profiles.json')
 
     def _reload_profiles(self):
-        self.profiles = self._read_profiles(self._config_path())
+        with tracer.span("build profiles"):
+            self.profiles = self._read_profiles(self._config_path())
 
     @staticmethod
     def _read_profiles(config_path):
@@ -43,9 +74,16 @@ class Build:
             raise ClientError(
                 "Cannot load build profiles from {}".format(config_path))
 
+        # Profile is either list of CMake entries or
+        # {"entries": [...], <options>}
         profiles = []
-        for name, entries in profiles_json.items():
-            profiles.append(Build.Profile(str(name), entries))
+        for name, value in profiles_json.items():
+            if isinstance(value, dict):
+                options = dict(value)
+                entries = options.pop("entries", [])
+                profiles.append(Build.Profile(str(name), entries, options))
+            else:
+                profiles.append(Build.Profile(str(name), value))
 
         return profiles
 
@@ -56,7 +94,12 @@ class Build:
         return os.path.join(self.path, profile.name)
 
     def _clear_all_dirs(self):
+        # Compiler caches survive clean builds
+        keep = [os.path.realpath(cache.dir) for _, cache in self.compiler_caches()]
+
         for subdir in helpers.get_immediate_subdirectories(self.path):
+            if os.path.realpath(subdir) in keep:
+                continue
             shutil.rmtree(subdir)
 
     def _create_profile_dirs(self):
@@ -68,39 +111,85 @@ class Build:
         self._clear_all_dirs()
         self._create_profile_dirs()
 
-    def profile_build_dirs(self):
-        for profile in self.profiles:
-            profile_dir = self._dir(profile)
-            if not os.path.exists(profile_dir):
-                helpers.mkdir(profile_dir, parents=True)
-            os.chdir(profile_dir)
-            yield profile, profile_dir
-
-    def _find_profile(self, name):
+    def find_profile(self, name):
         for profile in self.profiles:
             if profile.name == name:
                 return profile
         raise ClientError("Build profile '{}' not found".format(name))
 
-    @contextlib.contextmanager
-    def profile(self, name):
-        selected_profile = self._find_profile(name)
-        cwd = os.getcwd()
-        profile_dir = self._dir(selected_profile)
+    # Build directory of profile, does not change working directory:
+    # safe for concurrent builds and test runs
+    def profile_dir(self, name):
+        profile_dir = self._dir(self.find_profile(name))
         if not os.path.exists(profile_dir):
             helpers.mkdir(profile_dir, parents=True)
-        os.chdir(profile_dir)
-        try:
-            yield profile_dir
-        finally:
-            os.chdir(cwd)
-
-    def _cmake_command(self, profile):
-        def prepend(prefix, items):
-            return [prefix + item for item in items]
-
-        cxx_compiler = ClangCxxCompiler.locate(self.config.get("cxx_compiler_binaries"))
-        c_compiler = ClangCCompiler.locate(self.config.get("c_compiler_binaries"))
+        return profile_dir
+
+    def _compilers(self):
+        cxx_compiler = ClangCxxCompiler.locate(
+            self.config.get("cxx_compiler_binaries"), self.toolchain)
+        c_compiler = ClangCCompiler.locate(
+            self.config.get("c_compiler_binaries"), self.toolchain)
+        return cxx_compiler, c_compiler
+
+    # Global option from .clippy.json, overridden by build profile
+    def _profile_option(self, profile, name, default=None):
+        return profile.options.get(name, self.config.get_or(name, default=default))
+
+    def _compiler_cache(self, profile):
+        settings = self._profile_option(profile, "compiler_cache")
+        return compiler_cache.from_settings(
+            settings, self.path, self.repo_path, self.toolchain)
+
+    # [([profile names], CompilerCache)] for distinct caches
+    def compiler_caches(self):
+        caches = []
+        for profile in self.profiles:
+            cache = self._compiler_cache(profile)
+            if cache is None:
+                continue
+            for names, known in caches:
+                if (known.tool, known.dir) == (cache.tool, cache.dir):
+                    names.append(profile.name)
+                    break
+            else:
+                caches.append(([profile.name], cache))
+        return caches
+
+    # Compile timer launcher for `clippy build-stats`, Ninja logs edge times itself
+    def _compile_timer(self, profile):
+        if not self._profile_option(profile, "compile_stats", default=False):
+            return []
+        if self._generator(profile) == build_tool.NINJA_GENERATOR:
+            return []
+        return [sys.executable, COMPILE_TIMER, build_stats.timer_log_path(self._dir(profile))]
+
+    # Compiler launcher managed by clippy, empty if none
+    def _launcher(self, profile):
+        cache = self._compiler_cache(profile)
+        launcher = self._compile_timer(profile) + (cache.launcher().split(";") if cache else [])
+        return ";".join(launcher)
+
+    # Launcher variables not set explicitly in profile
+    @staticmethod
+    def _launcher_names(profile):
+        names = []
+        for lang in ["C", "CXX"]:
+            name = "CMAKE_{}_COMPILER_LAUNCHER".format(lang)
+            if any(entry.startswith(name + "=") for entry in profile.entries):
+                continue  # set explicitly in profile
+            names.append(name)
+        return names
+
+    # Launcher set by user (-D in CMake cache) is kept unless clippy manages it
+    def _launcher_entries(self, profile):
+        launcher = self._launcher(profile)
+        if not launcher:
+            return []
+        return ["{}={}".format(name, launcher) for name in self._launcher_names(profile)]
+
+    def _cmake_entries(self, profile):
+        cxx_compiler, c_compiler = self._compilers()
 
         common_entries = [
             "CMAKE_CXX_COMPILER={}".format(cxx_compiler.binary),
@@ -108,13 +197,307 @@ class Build:
             "TOOL_BUILD=ON",
         ]
 
-        entries = profile.entries + common_entries
+        return (self._flags_entries(profile, cxx_compiler) + common_entries +
+                self._launcher_entries(profile) + self._build_options_entries(profile))
+
+    def _precompiled_headers(self, profile):
+        setting = self._profile_option(profile, "precompiled_headers")
+        if not setting:
+            return None
+        if isinstance(setting, list):
+            setting = {"headers": setting}
+        if not isinstance(setting, dict) or not setting.get("headers"):
+            raise ClientError(
+                "Option 'precompiled_headers' of profile {} should be list of headers "
+                "or {{\"headers\": [...], \"targets\": [...], \"reuse\": true}}".format(profile.name))
+
+        def resolve(header):
+            # <system> headers are passed as is, files are relative to repo root
+            if header.startswith("<") or os.path.isabs(header):
+                return header
+            return os.path.join(self.repo_path, header)
+
+        return {
+            "headers": [resolve(header) for header in setting["headers"]],
+            "targets": setting.get("targets", []),
+            "reuse": bool(setting.get("reuse", False)),
+        }
+
+    def _unity_build(self, profile):
+        setting = self._profile_option(profile, "unity_build")
+        if not setting:
+            return None
+        if setting is True:
+            setting = {}
+        if not isinstance(setting, dict):
+            raise ClientError(
+                "Option 'unity_build' of profile {} should be true "
+                "or {{\"targets\": [...], \"batch_size\": 8}}".format(profile.name))
+
+        return {
+            "targets": setting.get("targets", []),
+            "batch_size": int(setting.get("batch_size", DEFAULT_UNITY_BATCH_SIZE)),
+        }
+
+    # CMake cache variables to unset: script is removed if options were removed
+    def _unset_entries(self, profile):
+        entries = []
+        # Launcher set by clippy in previous configure, e.g. compiler cache was disabled
+        if not self._launcher(profile) and self._read_stamp(profile).get("launcher"):
+            entries += self._launcher_names(profile)
+
+        if any(entry.startswith("CMAKE_PROJECT_INCLUDE=") for entry in profile.entries):
+            return entries
+        if self._precompiled_headers(profile) or self._unity_build(profile):
+            return entries
+        return entries + ["CMAKE_PROJECT_INCLUDE"]
+
+    # Precompiled headers and unity builds are applied to targets by
+    # CMake script included after project(), see cmake/clippy_build_options.cmake
+    def _build_options_entries(self, profile):
+        pch = self._precompiled_headers(profile)
+        unity = self._unity_build(profile)
+
+        explicit = any(entry.startswith("CMAKE_PROJECT_INCLUDE=") for entry in profile.entries)
+
+        if pch is None and unity is None:
+            return []
+
+        if explicit:
+            raise ClientError(
+                "Profile {} sets CMAKE_PROJECT_INCLUDE, it cannot be combined with "
+                "'precompiled_headers' / 'unity_build' options".format(profile.name))
+
+        entries = ["CMAKE_PROJECT_INCLUDE={}".format(BUILD_OPTIONS_SCRIPT)]
+
+        # Values are reset explicitly: CMake keeps them in cache
+        if pch is not None:
+            entries += [
+                "CLIPPY_PCH_HEADERS={}".format(";".join(pch["headers"])),
+                "CLIPPY_PCH_TARGETS={}".format(";".join(pch["targets"])),
+                "CLIPPY_PCH_REUSE={}".format("ON" if pch["reuse"] else "OFF"),
+            ]
+        else:
+            entries.append("CLIPPY_PCH_HEADERS=")
+
+        if unity is not None:
+            entries += [
+                "CLIPPY_UNITY_BUILD=ON",
+                "CLIPPY_UNITY_TARGETS={}".format(";".join(unity["targets"])),
+                "CLIPPY_UNITY_BATCH_SIZE={}".format(unity["batch_size"]),
+            ]
+        else:
+            entries.append("CLIPPY_UNITY_BUILD=OFF")
+
+        return entries
+
+    @staticmethod
+    def _is_clang(compiler):
+        return "clang" in compiler.version.lower()
+
+    # Profile entries + -ftime-trace for "time_trace" option (clang only)
+    def _flags_entries(self, profile, cxx_compiler):
+        if not self._profile_option(profile, "time_trace", default=False):
+            return profile.entries
+
+        if not self._is_clang(cxx_compiler):
+            return profile.entries
+
+        entries = []
+        traced = False
+        for entry in profile.entries:
+            if entry.startswith("CMAKE_CXX_FLAGS="):
+                entry += " " + TIME_TRACE_FLAG
+                traced = True
+            entries.append(entry)
+        if not traced:
+            entries.append("CMAKE_CXX_FLAGS={}".format(TIME_TRACE_FLAG))
+        return entries
+
+    def _generator(self, profile):
+        setting = self._profile_option(profile, "generator")
+        return build_tool.resolve_generator(setting)
+
+    def _check_generator(self, profile):
+        generator = self._generator(profile)
+        tool = build_tool.for_generator(generator)
+        helpers.check_tool(tool.binary)
+
+        configured = build_tool.configured_generator(self._dir(profile))
+        if configured is not None and configured != generator:
+            raise ClientError(
+                "Build directory for profile {} is generated by '{}', "
+                "run `clippy cmake --clean` to switch to '{}'".format(
+                    profile.name, configured, generator))
+
+        return generator
+
+    def _cmake_command(self, profile):
+        def prepend(prefix, items):
+            return [prefix + item for item in items]
 
-        echo.echo("CMake options for profile {}: {}".format(profile.name, entries))
+        entries = self._cmake_entries(profile)
+        generator = self._generator(profile)
 
-        return ["cmake"] + prepend("-D", entries) + [self.repo_path]
+        echo.echo("CMake options for profile {}: {}, generator: {}".format(
+            profile.name, entries, generator))
 
-    def cmake(self):
+        if self._profile_option(profile, "time_trace") and not self._is_clang(self._compilers()[0]):
+            echo.note("Option 'time_trace' requires clang, ignored for profile {}".format(profile.name))
+
+        return (["cmake", "-G", generator] + prepend("-D", entries) +
+                prepend("-U", self._unset_entries(profile)) + [self.repo_path])
+
+    # Compile-time statistics snapshot for profile or None, see build_stats
+    def collect_build_stats(self, name):
+        profile = self.find_profile(name)
+        return self._collect_build_stats(profile)
+
+    def _collect_build_stats(self, profile):
+        try:
+            return build_stats.collect(profile.name, self._dir(profile))
+        except (OSError, ValueError, KeyError) as error:
+            logging.warning("Cannot collect compile times for profile {}: {}".format(profile.name, error))
+            return None
+
+    # Snapshot after build for profiles that asked for compile statistics,
+    # other profiles are snapshotted by `clippy build-stats` itself
+    def _record_build_stats(self, profile):
+        if not (self._profile_option(profile, "compile_stats", default=False) or
+                self._profile_option(profile, "time_trace", default=False)):
+            return
+
+        snapshot = self._collect_build_stats(profile)
+        if snapshot is None:
+            return
+        try:
+            build_stats.StatsHistory(self.path).append(snapshot)
+        except OSError as error:
+            logging.warning("Cannot save compile times for profile {}: {}".format(profile.name, error))
+
+    def _profile_of_dir(self, build_dir):
+        for profile in self.profiles:
+            if os.path.realpath(self._dir(profile)) == os.path.realpath(build_dir):
+                return profile
+        return None
+
+    # Build targets in configured profile directory
+    def build_targets(self, build_dir, targets):
+        tool = build_tool.detect(build_dir)
+        check_build_call(
+            tool.target_command(targets, jobs=parallelism.build_jobs(self.config)),
+            self._log_path(QUIET_LOG_NAME), cwd=build_dir)
+
+        profile = self._profile_of_dir(build_dir)
+        if profile is not None:
+            self._record_build_stats(profile)
+
+    def _log_path(self, name):
+        return os.path.join(self.path, "logs", name)
+
+    # Stamps: skip re-configuration if nothing relevant changed
+
+    def _skip_dir(self, path):
+        return os.path.basename(path) == ".git" or os.path.realpath(path) == os.path.realpath(self.path)
+
+    # Content of CMakeLists.txt / *.cmake files + list of C/C++ sources
+    # (build scripts may glob them)
+    def _cmake_inputs_digest(self):
+        digest = hashlib.sha256()
+
+        for dir_path, subdirs, files in os.walk(self.repo_path):
+            subdirs[:] = sorted(d for d in subdirs if not self._skip_dir(os.path.join(dir_path, d)))
+            for name in sorted(files):
+                path = os.path.join(dir_path, name)
+                if name == "CMakeLists.txt" or name.endswith(".cmake"):
+                    digest.update(os.path.relpath(path, self.repo_path).encode("utf-8"))
+                    with open(path, "rb") as f:
+                        digest.update(hashlib.sha256(f.read()).digest())
+                elif helpers.is_cpp_file(name) or name.endswith(".c"):
+                    digest.update(os.path.relpath(path, self.repo_path).encode("utf-8"))
+
+        return digest.hexdigest()
+
+    # CMake scripts shipped with clippy
+    @staticmethod
+    def _scripts_digest():
+        with open(BUILD_OPTIONS_SCRIPT, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def _cmake_stamp(self, profile, inputs_digest):
+        cxx_compiler, c_compiler = self._compilers()
+
+        data = {
+            "entries": self._cmake_entries(profile),
+            "generator": self._generator(profile),
+            "compilers": [cxx_compiler.version, c_compiler.version],
+            "inputs": inputs_digest,
+            "scripts": self._scripts_digest(),
+            "file_api": impact.FILE_API_QUERY,
+        }
+
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _stamp_path(self, profile):
+        return os.path.join(self._dir(profile), STAMP_FILE_NAME)
+
+    # {"stamp": ..., "launcher": ...} of the last successful configure,
+    # empty if profile is not configured or stamp is broken
+    def _read_stamp(self, profile):
+        if not os.path.exists(os.path.join(self._dir(profile), "CMakeCache.txt")):
+            return {}
+        try:
+            with open(self._stamp_path(profile), "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _up_to_date(self, profile, stamp):
+        return self._read_stamp(profile).get("stamp") == stamp
+
+    # Stamp of the last successful configure or None
+    def cmake_stamp(self, name):
+        return self._read_stamp(self.find_profile(name)).get("stamp")
+
+    def _write_stamp(self, profile, stamp):
+        data = {"stamp": stamp, "launcher": bool(self._launcher_entries(profile))}
+        with open(self._stamp_path(profile), "w") as f:
+            json.dump(data, f)
+
+    # Returns [(profile, stamp)] for profiles that should be re-configured
+    def _stale_profiles(self, profiles, force):
+        inputs_digest = self._cmake_inputs_digest()
+
+        stale = []
+        for profile in profiles:
+            self._check_generator(profile)
+            stamp = self._cmake_stamp(profile, inputs_digest)
+            if not force and self._up_to_date(profile, stamp):
+                echo.echo("Build scripts for profile {} are up to date".format(
+                    highlight.smth(profile.name)))
+                continue
+            stale.append((profile, stamp))
+        return stale
+
+    def _cmake_sequential(self, stale):
+        for profile, stamp in stale:
+            profile_dir = self._dir(profile)
+            if not os.path.exists(profile_dir):
+                helpers.mkdir(profile_dir, parents=True)
+            impact.write_query(profile_dir)
+
+            echo.echo("Generate build scripts for profile {}".format(
+                highlight.smth(profile.name)))
+            with tracer.span("cmake", profile=profile.name):
+                cmake_cmd = self._cmake_command(profile)
+                check_build_call(cmake_cmd, self._log_path(QUIET_LOG_NAME), cwd=profile_dir)
+
+            self._write_stamp(profile, stamp)
+
+    # jobs: number of profiles configured concurrently
+    # force: re-configure even if stamp matches
+    def cmake(self, jobs=None, force=False):
         helpers.check_tool("cmake")
 
         echo.echo("Build directory: {}".format(
@@ -123,32 +506,113 @@ class Build:
 
         self._reload_profiles()
 
-        for profile, build_dir in self.profile_build_dirs():
-            echo.echo("Generate build scripts for profile {}".format(
-                highlight.smth(profile.name)))
-            cmake_cmd = self._cmake_command(profile)
-            check_call(cmake_cmd)
+        stale = self._stale_profiles(self.profiles, force)
+        if not stale:
+            return
 
-    def cmake_profile(self, name):
-        helpers.check_tool("cmake")
+        if jobs is None:
+            jobs = min(len(stale), parallelism.jobs(self.config))
 
-        profile = self._find_profile(name)
-        profile_dir = self._dir(profile)
+        if jobs > 1 and len(stale) > 1:
+            self._cmake_parallel(stale, jobs)
+        else:
+            self._cmake_sequential(stale)
 
+    def _cmake_job(self, profile, stamp):
+        profile_dir = self._dir(profile)
         if not os.path.exists(profile_dir):
             helpers.mkdir(profile_dir, parents=True)
-        os.chdir(profile_dir)
-
-        echo.echo("Generate build scripts for profile {}".format(
-            highlight.smth(profile.name)))
+        impact.write_query(profile_dir)
 
         cmake_cmd = self._cmake_command(profile)
-        check_call(cmake_cmd)
+        log_path = self._log_path("cmake-{}.log".format(profile.name))
+
+        def run():
+            with tracer.span("cmake", profile=profile.name):
+                exit_code = call_to_log(cmake_cmd, log_path, cwd=profile_dir)
+            if exit_code == 0:
+                self._write_stamp(profile, stamp)
+            return exit_code
+
+        return pool.Job(profile.name, run, log_path)
+
+    def _cmake_parallel(self, stale, jobs):
+        echo.echo("Generate build scripts for profiles {} ({} jobs)".format(
+            highlight.smth([profile.name for profile, _ in stale]), jobs))
+
+        cmake_jobs = [self._cmake_job(profile, stamp) for profile, stamp in stale]
+
+        results = pool.run_jobs(cmake_jobs, jobs)
+
+        echo.blank_line()
+        pool.print_summary(results)
 
-    def warmup(self, target):
+        failed = pool.failed(results)
+        if failed:
+            raise ClientError("CMake failed for profiles: {}".format(failed))
+
+    def cmake_profile(self, name, force=False):
+        helpers.check_tool("cmake")
+
+        profile = self.find_profile(name)
+        self._cmake_sequential(self._stale_profiles([profile], force))
+
+    def _build_job(self, profile, targets, tool, jobserver, jobs, log_name):
+        build_dir = self._dir(profile)
+        if not os.path.exists(build_dir):
+            helpers.mkdir(build_dir, parents=True)
+
+        if tool.jobserver_client:
+            cmd = tool.target_command(targets)
+            kwargs = jobserver.make_kwargs(tool.binary)
+        else:
+            cmd = tool.target_command(targets, jobs=jobs)
+            kwargs = {}
+
+        log_path = self._log_path("{}-{}.log".format(log_name, profile.name))
+
+        def run():
+            with tracer.span("build", targets=targets, profile=profile.name):
+                exit_code = call_to_log(cmd, log_path, cwd=build_dir, **kwargs)
+            if exit_code == 0:
+                self._record_build_stats(profile)
+            return exit_code
+
+        return pool.Job(profile.name, run, log_path)
+
+    # Build targets in several profiles concurrently, all builds share
+    # one job budget: make takes slots from jobserver, other tools get
+    # static share of the budget, which is not put to the jobserver pool
+    # units: [(profile, targets)]
+    def build_concurrently(self, units, log_name):
+        budget = parallelism.build_jobs(self.config)
+        workers = max(1, min(len(units), budget))
+        share = max(1, budget // workers)
+
+        tools = [build_tool.detect(self._dir(profile)) for profile, _ in units]
+        static = min(workers, sum(1 for tool in tools if not tool.jobserver_client))
+
+        echo.echo("Building {} profile(s), {} job slots".format(len(units), budget))
+
+        # Implicit slot of each worker + extra slots of static shares
+        with JobServer(max(0, budget - workers - static * (share - 1))) as jobserver:
+            jobs = [
+                self._build_job(profile, targets, tool, jobserver, share, log_name)
+                for (profile, targets), tool in zip(units, tools)
+            ]
+            results = pool.run_jobs(jobs, workers)
+
+        echo.blank_line()
+        pool.print_summary(results)
+
+        failed = pool.failed(results)
+        if failed:
+            raise ClientError("Build failed for profiles: {}".format(failed))
+
+    def warmup(self, targets):
         #self.cmake()
-        for profile, dir in self.profile_build_dirs():
-            echo.echo(
-                "Warming up target {} for profile {}".format(
-                    target, profile.name))
-            check_call(helpers.make_target_command(target))
+        echo.echo("Warming up targets {} for profiles {}".format(
+            highlight.smth(targets), highlight.smth(self.list_profile_names())))
+
+        self.build_concurrently(
+            [(profile, targets) for profile in self.profiles], "warmup")
@@ -0,0 +1,184 @@
+import json
+import os
+import re
+import time
+
+from . import helpers
+from . import impact
+
+# Compile-time statistics for `clippy build-stats`
+#
+# Sources (in profile build directory):
+#   .ninja_log - Ninja generator
+#   .clippy-compile-times.log - compile_timer launcher ("compile_stats" option)
+#   <object>.json - clang -ftime-trace output ("time_trace" option)
+#
+# Snapshots are kept in <build_dir>/stats/<profile>.json to compare builds:
+# recorded after builds of profiles with "compile_stats" / "time_trace"
+# (see Build._record_build_stats), otherwise by `clippy build-stats` itself.
+# Snapshot equal to the latest one is not recorded again.
+
+NINJA_LOG = ".ninja_log"
+TIMES_LOG = ".clippy-compile-times.log"
+
+STATS_DIR_NAME = "stats"
+HISTORY_SIZE = 10
+
+OBJECT_SUFFIXES = (".o", ".obj")
+
+# -ftime-trace events
+HEADER_EVENTS = ["Source"]
+TEMPLATE_EVENTS = ["InstantiateClass", "InstantiateFunction"]
+
+TARGET_DIR_PATTERN = re.compile(r"CMakeFiles/([^/]+)\.dir/")
+
+
+def timer_log_path(profile_dir):
+    return os.path.join(profile_dir, TIMES_LOG)
+
+
+# {output: ms}, latest entry for each output wins
+def _read_ninja_log(path):
+    durations = {}
+    with open(path, "r") as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) < 4:
+                continue
+            start, end, _, output = parts[:4]
+            durations[output] = int(end) - int(start)
+    return durations
+
+
+def _read_timer_log(path, profile_dir):
+    durations = {}
+    with open(path, "r") as f:
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) != 3:
+                continue
+            start, end, output = parts
+            durations[os.path.relpath(output, profile_dir)] = int(end) - int(start)
+    return durations
+
+
+def _is_object(output):
+    return output.endswith(OBJECT_SUFFIXES)
+
+
+# artifacts: {link output: target name} from CMake codemodel, see impact.target_artifacts
+def _target(output, artifacts):
+    match = TARGET_DIR_PATTERN.search(output)
+    if match:
+        return match.group(1)
+    # Link step: binary or library, basename if profile has no codemodel yet
+    return artifacts.get(os.path.normpath(output), os.path.basename(output))
+
+
+def _time_trace_path(profile_dir, output):
+    base, _ = os.path.splitext(output)
+    return os.path.join(profile_dir, base + ".json")
+
+
+# Sums event durations (us) by detail
+def _aggregate_time_traces(paths):
+    headers = {}
+    templates = {}
+    for path in paths:
+        try:
+            events = helpers.load_json(path).get("traceEvents", [])
+        except (OSError, ValueError):
+            continue
+        for event in events:
+            name = event.get("name")
+            detail = event.get("args", {}).get("detail")
+            if detail is None or "dur" not in event:
+                continue
+            if name in HEADER_EVENTS:
+                headers[detail] = headers.get(detail, 0) + event["dur"]
+            elif name in TEMPLATE_EVENTS:
+                templates[detail] = templates.get(detail, 0) + event["dur"]
+    return headers, templates
+
+
+# Returns snapshot dict or None if no sources found
+def collect(profile_name, profile_dir):
+    ninja_log = os.path.join(profile_dir, NINJA_LOG)
+    timer_log = timer_log_path(profile_dir)
+
+    if os.path.exists(ninja_log):
+        source = "ninja"
+        durations = _read_ninja_log(ninja_log)
+    elif os.path.exists(timer_log):
+        source = "launcher"
+        durations = _read_timer_log(timer_log, profile_dir)
+    else:
+        return None
+
+    objects = {output: ms for output, ms in durations.items() if _is_object(output)}
+
+    artifacts = impact.target_artifacts(profile_dir)
+    targets = {}
+    for output, ms in durations.items():
+        target = _target(output, artifacts)
+        targets[target] = targets.get(target, 0) + ms
+
+    traces = [_time_trace_path(profile_dir, output) for output in objects]
+    headers, templates = _aggregate_time_traces(
+        [path for path in traces if os.path.exists(path)])
+
+    return {
+        "profile": profile_name,
+        "time": int(time.time()),
+        "source": source,
+        "total_ms": sum(objects.values()),
+        "objects": objects,
+        "targets": targets,
+        "headers_us": headers,
+        "templates_us": templates,
+    }
+
+
+class StatsHistory:
+    def __init__(self, build_dir):
+        self.dir = os.path.join(build_dir, STATS_DIR_NAME)
+
+    def _path(self, profile_name):
+        return os.path.join(self.dir, "{}.json".format(profile_name))
+
+    def load(self, profile_name):
+        path = self._path(profile_name)
+        if not os.path.exists(path):
+            return []
+        try:
+            return helpers.load_json(path)
+        except ValueError:
+            return []
+
+    # Builds that did not compile or link anything are not recorded
+    def append(self, snapshot):
+        history = self.load(snapshot["profile"])
+        if history and same_build(history[-1], snapshot):
+            return
+
+        history = (history + [snapshot])[-HISTORY_SIZE:]
+        helpers.mkdir(self.dir, parents=True)
+        with open(self._path(snapshot["profile"]), "w") as f:
+            json.dump(history, f)
+
+    # Snapshot to compare current one with or None
+    def previous(self, snapshot):
+        history = self.load(snapshot["profile"])
+        if history and same_build(history[-1], snapshot):
+            history = history[:-1]
+        return history[-1] if history else None
+
+
+def same_build(snapshot, other):
+    return snapshot["objects"] == other["objects"] and snapshot["targets"] == other["targets"]
+
+
+def top(items, count):
+    return sorted(items.items(), key=lambda item: item[1], reverse=True)[:count]
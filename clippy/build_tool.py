@@ -0,0 +1,77 @@
+import os
+
+from .exceptions import ClientError
+from . import helpers
+
+# Build tools (CMake generators) that build targets in configured build directory
+
+MAKE_GENERATOR = "Unix Makefiles"
+NINJA_GENERATOR = "Ninja"
+
+
+class BuildTool:
+    generator = None
+    binary = None
+    # Takes job slots from parent make jobserver (MAKEFLAGS) instead of -j
+    jobserver_client = False
+
+    def target_command(self, targets, jobs=None):
+        cmd = [self.binary]
+        if jobs:
+            cmd.extend(["-j", str(jobs)])
+        return cmd + list(targets)
+
+
+class Make(BuildTool):
+    generator = MAKE_GENERATOR
+    binary = "make"
+    jobserver_client = True
+
+
+class Ninja(BuildTool):
+    generator = NINJA_GENERATOR
+    binary = "ninja"
+
+
+TOOLS = [Make, Ninja]
+
+
+# Generator setting from .clippy.json / build profile:
+# not set - Unix Makefiles, "auto" - Ninja if available
+def resolve_generator(setting):
+    if setting is None:
+        return MAKE_GENERATOR
+    if setting == "auto":
+        if helpers.which(Ninja.binary):
+            return NINJA_GENERATOR
+        return MAKE_GENERATOR
+    return setting
+
+
+def for_generator(generator):
+    for tool in TOOLS:
+        if tool.generator == generator:
+            return tool()
+    raise ClientError("Unsupported CMake generator: '{}'".format(generator))
+
+
+# Generator of configured build directory or None
+def configured_generator(build_dir):
+    cache_path = os.path.join(build_dir, "CMakeCache.txt")
+    if not os.path.exists(cache_path):
+        return None
+
+    with open(cache_path, "r", errors="replace") as cache:
+        for line in cache:
+            if line.startswith("CMAKE_GENERATOR:"):
+                return line.split("=", 1)[1].strip()
+    return None
+
+
+def detect(build_dir):
+    generator = configured_generator(build_dir)
+    if generator is None:
+        if os.path.exists(os.path.join(build_dir, "build.ninja")):
+            return Ninja()
+        return Make()
+    return for_generator(generator)
@@ -1,30 +1,47 @@
+import collections
+import json
 import logging
 import os
+import re
+import resource
+import signal
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
+from . import cgroups
 from . import helpers
 from . import highlight
 from . import sandbox
 from .echo import echo
 from .exceptions import ClientError
+from .trace import tracer
 
+CHUNK_SIZE = 64 * 1024
 
+
+# Output is copied in chunks, without decoding
 def call_with_live_output(cmd, **kwargs):
     p = subprocess.Popen(
         cmd,
         shell=False,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        #bufsize=1,
         **kwargs)
 
-    for line in p.stdout:
-        line = line.decode("utf-8")
-        sys.stdout.write(line)
-
     sys.stdout.flush()
+    out = sys.stdout.buffer
 
+    while True:
+        chunk = os.read(p.stdout.fileno(), CHUNK_SIZE)
+        if not chunk:
+            break
+        out.write(chunk)
+        out.flush()
+
+    p.stdout.close()
     return p.wait()
 
 
@@ -34,7 +51,8 @@ def _check_call_ci(cmd, **kwargs):
     if exit_code != 0:
         echo.error(
             "Command {} returned non-zero exit code: {}".format(cmd, exit_code))
-        sys.exit(1)
+
+    return exit_code
 
 
 def _check_call_default(cmd, **kwargs):
@@ -42,7 +60,9 @@ def _check_call_default(cmd, **kwargs):
         subprocess.check_call(cmd, stderr=subprocess.STDOUT, **kwargs)
     except subprocess.CalledProcessError as error:
         echo.error(str(error))
-        sys.exit(1)
+        return error.returncode
+
+    return 0
 
 
 def check_call(cmd, **kwargs):
@@ -52,21 +72,425 @@ def check_call(cmd, **kwargs):
 
     sys.stdout.write('\n{} output:\n'.format(highlight.path(tool)))  # header
 
-    if "CLIPPY_CI" in os.environ:
-        _check_call_ci(cmd, **kwargs)
-    else:
-        _check_call_default(cmd, **kwargs)
+    with tracer.process(cmd) as span:
+        if "CLIPPY_CI" in os.environ:
+            exit_code = _check_call_ci(cmd, **kwargs)
+        else:
+            exit_code = _check_call_default(cmd, **kwargs)
+        span["exit_code"] = exit_code
+
+    if exit_code != 0:
+        sys.exit(1)
 
     sys.stdout.write("\n")  # empty footer line
 
-def check_call_user_code(cmd, **kwargs):
-    if "CLIPPY_CI" in os.environ:
-        kwargs["preexec_fn"] = sandbox.setup_sandbox
+# Quiet build mode (--quiet-build): build tool output goes to bounded
+# ring buffer and gzip log, terminal shows progress line only.
+# Tail of the buffer is printed on failure.
+
+QUIET_TAIL_LINES = 200
+
+# Progress of make ("[ 42%]") and ninja ("[12/40]")
+PROGRESS_PATTERN = re.compile(rb"^\[\s*(\d+%|\d+/\d+)\]")
+
+# Progress line redraw interval, seconds
+PROGRESS_INTERVAL = 0.1
+
+_quiet_build = False
+# Logs written by this run, appended as separate gzip members
+_quiet_logs = set()
+
+
+def set_quiet_build(enabled):
+    global _quiet_build
+    _quiet_build = enabled
+
+
+def is_quiet_build():
+    return _quiet_build
+
+
+class _QuietOutput:
+    def __init__(self, tool, log, tail_lines):
+        self.tool = tool
+        self.log = log
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.partial = b""
+        self.progress = None
+        self.lines = 0
+        self.interactive = sys.stdout.isatty()
+        self.last_redraw = 0.0
+
+    def feed(self, chunk):
+        self.log.write(chunk)
+
+        lines = (self.partial + chunk).split(b"\n")
+        self.partial = lines.pop()
+        self.tail.extend(lines)
+        self.lines += len(lines)
+
+        for line in reversed(lines):
+            match = PROGRESS_PATTERN.match(line)
+            if match:
+                self.progress = match.group(1).decode("utf-8")
+                break
+
+        self._redraw()
+
+    def _status(self):
+        return "{}: {} lines{}".format(
+            self.tool, self.lines, ", " + self.progress if self.progress else "")
+
+    # Progress line is redrawn in terminal only, CI logs get final status
+    def _redraw(self):
+        if not self.interactive:
+            return
+        now = time.monotonic()
+        if now - self.last_redraw < PROGRESS_INTERVAL:
+            return
+        self.last_redraw = now
+        sys.stdout.write("\r\033[K" + self._status())
+        sys.stdout.flush()
+
+    def finish(self):
+        if self.partial:
+            self.tail.append(self.partial)
+            self.lines += 1
+        if self.interactive:
+            sys.stdout.write("\r\033[K")
+        sys.stdout.write(self._status() + "\n")
+        sys.stdout.flush()
+
+    def print_tail(self):
+        sys.stdout.flush()
+        for line in self.tail:
+            sys.stdout.buffer.write(line + b"\n")
+        sys.stdout.buffer.flush()
+
+
+def _check_call_quiet(cmd, log_path, **kwargs):
+    import gzip
+
+    tool = os.path.basename(cmd[0])
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+
+    mode = "ab" if log_path in _quiet_logs else "wb"
+    _quiet_logs.add(log_path)
+
+    with gzip.open(log_path, mode, compresslevel=1) as log:
+        log.write("Command: {}\n\n".format(cmd).encode("utf-8"))
+
+        output = _QuietOutput(tool, log, QUIET_TAIL_LINES)
+
+        p = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, **kwargs)
+        while True:
+            chunk = os.read(p.stdout.fileno(), CHUNK_SIZE)
+            if not chunk:
+                break
+            output.feed(chunk)
+        p.stdout.close()
+        exit_code = p.wait()
+
+        output.finish()
+
+    if exit_code != 0:
+        echo.error("Command {} returned non-zero exit code: {}, last {} lines of output "
+                   "(full log: {}):".format(cmd, exit_code, len(output.tail), log_path))
+        output.print_tail()
+
+    return exit_code
+
+
+# Build tools (make, ninja, cmake) call: in quiet build mode
+# output goes to gzip log at log_path, see _check_call_quiet
+def check_build_call(cmd, log_path, **kwargs):
+    if not _quiet_build:
+        check_call(cmd, **kwargs)
+        return
+
+    logging.debug("Running command {}, log: {}".format(cmd, log_path))
+
+    with tracer.process(cmd) as span:
+        exit_code = _check_call_quiet(cmd, log_path, **kwargs)
+        span["exit_code"] = exit_code
+
+    if exit_code != 0:
+        sys.exit(1)
+
+
+class RunResult:
+    def __init__(self, exit_code, elapsed, usage, rss_floor_kb, timed_out=False):
+        self.exit_code = exit_code
+        self.elapsed = elapsed
+        self.user_cpu_s = usage.ru_utime
+        self.system_cpu_s = usage.ru_stime
+        self.max_rss_kb = usage.ru_maxrss
+        # Peak RSS survives fork and exec, so it includes memory of clippy at
+        # spawn and of exec wrapper (see exec_user_code.py), which reports
+        # this floor. Values up to the floor only mean "at most floor",
+        # see cgroup_usage for exact peak of the run
+        self.max_rss_floor_kb = rss_floor_kb
+        self.timed_out = timed_out
+        # Description of exceeded resource limit, see limits.Limits.violation
+        self.limit = None
+        # cgroups.Usage of the whole run with cgroup backend, otherwise None
+        self.cgroup_usage = None
+
+
+def _kill(p, process_group, cgroup=None):
+    try:
+        if process_group:
+            os.killpg(p.pid, signal.SIGKILL)
+        else:
+            p.kill()
+    except ProcessLookupError:
+        pass
+    if cgroup is not None:
+        cgroup.kill()
 
-    check_call(cmd, **kwargs)
 
-def check_output_user_code(cmd, **kwargs):
+# Resource usage of this process only (os.wait4), not of all children
+# user_code: _UserCode, child leads its own process group, whole group
+# is killed on timeout and after exit (leftover background processes),
+# leaf cgroup usage is reported and the leaf is removed after run
+def run_and_measure(cmd, timeout=None, user_code=None, **kwargs):
+    stop_watch = helpers.StopWatch()
+    rss_floor_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if user_code is not None:
+        p = user_code.popen(cmd, **kwargs)
+    else:
+        p = subprocess.Popen(cmd, **kwargs)
+
+    process_group = user_code is not None
+    cgroup = user_code.cgroup if user_code is not None else None
+
+    timed_out = threading.Event()
+    timer = None
+    if timeout:
+        def on_timeout():
+            timed_out.set()
+            _kill(p, process_group, cgroup)
+        timer = threading.Timer(timeout, on_timeout)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        _, status, usage = os.wait4(p.pid, 0)
+    except BaseException:
+        _kill(p, process_group, cgroup)
+        p.wait()
+        if user_code is not None:
+            user_code.rss_floor_kb()
+        if cgroup is not None:
+            cgroup.remove()
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+    p.returncode = os.waitstatus_to_exitcode(status)
+
+    if process_group:
+        _kill(p, process_group, cgroup)
+
+    wrapper_rss_kb = user_code.rss_floor_kb() if user_code is not None else None
+    if wrapper_rss_kb is not None:
+        rss_floor_kb = wrapper_rss_kb
+
+    result = RunResult(
+        p.returncode, stop_watch.elapsed_seconds(), usage, rss_floor_kb, timed_out.is_set())
+
+    if cgroup is not None:
+        result.cgroup_usage = cgroup.usage()
+        cgroup.remove()
+
+    return result
+
+
+# Usage of this process only, safe for spans of concurrent runs
+def _trace_result(span, result):
+    span["exit_code"] = result.exit_code
+    span["user_cpu_s"] = result.user_cpu_s
+    span["system_cpu_s"] = result.system_cpu_s
+    span["max_rss_kb"] = result.max_rss_kb
+
+
+def _call_to_log(cmd, log_path, limits=None, **kwargs):
+    logging.debug("Running command {}, log: {}".format(cmd, log_path))
+
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+
+    with open(log_path, "wb") as log, tracer.process(cmd) as span:
+        log.write("Command: {}\n\n".format(cmd).encode("utf-8"))
+        log.flush()
+        result = run_and_measure(
+            cmd, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, **kwargs)
+        _check_limits(result, limits)
+        if result.limit:
+            log.write("\nLimit exceeded: {}\n".format(result.limit).encode("utf-8"))
+        _trace_result(span, result)
+
+    return result
+
+
+# Output goes to log file, returns exit code
+def call_to_log(cmd, log_path, **kwargs):
+    return _call_to_log(cmd, log_path, **kwargs).exit_code
+
+
+EXEC_WRAPPER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "exec_user_code.py")
+
+
+# User code runs in its own session (process group) with resource limits,
+# in leaf cgroup if cgroup backend is configured (see cgroups.py),
+# in CI also in sandbox (see sandbox.py).
+#
+# preexec_fn is not safe with threads of parallel runs, so limits and
+# sandbox user are applied by exec wrapper (see exec_user_code.py),
+# which is moved to leaf cgroup before it execs user code
+class _UserCode:
+    def __init__(self, limits):
+        self.limits = limits
+        self.in_sandbox = "CLIPPY_CI" in os.environ
+        self.cgroup = cgroups.create_leaf(limits)
+        # Read end of pipe with peak RSS of exec wrapper, see rss_floor_kb
+        self.rss_fd = None
+
+    def popen(self, cmd, **kwargs):
+        if self.in_sandbox and "env" not in kwargs:
+            kwargs["env"] = sandbox.whitelisted_env()
+
+        if not (self.limits or self.in_sandbox or self.cgroup is not None):
+            return subprocess.Popen(cmd, start_new_session=True, **kwargs)
+
+        read_fd, write_fd = os.pipe()
+        rss_read_fd, rss_write_fd = os.pipe()
+        try:
+            p = subprocess.Popen(
+                [sys.executable, "-S", "-E", EXEC_WRAPPER, str(read_fd), str(rss_write_fd)] + cmd,
+                start_new_session=True, pass_fds=[read_fd, rss_write_fd], **kwargs)
+        except BaseException:
+            os.close(write_fd)
+            os.close(rss_read_fd)
+            self._remove_cgroup()
+            raise
+        finally:
+            os.close(read_fd)
+            os.close(rss_write_fd)
+        self.rss_fd = rss_read_fd
+
+        try:
+            with os.fdopen(write_fd, "w") as spec:
+                spec.write(json.dumps(self._spec(p.pid)))
+        except BrokenPipeError:
+            pass  # wrapper failed, its exit code is reported
+        return p
+
+    # Peak RSS of exec wrapper before exec, KB, or None if user code was
+    # spawned directly or wrapper failed. Called once, after the wrapper exits
+    def rss_floor_kb(self):
+        if self.rss_fd is None:
+            return None
+        with os.fdopen(self.rss_fd, "r") as f:
+            data = f.read()
+        self.rss_fd = None
+        try:
+            return int(data)
+        except ValueError:
+            return None
+
+    def _remove_cgroup(self):
+        if self.cgroup is not None:
+            self.cgroup.remove()
+            self.cgroup = None
+
+    def _spec(self, pid):
+        if self.cgroup is not None:
+            try:
+                self.cgroup.attach(pid)
+            except OSError as error:
+                logging.warning("Cannot move user code to cgroup {}: {}, using rlimits only".format(
+                    self.cgroup.path, error))
+                self._remove_cgroup()
+
+        rlimits = []
+        if self.limits:
+            rlimits = self.limits.rlimits(cgroup=self.cgroup is not None, sandbox=self.in_sandbox)
+        user = sandbox.sandbox_user() if self.in_sandbox else None
+        return {"rlimits": rlimits, "user": user}
+
+
+def _user_code_kwargs(limits, kwargs):
+    kwargs["user_code"] = _UserCode(limits)
+    if limits and limits.timeout_s:
+        kwargs["timeout"] = limits.timeout_s
+    return kwargs
+
+
+def _check_limits(result, limits):
+    if limits:
+        result.limit = limits.violation(
+            result.exit_code, result.timed_out, result.user_cpu_s + result.system_cpu_s,
+            result.cgroup_usage)
+
+
+def check_call_user_code(cmd, limits=None, **kwargs):
+    result = call_user_code(cmd, limits=limits, **kwargs)
+    if result.exit_code != 0:
+        sys.exit(1)
+
+# Environment for user code with extra variables: explicit env is passed
+# to exec as is, so sandbox whitelist is applied here
+def user_code_env(extra):
     if "CLIPPY_CI" in os.environ:
-        kwargs["preexec_fn"] = sandbox.setup_sandbox
+        env = sandbox.whitelisted_env()
+    else:
+        env = dict(os.environ)
+    env.update(extra)
+    return env
+
+# Output goes to log file, returns RunResult
+def call_to_log_user_code(cmd, log_path, limits=None, **kwargs):
+    return _call_to_log(cmd, log_path, limits=limits, **_user_code_kwargs(limits, kwargs))
+
+# Output goes to terminal, returns RunResult
+def call_user_code(cmd, limits=None, **kwargs):
+    logging.debug("Running command {}".format(cmd))
+
+    sys.stdout.write('\n{} output:\n'.format(highlight.path(cmd[0])))  # header
+    sys.stdout.flush()
+
+    with tracer.process(cmd) as span:
+        result = run_and_measure(cmd, stderr=subprocess.STDOUT, **_user_code_kwargs(limits, kwargs))
+        _check_limits(result, limits)
+        _trace_result(span, result)
+
+    if result.limit:
+        echo.error("Command {} was stopped: {}".format(cmd, result.limit))
+    elif result.exit_code != 0:
+        echo.error("Command {} returned non-zero exit code: {}".format(cmd, result.exit_code))
+
+    sys.stdout.write("\n")  # empty footer line
+    return result
+
+# Returns stdout, stderr goes to terminal. Output is collected in
+# temporary file: run_and_measure waits for exit before it could be read
+# timeout: used if limits have no "timeout_s"
+def check_output_user_code(cmd, limits=None, **kwargs):
+    logging.debug("Running command {}".format(cmd))
+
+    with tempfile.TemporaryFile() as output, tracer.process(cmd) as span:
+        result = run_and_measure(
+            cmd, stdout=output, stdin=subprocess.DEVNULL, **_user_code_kwargs(limits, kwargs))
+        _check_limits(result, limits)
+        _trace_result(span, result)
+        output.seek(0)
+        data = output.read()
 
-    return subprocess.check_output(cmd, **kwargs)
+    if result.limit or result.timed_out:
+        raise ClientError("Command {} was stopped: {}".format(
+            cmd, result.limit or "wall-clock timeout exceeded"))
+    if result.exit_code != 0:
+        raise subprocess.CalledProcessError(result.exit_code, cmd, output=data)
+    return data
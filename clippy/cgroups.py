@@ -0,0 +1,238 @@
+import errno
+import itertools
+import logging
+import os
+import signal
+import threading
+import time
+
+# cgroup v2 sandbox backend for user code
+#
+# Enabled by "cgroup_root" in .clippy.json or CLIPPY_CGROUP_ROOT: a delegated
+# cgroup v2 subtree writable by clippy without processes of its own
+# (e.g. systemd unit with Delegate=yes, or a directory chown-ed by grading box setup).
+#
+# Each run gets its own leaf cgroup "run-<pid>-<n>" with limits:
+#   memory.max  <- limits.memory_mb (instead of RLIMIT_AS, counts all processes)
+#   cpu.max     <- limits.cpus (CPU bandwidth, e.g. 1.5)
+#   pids.max    <- limits.processes (instead of per-user RLIMIT_NPROC)
+# After run memory.peak and cpu.stat are reported, remaining processes
+# are killed and leaf is removed.
+#
+# Without usable cgroup v2 subtree runs fall back to rlimits (see limits.py)
+
+CONTROLLERS = ["memory", "cpu", "pids"]
+
+CPU_PERIOD_US = 100000
+
+LEAF_PREFIX = "run-"
+
+# Waiting for killed processes to leave the leaf before rmdir
+REMOVE_ATTEMPTS = 50
+REMOVE_DELAY_S = 0.02
+
+_root = None
+_checked = False
+_lock = threading.Lock()
+_counter = itertools.count()
+
+
+def _read(path):
+    with open(path, "r") as f:
+        return f.read().strip()
+
+
+def _write(path, value):
+    with open(path, "w") as f:
+        f.write(value)
+
+
+def _read_keyed(path):
+    values = {}
+    try:
+        content = _read(path)
+    except OSError:
+        return values
+    for line in content.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            values[parts[0]] = int(parts[1])
+    return values
+
+
+def configure(root):
+    global _root, _checked
+
+    with _lock:
+        _root = root
+        _checked = False
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Leaves of crashed clippy processes
+def _remove_stale_leaves(root):
+    for name in os.listdir(root):
+        if not name.startswith(LEAF_PREFIX):
+            continue
+        pid = name[len(LEAF_PREFIX):].split("-")[0]
+        if pid.isdigit() and not _pid_alive(int(pid)):
+            try:
+                os.rmdir(os.path.join(root, name))
+            except OSError:
+                pass
+
+
+def _enable_controllers(root):
+    available = _read(os.path.join(root, "cgroup.controllers")).split()
+    missing = [name for name in CONTROLLERS if name not in available]
+    if missing:
+        raise OSError("controllers {} are not delegated".format(missing))
+
+    subtree_control = os.path.join(root, "cgroup.subtree_control")
+    enabled = _read(subtree_control).split()
+    wanted = ["+" + name for name in CONTROLLERS if name not in enabled]
+    if wanted:
+        _write(subtree_control, " ".join(wanted))
+
+
+# Delegated subtree or None, checked once
+def usable_root():
+    global _root, _checked
+
+    with _lock:
+        if _root is None or _checked:
+            return _root
+        _checked = True
+
+        try:
+            _enable_controllers(_root)
+            _remove_stale_leaves(_root)
+        except OSError as error:
+            logging.warning(
+                "cgroup v2 sandbox is unavailable in {}: {}, using rlimits only".format(_root, error))
+            _root = None
+
+        return _root
+
+
+class Usage:
+    def __init__(self, memory_peak_kb, cpu_user_s, cpu_system_s, oom_kills, pids_max_events):
+        # memory.peak requires Linux 5.19, None on older kernels
+        self.memory_peak_kb = memory_peak_kb
+        # All processes of the leaf, unlike rusage of the direct child
+        self.cpu_user_s = cpu_user_s
+        self.cpu_system_s = cpu_system_s
+        self.oom_kills = oom_kills
+        self.pids_max_events = pids_max_events
+
+
+class Leaf:
+    def __init__(self, path, limits):
+        self.path = path
+
+        os.mkdir(path)
+        try:
+            if limits:
+                self._apply(limits)
+        except BaseException:
+            self.remove()
+            raise
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _apply(self, limits):
+        if limits.memory_mb is not None:
+            _write(self._file("memory.max"), str(int(limits.memory_mb) * 1024 * 1024))
+            # Otherwise limit is enforced by swapping
+            if os.path.exists(self._file("memory.swap.max")):
+                _write(self._file("memory.swap.max"), "0")
+            # OOM kills the whole run, not a random process of it
+            _write(self._file("memory.oom.group"), "1")
+
+        if limits.cpus is not None:
+            quota = max(1000, int(float(limits.cpus) * CPU_PERIOD_US))
+            _write(self._file("cpu.max"), "{} {}".format(quota, CPU_PERIOD_US))
+
+        if limits.processes is not None:
+            _write(self._file("pids.max"), str(int(limits.processes)))
+
+    # Moves process to the leaf, called by clippy for exec wrapper
+    # of user code before it execs (see exec_user_code.py)
+    def attach(self, pid):
+        _write(self._file("cgroup.procs"), str(pid))
+
+    def usage(self):
+        cpu = _read_keyed(self._file("cpu.stat"))
+        memory_events = _read_keyed(self._file("memory.events"))
+        pids_events = _read_keyed(self._file("pids.events"))
+
+        try:
+            memory_peak_kb = int(_read(self._file("memory.peak"))) // 1024
+        except OSError:
+            memory_peak_kb = None
+
+        return Usage(
+            memory_peak_kb,
+            cpu.get("user_usec", 0) / 1e6,
+            cpu.get("system_usec", 0) / 1e6,
+            memory_events.get("oom_kill", 0),
+            pids_events.get("max", 0))
+
+    def _pids(self):
+        try:
+            return [int(pid) for pid in _read(self._file("cgroup.procs")).split()]
+        except OSError:
+            return []
+
+    # Kills processes which left process group too
+    def kill(self):
+        try:
+            _write(self._file("cgroup.kill"), "1")
+            return
+        except OSError:
+            pass  # cgroup.kill requires Linux 5.14
+
+        for pid in self._pids():
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def remove(self):
+        for _ in range(REMOVE_ATTEMPTS):
+            try:
+                os.rmdir(self.path)
+                return
+            except FileNotFoundError:
+                return
+            except OSError as error:
+                if error.errno != errno.EBUSY:
+                    break
+                self.kill()
+                time.sleep(REMOVE_DELAY_S)
+
+        logging.debug("Cannot remove cgroup {}".format(self.path))
+
+
+# Leaf cgroup for a single run or None if backend is not available
+def create_leaf(limits):
+    root = usable_root()
+    if root is None:
+        return None
+
+    name = "{}{}-{}".format(LEAF_PREFIX, os.getpid(), next(_counter))
+    try:
+        return Leaf(os.path.join(root, name), limits)
+    except OSError as error:
+        logging.warning("Cannot create cgroup in {}: {}, using rlimits only".format(root, error))
+        return None
@@ -0,0 +1,103 @@
+# Included via CMAKE_PROJECT_INCLUDE for build profiles with
+# "precompiled_headers" / "unity_build" options, see clippy/build.py
+#
+# Variables (set by clippy):
+#   CLIPPY_PCH_HEADERS - headers to precompile
+#   CLIPPY_PCH_TARGETS - target name regexes, empty - all targets
+#   CLIPPY_PCH_REUSE - ON: executables reuse PCH of the first matched executable
+#   CLIPPY_UNITY_BUILD - ON / OFF
+#   CLIPPY_UNITY_TARGETS - target name regexes for unity build
+#   CLIPPY_UNITY_BATCH_SIZE - sources per unity file
+
+include_guard(GLOBAL)
+
+# Not cmake_minimum_required: it would reset policies of the course project
+if(CMAKE_VERSION VERSION_LESS 3.19)
+  message(FATAL_ERROR "clippy: precompiled_headers / unity_build profile options require CMake 3.19+")
+endif()
+
+# Functions below record policies at definition, project policies are restored after
+cmake_policy(PUSH)
+cmake_policy(VERSION 3.19)
+
+function(_clippy_collect_targets dir out)
+  get_property(targets DIRECTORY "${dir}" PROPERTY BUILDSYSTEM_TARGETS)
+  get_property(subdirs DIRECTORY "${dir}" PROPERTY SUBDIRECTORIES)
+  foreach(subdir ${subdirs})
+    _clippy_collect_targets("${subdir}" subdir_targets)
+    list(APPEND targets ${subdir_targets})
+  endforeach()
+  set(${out} ${targets} PARENT_SCOPE)
+endfunction()
+
+function(_clippy_matches target patterns out)
+  if(NOT patterns)
+    set(${out} ON PARENT_SCOPE)
+    return()
+  endif()
+  foreach(pattern ${patterns})
+    if(target MATCHES "${pattern}")
+      set(${out} ON PARENT_SCOPE)
+      return()
+    endif()
+  endforeach()
+  set(${out} OFF PARENT_SCOPE)
+endfunction()
+
+function(_clippy_compiled_target target out)
+  get_target_property(type ${target} TYPE)
+  if(type MATCHES "^(EXECUTABLE|STATIC_LIBRARY|SHARED_LIBRARY|MODULE_LIBRARY|OBJECT_LIBRARY)$")
+    set(${out} ON PARENT_SCOPE)
+  else()
+    set(${out} OFF PARENT_SCOPE)
+  endif()
+endfunction()
+
+function(_clippy_apply_build_options)
+  _clippy_collect_targets("${CMAKE_SOURCE_DIR}" targets)
+
+  set(pch_target "")
+  set(pch_count 0)
+  set(unity_count 0)
+
+  foreach(target ${targets})
+    _clippy_compiled_target(${target} compiled)
+    if(NOT compiled)
+      continue()
+    endif()
+
+    if(CLIPPY_PCH_HEADERS)
+      _clippy_matches(${target} "${CLIPPY_PCH_TARGETS}" matched)
+      if(matched)
+        # Test harnesses share compile flags, libraries may differ (e.g. PIC)
+        get_target_property(type ${target} TYPE)
+        if(CLIPPY_PCH_REUSE AND pch_target AND type STREQUAL "EXECUTABLE")
+          target_precompile_headers(${target} REUSE_FROM ${pch_target})
+        else()
+          target_precompile_headers(${target} PRIVATE ${CLIPPY_PCH_HEADERS})
+          if(NOT pch_target AND type STREQUAL "EXECUTABLE")
+            set(pch_target ${target})
+          endif()
+        endif()
+        math(EXPR pch_count "${pch_count} + 1")
+      endif()
+    endif()
+
+    if(CLIPPY_UNITY_BUILD)
+      _clippy_matches(${target} "${CLIPPY_UNITY_TARGETS}" matched)
+      if(matched)
+        set_target_properties(${target} PROPERTIES
+          UNITY_BUILD ON
+          UNITY_BUILD_BATCH_SIZE ${CLIPPY_UNITY_BATCH_SIZE})
+        math(EXPR unity_count "${unity_count} + 1")
+      endif()
+    endif()
+  endforeach()
+
+  message(STATUS "clippy: precompiled headers for ${pch_count} target(s), unity build for ${unity_count} target(s)")
+endfunction()
+
+# Targets are known only after the whole top-level CMakeLists.txt is processed
+cmake_language(DEFER DIRECTORY "${CMAKE_SOURCE_DIR}" CALL _clippy_apply_build_options)
+
+cmake_policy(POP)
@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+
+# Compiler launcher that records compile times for `clippy build-stats`
+#
+# Usage (CMAKE_<LANG>_COMPILER_LAUNCHER): python3 compile_timer.py <log> <compiler command...>
+#
+# Appends "<start ms>\t<end ms>\t<output>" line to <log>.
+# Runs standalone for every translation unit, so imports nothing from clippy.
+
+
+def _output(args):
+    for i, arg in enumerate(args):
+        # Make runs compilers in target subdirectories
+        if arg == "-o" and i + 1 < len(args):
+            return os.path.abspath(args[i + 1])
+        if arg.startswith("-o") and len(arg) > 2:
+            return os.path.abspath(arg[2:])
+    return None
+
+
+def main():
+    log_path, args = sys.argv[1], sys.argv[2:]
+
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.execvp(args[0], args)
+        finally:
+            os._exit(127)
+    _, status = os.waitpid(pid, 0)
+    end = time.time()
+
+    output = _output(args)
+    if output is not None and os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+        line = "{}\t{}\t{}\n".format(int(start * 1000), int(end * 1000), output)
+        # Single O_APPEND write: safe for concurrent compile jobs
+        fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
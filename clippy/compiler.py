@@ -1,40 +1,40 @@
-import subprocess
-
 from .exceptions import ToolNotFound
 from . import helpers
 
 
 class ClangCCompiler:
-    def __init__(self, binary):
+    def __init__(self, binary, toolchain=None):
         self.binary = binary
+        self.toolchain = toolchain
 
     @property
     def version(self):
-        output = subprocess.check_output([self.binary, "--version"])
-        lines = output.splitlines()
-        return lines[0].strip().decode("utf-8")
+        if self.toolchain:
+            return self.toolchain.version(self.binary)
+        return helpers.tool_version(self.binary)
 
     @classmethod
-    def locate(cls, names):
-        binary = helpers.locate_binary(names)
+    def locate(cls, names, toolchain=None):
+        binary = helpers.locate_tool(names, toolchain)
         if binary is None:
             raise ToolNotFound("Clang C compiler not found")
-        return cls(binary)
+        return cls(binary, toolchain)
 
 
 class ClangCxxCompiler:
-    def __init__(self, binary):
+    def __init__(self, binary, toolchain=None):
         self.binary = binary
+        self.toolchain = toolchain
 
     @property
     def version(self):
-        output = subprocess.check_output([self.binary, "--version"])
-        lines = output.splitlines()
-        return lines[0].strip().decode("utf-8")
+        if self.toolchain:
+            return self.toolchain.version(self.binary)
+        return helpers.tool_version(self.binary)
 
     @classmethod
-    def locate(cls, names):
-        binary = helpers.locate_binary(names)
+    def locate(cls, names, toolchain=None):
+        binary = helpers.locate_tool(names, toolchain)
         if binary is None:
             raise ToolNotFound("Clang++ compiler not found")
-        return cls(binary)
+        return cls(binary, toolchain)
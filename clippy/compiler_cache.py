@@ -0,0 +1,122 @@
+import json
+import os
+import subprocess
+
+from .exceptions import ClientError, ToolNotFound
+from . import helpers
+
+# Compiler cache (ccache / sccache) used as CMake compiler launcher
+#
+# Settings ("compiler_cache" in .clippy.json or in build profile):
+#   true / false
+#   {"tool": "ccache" | "sccache" | "auto", "dir": "...", "max_size": "5G"}
+
+DEFAULT_MAX_SIZE = "5G"
+DEFAULT_DIR_NAME = ".compiler-cache"
+
+TOOLS = ["ccache", "sccache"]
+
+
+class CompilerCache:
+    def __init__(self, tool, binary, dir, max_size, base_dir):
+        self.tool = tool
+        self.binary = binary
+        self.dir = dir
+        self.max_size = max_size
+        # Paths under base dir are hashed as relative: cache hits across build dirs
+        self.base_dir = base_dir
+
+    def env(self):
+        if self.tool == "ccache":
+            return {
+                "CCACHE_DIR": self.dir,
+                "CCACHE_MAXSIZE": self.max_size,
+                "CCACHE_BASEDIR": self.base_dir,
+            }
+        else:
+            return {
+                "SCCACHE_DIR": self.dir,
+                "SCCACHE_CACHE_SIZE": self.max_size,
+            }
+
+    # CMake list: env VAR=value ... cache-binary
+    def launcher(self):
+        assignments = ["{}={}".format(var, value) for var, value in sorted(self.env().items())]
+        return ";".join(["env"] + assignments + [self.binary])
+
+    def _run(self, args):
+        env = dict(os.environ)
+        env.update(self.env())
+        return subprocess.check_output([self.binary] + args, env=env).decode("utf-8")
+
+    # Returns {"hits", "misses", "cache_size", "files"}, sizes in bytes
+    def stats(self):
+        if self.tool == "ccache":
+            return self._ccache_stats()
+        else:
+            return self._sccache_stats()
+
+    def _ccache_stats(self):
+        counters = {}
+        for line in self._run(["--print-stats"]).splitlines():
+            parts = line.split("\t")
+            if len(parts) == 2 and parts[1].strip().isdigit():
+                counters[parts[0]] = int(parts[1])
+
+        return {
+            "hits": counters.get("direct_cache_hit", 0) + counters.get("preprocessed_cache_hit", 0),
+            "misses": counters.get("cache_miss", 0),
+            "cache_size": counters.get("cache_size_kibibyte", 0) * 1024,
+            "files": counters.get("files_in_cache", 0),
+        }
+
+    def _sccache_stats(self):
+        info = json.loads(self._run(["--show-stats", "--stats-format", "json"]))
+        stats = info.get("stats", {})
+
+        def total(name):
+            return sum(stats.get(name, {}).get("counts", {}).values())
+
+        return {
+            "hits": total("cache_hits"),
+            "misses": total("cache_misses"),
+            "cache_size": info.get("cache_size") or 0,
+            "files": stats.get("cache_writes", 0),
+        }
+
+
+def _resolve_tool(tool, toolchain):
+    names = TOOLS if tool == "auto" else [tool]
+    for name in names:
+        if name not in TOOLS:
+            raise ClientError("Unsupported compiler cache: '{}'".format(name))
+        binary = helpers.locate_tool([name], toolchain)
+        if binary:
+            return name, binary
+    raise ToolNotFound("Compiler cache not found: {}".format(names))
+
+
+# Returns CompilerCache or None if disabled
+def from_settings(settings, build_dir, base_dir, toolchain=None):
+    if not settings:
+        return None
+    if settings is True:
+        settings = {}
+
+    tool, binary = _resolve_tool(settings.get("tool", "auto"), toolchain)
+
+    dir = settings.get("dir", os.path.join(build_dir, DEFAULT_DIR_NAME))
+    if not os.path.isabs(dir):
+        dir = os.path.join(build_dir, dir)
+
+    max_size = str(settings.get("max_size", DEFAULT_MAX_SIZE))
+
+    return CompilerCache(tool, binary, dir, max_size, base_dir)
+
+
+def format_size(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} TiB".format(size)
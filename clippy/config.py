@@ -3,6 +3,7 @@ import os
 
 from . import helpers
 from .exceptions import ClientError
+from .trace import tracer
 
 
 class Config:
@@ -18,7 +19,8 @@ class Config:
 
     def _load(self, template):
         data = template.copy()
-        file_data = helpers.load_json(self.path)
+        with tracer.span("config", path=self.path):
+            file_data = helpers.load_json(self.path)
         data.update(file_data)
 
         self.data = data
@@ -1,4 +1,8 @@
 from . import helpers
+from . import build_stats
+from . import cgroups
+from .watch import watch as watch_files
+from . import compiler_cache
 from . import highlight
 from .benchmark import print_benchmark_reports
 from .config import Config
@@ -6,15 +10,20 @@ from .call import check_call, check_call_user_code, check_output_user_code
 from .echo import echo
 from .exceptions import ClientError
 from .censor import Censor
+from .compiler import ClangCxxCompiler
 from .linters import ClangFormat, ClangTidy
 from .build import Build
 from .tasks import Tasks
+from .toolchain import Toolchain
+from .trace import tracer
+from .limits import Limits
+from .impact import ImpactIndex
+from .report import TestReport
+from .test_cache import TestResultCache
 from .test_runner import create_test_runner, TaskTargets
 from .solutions import Solutions
 
-import click
-import git
-
+import logging
 import os
 import json
 import shutil
@@ -23,56 +32,144 @@ import sys
 
 from pathlib import Path
 
+# Parts of the client are opened lazily, on first access:
+# cheap commands should not pay for git, build profiles or compilers
+
 class CourseClient:
     def __init__(self):
-        self.repo = self._this_client_repo()
-        self.config = self._open_client_config()
-        self.build = Build(self.repo, self.config, self._build_dir())
-        self.tasks = Tasks(self.repo)
-        self._reopen_solutions()
+        self._repo_dir = None
+        self._repo = None
+        self._config = None
+        self._build = None
+        self._toolchain = None
+        self._tasks = None
+        self._solutions = None
+
+    @property
+    def repo_dir(self):
+        if self._repo_dir is None:
+            self._repo_dir = self._this_client_repo_dir()
+        return self._repo_dir
+
+    @property
+    def repo(self):
+        if self._repo is None:
+            import git
+            self._repo = git.Repo(self.repo_dir)
+        return self._repo
+
+    @property
+    def config(self):
+        if self._config is None:
+            self._config = self._open_client_config()
+        return self._config
+
+    @property
+    def build(self):
+        if self._build is None:
+            self._build = Build(
+                self.repo_dir, self.config, self._build_dir(), self.toolchain)
+        return self._build
+
+    # Located compilers and linters, shared by all commands
+    @property
+    def toolchain(self):
+        if self._toolchain is None:
+            self._toolchain = Toolchain(
+                os.path.join(self._build_dir(), ".clippy-toolchain.json"))
+        return self._toolchain
+
+    @property
+    def tasks(self):
+        if self._tasks is None:
+            self._tasks = Tasks(
+                self.repo_dir, os.path.join(self._build_dir(), ".clippy-tasks.json"))
+        return self._tasks
+
+    @property
+    def solutions(self):
+        if self._solutions is None:
+            self._reopen_solutions()
+        return self._solutions
+
+    @property
+    def compiler(self):
+        return ClangCxxCompiler.locate(
+            self.config.get("cxx_compiler_binaries"), self.toolchain)
+
+    # Open all parts of the client at once, used by resident daemon
+    def open_all(self):
+        _ = self.repo
+        _ = self.build
+        _ = self.tasks
+        _ = self.solutions
+        _ = self.compiler.version
+
+    # Client state depends on these files
+    # Solutions are not opened here: broken config is watched too,
+    # so that daemon reloads once it is fixed
+    def config_files(self):
+        link_path = os.path.join(self.repo_dir, "client/.solutions")
+        files = [
+            os.path.join(self.repo_dir, ".clippy.json"),
+            os.path.join(self.repo_dir, ".clippy-build-profiles.json"),
+            link_path,
+        ]
+        if os.path.exists(link_path):
+            with open(link_path) as link:
+                solutions_repo_dir = link.read().strip()
+            if solutions_repo_dir:
+                files.append(os.path.join(solutions_repo_dir, ".clippy-user.json"))
+        return files
 
     def _build_dir(self):
         build_dir = self.config.get_or("build_dir", default="build")
         if os.path.isabs(build_dir):
             return build_dir
         else:
-            return os.path.join(self.repo.working_tree_dir, build_dir)
+            return os.path.join(self.repo_dir, build_dir)
 
-    def _this_client_repo(self):
-        this_tool_real_path = os.path.realpath(__file__)
-        repo_root_dir = helpers.git_repo_root_dir(
-            os.path.dirname(this_tool_real_path))
-        return git.Repo(Path(repo_root_dir).parent)
+    def _this_client_repo_dir(self):
+        this_tool_dir = os.path.dirname(os.path.realpath(__file__))
+        # Avoid spawning git: client repo root is the nearest directory with .git
+        client_root_dir = helpers.climb(".git", this_tool_dir, steps=3)
+        if client_root_dir is None:
+            client_root_dir = helpers.git_repo_root_dir(this_tool_dir)
+        return str(Path(client_root_dir).parent)
 
     def _open_client_config(self):
-        path = os.path.join(self.repo.working_tree_dir, ".clippy.json")
+        path = os.path.join(self.repo_dir, ".clippy.json")
         return Config(path)
 
     def _reopen_solutions(self):
-        self.solutions = Solutions.open(self.repo, self.config)
+        self._solutions = Solutions.open(self.repo_dir, self.config)
 
-    def update(self, with_cmake):
-        os.chdir(self.repo.working_tree_dir)
+    def update(self, with_cmake, jobs=None, force=False):
+        os.chdir(self.repo_dir)
 
         echo.echo("Updating tasks repository\n")
 
         master_branch = self.config.get_or("repo_master", "master")
-        subprocess.check_call(["git", "pull", "origin", master_branch])
-        subprocess.check_call(["git", "submodule", "update", "--init", "--recursive"])
+        git_pull_cmd = ["git", "pull", "origin", master_branch]
+        with tracer.process(git_pull_cmd):
+            subprocess.check_call(git_pull_cmd)
+        git_submodules_cmd = ["git", "submodule", "update", "--init", "--recursive"]
+        with tracer.process(git_submodules_cmd):
+            subprocess.check_call(git_submodules_cmd)
 
         if with_cmake:
             echo.blank_line()
-            self.cmake()
+            self.cmake(jobs=jobs, force=force)
 
     # Generate build scripts
-    def cmake(self, clean=False, profile=None):
+    def cmake(self, clean=False, profile=None, jobs=None, force=False):
         if clean:
             self.build.reset()
 
         if profile:
-            self.build.cmake_profile(profile)
+            self.build.cmake_profile(profile, force=force)
         else:
-            self.build.cmake()
+            self.build.cmake(jobs=jobs, force=force)
 
 
     # Build common libraries
@@ -83,8 +180,95 @@ class CourseClient:
             echo.note("No targets to warmup")
             return
 
-        for target in warmup_targets:
-            self.build.warmup(target)
+        self.build.warmup(warmup_targets)
+
+    def print_compiler_cache_stats(self):
+        caches = self.build.compiler_caches()
+
+        if not caches:
+            echo.note("Compiler cache is disabled, see 'compiler_cache' in .clippy.json")
+            return
+
+        for profiles, cache in caches:
+            stats = cache.stats()
+
+            requests = stats["hits"] + stats["misses"]
+            hit_rate = 100.0 * stats["hits"] / requests if requests else 0.0
+            # Estimate: average cached object size per hit
+            saved = stats["hits"] * stats["cache_size"] // stats["files"] if stats["files"] else 0
+
+            echo.echo("{} at {} (profiles {}):".format(
+                highlight.smth(cache.tool), highlight.path(cache.dir), profiles))
+            echo.write("Hits: {}, misses: {}, hit rate: {:.1f}%".format(
+                stats["hits"], stats["misses"], hit_rate))
+            echo.write("Cache size: {} (max {}), saved: ~{}".format(
+                compiler_cache.format_size(stats["cache_size"]),
+                cache.max_size,
+                compiler_cache.format_size(saved)))
+            echo.blank_line()
+
+    def print_build_stats(self, profile=None, top=10, as_json=False):
+        names = [profile] if profile else self.build.list_profile_names()
+        history = build_stats.StatsHistory(self.build.path)
+
+        snapshots = []
+        for name in names:
+            snapshot = self.build.collect_build_stats(name)
+            if snapshot is None:
+                if not as_json:
+                    echo.note("No compile times for profile {}: build with Ninja generator "
+                              "or enable 'compile_stats'".format(name))
+                continue
+            snapshots.append((snapshot, history.previous(snapshot)))
+            # Builds of profiles without compile statistics options are
+            # recorded here: unchanged snapshot is not appended again
+            try:
+                history.append(snapshot)
+            except OSError as error:
+                logging.warning("Cannot save compile times: {}".format(error))
+
+        if as_json:
+            echo.json([snapshot for snapshot, _ in snapshots])
+            return
+
+        def seconds(ms):
+            return "{:.2f}s".format(ms / 1000.0)
+
+        def delta(ms, previous_ms):
+            if previous_ms is None:
+                return ""
+            return " ({:+.2f}s)".format((ms - previous_ms) / 1000.0)
+
+        for snapshot, previous in snapshots:
+            previous = previous or {}
+
+            echo.echo("Profile {}: {} translation units, total {}{}".format(
+                highlight.smth(snapshot["profile"]),
+                len(snapshot["objects"]),
+                seconds(snapshot["total_ms"]),
+                delta(snapshot["total_ms"], previous.get("total_ms"))))
+
+            echo.write("Slowest translation units:")
+            for output, ms in build_stats.top(snapshot["objects"], top):
+                echo.write("  {:>9}{}  {}".format(
+                    seconds(ms), delta(ms, previous.get("objects", {}).get(output)), output))
+
+            echo.write("Slowest targets:")
+            for target, ms in build_stats.top(snapshot["targets"], top):
+                echo.write("  {:>9}{}  {}".format(
+                    seconds(ms), delta(ms, previous.get("targets", {}).get(target)), target))
+
+            if snapshot["headers_us"]:
+                echo.write("Most expensive headers (-ftime-trace):")
+                for header, us in build_stats.top(snapshot["headers_us"], top):
+                    echo.write("  {:>9}  {}".format(seconds(us / 1000.0), header))
+
+            if snapshot["templates_us"]:
+                echo.write("Most expensive template instantiations (-ftime-trace):")
+                for template, us in build_stats.top(snapshot["templates_us"], top):
+                    echo.write("  {:>9}  {}".format(seconds(us / 1000.0), template))
+
+            echo.blank_line()
 
     def print_current_task(self):
         current_task = self.tasks.current_dir_task()
@@ -96,11 +280,29 @@ class CourseClient:
             echo.echo("Not in task directory: {}".format(
                 highlight.path(os.getcwd())))
 
+    def print_tasks(self, topic=None, as_json=False):
+        tasks = self.tasks.list(topic)
+
+        if as_json:
+            echo.json([{
+                "topic": task.topic,
+                "name": task.name,
+                "dir": task.dir,
+                "conf": task.conf.json_conf,
+                "lint_files": task.all_files_to_lint,
+                "solution_files": task.all_solution_files,
+            } for task in tasks])
+            return
+
+        for task in tasks:
+            echo.echo("{}/{}".format(
+                highlight.topic(task.topic), highlight.task(task.name)))
+
     def attach_remote_solutions(self, url, local_name=None):
         url = url.rstrip('/')
         helpers.check_gitlab(url)
 
-        repo_parent_dir = os.path.dirname(self.repo.working_tree_dir)
+        repo_parent_dir = os.path.dirname(self.repo_dir)
         os.chdir(repo_parent_dir)
 
         if not local_name:
@@ -109,10 +311,11 @@ class CourseClient:
         solutions_repo_dir = os.path.join(repo_parent_dir, local_name)
 
         link_path = os.path.join(
-            self.repo.working_tree_dir,
+            self.repo_dir,
             "client/.solutions")
 
         if os.path.exists(solutions_repo_dir):
+            import click
             if click.confirm("Do you want remove existing solutions local repo '{}'?".format(
                     solutions_repo_dir), default=False):
                 echo.echo(
@@ -155,7 +358,7 @@ class CourseClient:
 
         # rewrite link
         link_path = os.path.join(
-            self.repo.working_tree_dir,
+            self.repo_dir,
             "client/.solutions")
         with open(link_path, "w") as link:
             link.write(solutions_repo_dir)
@@ -179,28 +382,70 @@ class CourseClient:
     def current_task(self):
         return self.tasks.current_dir_task()
 
-    def _censor_before_test(self, task):
+    # interactive: ask whether to run tests despite censor errors
+    def _censor_before_test(self, task, interactive=True):
         censor = Censor(self.config)
-        report = censor.check(task)
+        with tracer.span("censor"):
+            report = censor.check(task)
 
         if report.has_errors():
             report.print()
+            if not interactive:
+                return
+            import click
             if not click.confirm("Are you sure you want to run the tests?", default=True):
                 raise ClientError("Aborting")
 
-    def test(self, task, config_path, censor):
+    # stress: stress.StressOptions for repeated runs or None
+    # affected: skip units with inputs unchanged since green run, see impact.py
+    def test(self, task, config_path, censor, parallel=False, use_cache=True, report_path=None,
+             interactive=True, stress=None, affected=False):
         if task.conf.theory:
             echo.note("Action disabled for theory task")
             return
 
         if censor:
-            self._censor_before_test(task)
-
-        test_runner = create_test_runner(task, self.build)
-        test_runner.run_tests(config_path)
-
-    def target(self, task, target, profile, args):
-        targets = TaskTargets(task, self.build)
+            self._censor_before_test(task, interactive)
+
+        # Graded runs always execute tests
+        if "CLIPPY_CI" in os.environ:
+            use_cache = False
+            affected = False
+
+        self._configure_cgroups()
+
+        cache = TestResultCache(os.path.join(self._build_dir(), ".clippy-test-results.json"))
+        impact = None
+        if affected:
+            impact = ImpactIndex(os.path.join(self._build_dir(), ".clippy-affected.json"), self.repo_dir)
+        report = TestReport(report_path) if report_path else None
+        test_runner = create_test_runner(
+            task, self.build, cache, use_cache, report, self.config.get_or("limits", default=None), stress,
+            impact)
+        test_runner.run_tests(config_path, parallel=parallel)
+
+    def _limits(self, task):
+        return Limits.from_settings(task.fullname, self.config.get_or("limits", default=None), task.conf.limits)
+
+    # cgroup v2 backend for user code runs, see cgroups.py
+    def _configure_cgroups(self):
+        root = os.environ.get("CLIPPY_CGROUP_ROOT") or self.config.get_or("cgroup_root", default=None)
+        cgroups.configure(root)
+
+    # Reruns run() on changes of task files, see watch.py
+    def watch(self, task, run):
+        names = list(task.conf.lint_files or [])
+        if not task.conf.theory:
+            names += task.conf.solution_files
+        paths = sorted(set(os.path.join(task.dir, name) for name in names))
+        if not paths:
+            raise ClientError("Task {} has no submit_files / lint_files to watch".format(task.fullname))
+
+        watch_files(paths, run)
+
+    def target(self, task, target, profile, args, stress=None):
+        self._configure_cgroups()
+        targets = TaskTargets(task, self.build, self._limits(task), stress)
         targets.run(target, profile, args)
 
     def debug(self, task, target, profile, args):
@@ -212,8 +457,9 @@ class CourseClient:
             echo.note("Action disabled for theory task")
             return
 
-        with self.build.profile("Release"):
-            check_call(helpers.make_target_command(task.run_benchmark_target))
+        build_dir = self.build.profile_dir("Release")
+        with tracer.span("build", target=task.run_benchmark_target, profile="Release"):
+            self.build.build_targets(build_dir, [task.run_benchmark_target])
 
     def _get_lint_targets(self, task):
         if task.conf.theory:
@@ -244,12 +490,13 @@ class CourseClient:
         os.chdir(task.dir)
 
         clang_format = ClangFormat.locate(
-            self.config.get("format_binaries"))
+            self.config.get("format_binaries"), self.toolchain)
 
         echo.echo(
             "Checking {} with clang-format ({})".format(task.conf.lint_files, clang_format.binary))
 
-        ok, diffs = clang_format.check(lint_targets, style="file")
+        with tracer.span("clang-format", files=len(lint_targets)):
+            ok, diffs = clang_format.check(lint_targets, style="file")
         if diffs:
             for target_file, diff in diffs.items():
                 echo.echo("File: {}".format(
@@ -271,7 +518,7 @@ class CourseClient:
         if os.path.isabs(includes_path):
             return includes_path
         else:
-            return os.path.join(self.repo.working_tree_dir, includes_path)
+            return os.path.join(self.repo_dir, includes_path)
 
     def _tidy_include_dirs(self, task):
         libs_path = self._tidy_libs_path()
@@ -292,7 +539,7 @@ class CourseClient:
         os.chdir(task.dir)
 
         clang_tidy = ClangTidy.locate(
-            self.config.get("tidy_binaries"))
+            self.config.get("tidy_binaries"), self.toolchain)
 
         compiler_options = self.config.get_or("tidy_compiler_options", default=[])
         if compiler_options:
@@ -305,10 +552,14 @@ class CourseClient:
         echo.echo(
             "Checking {} with clang-tidy ({})".format(task.conf.lint_files, clang_tidy.binary))
 
-        if not clang_tidy.check(lint_targets, include_dirs):
+        with tracer.span("clang-tidy", files=len(lint_targets)):
+            tidy_ok = clang_tidy.check(lint_targets, include_dirs)
+
+        if not tidy_ok:
             if verify:
                 raise ClientError("clang-tidy check failed")
 
+            import click
             if click.confirm("Do you want to fix these errors?", default=True):
                 echo.echo(
                     "Applying clang-tidy --fix to {}".format(lint_targets))
@@ -328,7 +579,8 @@ class CourseClient:
 
     def censor(self, task):
         censor = Censor(self.config)
-        report = censor.check(task)
+        with tracer.span("censor"):
+            report = censor.check(task)
         if report.has_errors():
             report.raise_on_errors()
 
@@ -343,19 +595,22 @@ class CourseClient:
         self.censor(task)
 
     def _get_benchmark_scores(self, task):
-        with self.build.profile("Release") as build_dir:
-            check_call(helpers.make_target_command(task.benchmark_target))
-
-            benchmark_bin = os.path.join(
-                build_dir,
-                'tasks',
-                task.topic,
-                task.name,
-                'bin',
-                task.benchmark_target)
-            scores_json = check_output_user_code(
-                [benchmark_bin, '--benchmark_format=json'], timeout=60).decode('utf-8')
-            return json.loads(scores_json)
+        build_dir = self.build.profile_dir("Release")
+        with tracer.span("build", target=task.benchmark_target, profile="Release"):
+            self.build.build_targets(build_dir, [task.benchmark_target])
+
+        benchmark_bin = os.path.join(
+            build_dir,
+            'tasks',
+            task.topic,
+            task.name,
+            'bin',
+            task.benchmark_target)
+        self._configure_cgroups()
+        scores_json = check_output_user_code(
+            [benchmark_bin, '--benchmark_format=json'], limits=self._limits(task), cwd=build_dir,
+            timeout=60).decode('utf-8')
+        return json.loads(scores_json)
 
     def _run_perf_checker(self, task, solution_scores, private_scores):
         checker_path = os.path.join(task.dir, "benchmark_scores.py")
@@ -373,7 +628,7 @@ class CourseClient:
             echo.echo("No performance test")
             return
 
-        private_solutions_repo_dir = self.repo.working_tree_dir + "-private"
+        private_solutions_repo_dir = self.repo_dir + "-private"
         private_solution_dir = os.path.join(private_solutions_repo_dir, "perf_solutions", task.fullname)
         if not os.path.exists(private_solution_dir):
             echo.echo("Private solution not found: {}".format(private_solution_dir))
@@ -0,0 +1,344 @@
+import array
+import io
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+
+# Resident clippy process (`clippy serve`)
+#
+# Daemon keeps client state warm and runs commands forwarded by thin
+# clients over UNIX domain socket. Thin client passes its stdin, stdout
+# and stderr along with the request, each command runs in a forked child
+# attached to these descriptors, so output goes straight to the caller.
+# Commands run concurrently: children are reaped on SIGCHLD, accept loop
+# does not wait for them.
+#
+# Protocol (JSON lines):
+#   client -> daemon: {"argv": [...], "cwd": "...", "env": {...}} + fds
+#   daemon -> client: {"pid": ...}, then {"exit_code": ...}
+
+SOCKET_NAME = ".clippy.sock"
+
+# Check watched files at least this often, seconds
+WATCH_INTERVAL = 2.0
+
+_MAX_MESSAGE = 1024 * 1024
+
+# Accept loop waits for request of connected client at most this long, seconds
+REQUEST_TIMEOUT = 1.0
+
+
+def socket_path(tool_dir):
+    return os.environ.get("CLIPPY_SOCKET", os.path.join(tool_dir, SOCKET_NAME))
+
+
+def _send_line(sock, data, fds=None):
+    payload = (json.dumps(data) + "\n").encode("utf-8")
+    if fds:
+        sock.sendmsg([payload], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+    else:
+        sock.sendall(payload)
+
+
+class _LineReader:
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b""
+        self.fds = []
+
+    def _recv(self):
+        fds = array.array("i")
+        data, ancdata, _, _ = self.sock.recvmsg(
+            65536, socket.CMSG_LEN(3 * fds.itemsize))
+        for level, type, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+        self.fds.extend(fds)
+        return data
+
+    def read(self):
+        while b"\n" not in self.buffer:
+            data = self._recv()
+            if not data:
+                return None
+            self.buffer += data
+            if len(self.buffer) > _MAX_MESSAGE:
+                raise RuntimeError("Message too long")
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return json.loads(line.decode("utf-8"))
+
+# --------------------------------------------------------------------
+
+# Thin client
+
+
+# Returns exit code of forwarded command or None if daemon is not running
+# or did not start the command (command is run in-process then)
+def forward(path, argv):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock:
+        request = {
+            "argv": argv,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+        }
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        reader = _LineReader(sock)
+        pid = None
+        try:
+            _send_line(sock, request, fds=[0, 1, 2])
+            while True:
+                try:
+                    reply = reader.read()
+                except KeyboardInterrupt:
+                    # Forward to command process group, wait for exit code
+                    if pid is not None:
+                        os.killpg(pid, signal.SIGINT)
+                    continue
+
+                if reply is None:
+                    break
+                if "pid" in reply:
+                    pid = reply["pid"]
+                if "exit_code" in reply:
+                    return reply["exit_code"]
+        except (OSError, ValueError, RuntimeError) as error:
+            logging.debug("Daemon connection failed: {}".format(error))
+
+        if pid is None:
+            return None
+        return 1  # daemon died while command was running
+
+# --------------------------------------------------------------------
+
+# Daemon
+
+
+class Server:
+    # reload() -> list of files to watch, builds fresh client state
+    # run(argv) -> runs command in-process
+    def __init__(self, path, reload, run):
+        self.path = path
+        self.reload = reload
+        self.run = run
+        self.watched = {}
+        # pid of running command -> connection of its thin client
+        self.children = {}
+        # SIGCHLD wakes up accept loop through this pipe
+        self.wakeup = None
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _reload(self):
+        files = self.reload()
+        self.watched = {path: self._mtime(path) for path in files}
+
+    def _changed(self):
+        for path, mtime in self.watched.items():
+            if self._mtime(path) != mtime:
+                return path
+        return None
+
+    def _check_changes(self):
+        changed = self._changed()
+        if changed:
+            logging.info("Config changed: {}, reloading".format(changed))
+            self._reload()
+
+    def _listen(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)  # stale
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        listener.listen(16)
+        return listener
+
+    @staticmethod
+    def _on_terminate(signum, frame):
+        sys.exit(0)
+
+    @staticmethod
+    def _on_child(signum, frame):
+        pass  # handled in accept loop, see _reap
+
+    def _watch_children(self):
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.wakeup[1])
+        signal.signal(signal.SIGCHLD, self._on_child)
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self.wakeup[0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    # Sends exit codes of finished commands to their thin clients
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+
+            conn = self.children.pop(pid, None)
+            if conn is None:
+                continue
+
+            exit_code = os.waitstatus_to_exitcode(status)
+            if exit_code < 0:
+                exit_code = 128 - exit_code  # killed by signal
+
+            with conn:
+                try:
+                    _send_line(conn, {"exit_code": exit_code})
+                except OSError:
+                    pass
+
+    def serve(self):
+        signal.signal(signal.SIGTERM, self._on_terminate)
+        self._watch_children()
+
+        self._reload()
+
+        listener = self._listen()
+        logging.info("Serving on {}".format(self.path))
+
+        try:
+            while True:
+                ready, _, _ = select.select([listener, self.wakeup[0]], [], [], WATCH_INTERVAL)
+
+                if self.wakeup[0] in ready:
+                    self._drain_wakeup()
+                self._reap()
+
+                if listener not in ready:
+                    self._check_changes()
+                    continue
+
+                conn, _ = listener.accept()
+                # Client that connected but does not send request must not block the loop
+                conn.settimeout(REQUEST_TIMEOUT)
+                self._check_changes()
+                self._handle(conn, listener)
+        finally:
+            listener.close()
+            for conn in self.children.values():
+                conn.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    # Starts command, connection is closed after its exit code is sent
+    def _handle(self, conn, listener):
+        reader = _LineReader(conn)
+        try:
+            request = reader.read()
+        except (OSError, ValueError, RuntimeError) as error:
+            logging.warning("Bad request: {}".format(error))
+            request = None
+
+        if request is None or len(reader.fds) != 3:
+            for fd in reader.fds:
+                os.close(fd)
+            conn.close()
+            return
+        conn.settimeout(None)
+
+        # Buffered output of the daemon would be written by the child too
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            listener.close()
+            self._close_inherited(conn)
+            self._run_child(request, reader.fds)
+
+        for fd in reader.fds:
+            os.close(fd)
+
+        self.children[pid] = conn
+        try:
+            _send_line(conn, {"pid": pid})
+        except OSError:
+            pass
+
+    # Connections of other commands and SIGCHLD wakeup belong to the daemon
+    def _close_inherited(self, conn):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+        for fd in self.wakeup:
+            os.close(fd)
+        conn.close()
+        for other in self.children.values():
+            other.close()
+
+    # Standard streams of the daemon are set up for its own stdout (e.g. log
+    # file) and environment, child sets them up as fresh interpreter would
+    # for the client's descriptors and environment (PYTHONUNBUFFERED)
+    @staticmethod
+    def _reset_std_streams():
+        unbuffered = bool(os.environ.get("PYTHONUNBUFFERED"))
+
+        def output(fd):
+            return io.open(fd, "wb", buffering=0 if unbuffered else -1, closefd=False)
+
+        sys.stdin = io.TextIOWrapper(io.open(0, "rb", closefd=False))
+        sys.stdout = io.TextIOWrapper(output(1), line_buffering=os.isatty(1), write_through=unbuffered)
+        sys.stderr = io.TextIOWrapper(
+            output(2), errors="backslashreplace", line_buffering=True, write_through=unbuffered)
+
+    def _run_child(self, request, fds):
+        exit_code = 1
+        try:
+            # Own process group: thin client forwards Ctrl-C to it
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+            for target_fd, fd in enumerate(fds):
+                os.dup2(fd, target_fd)
+                os.close(fd)
+
+            os.environ.clear()
+            os.environ.update(request["env"])
+            self._reset_std_streams()
+            os.chdir(request["cwd"])
+
+            self.run(request["argv"])
+            exit_code = 0
+        except SystemExit as exit:
+            if isinstance(exit.code, int):
+                exit_code = exit.code
+            elif exit.code is None:
+                exit_code = 0
+        except BaseException:
+            logging.exception("Command failed")
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(exit_code)
@@ -0,0 +1,69 @@
+import json
+import os
+import resource
+import signal
+import sys
+# Lazily imported by os.execvp: stdlib may be unreadable after privileges are dropped
+import warnings  # noqa: F401
+
+# Exec wrapper of user code, see _UserCode in call.py
+#
+# Started by clippy in a new session as
+#   python -S -E exec_user_code.py <spec fd> <rss fd> <cmd>...
+# and waits for JSON spec on <spec fd>, which clippy sends after moving
+# the wrapper to leaf cgroup of the run:
+#   {"rlimits": [[resource, soft, hard], ...], "user": [uid, gid] or null}
+# Then rlimits are applied, privileges are dropped and cmd is exec-ed.
+#
+# Peak RSS of the process survives exec, so before exec the wrapper writes
+# its own peak RSS (KB) to <rss fd>: peak RSS of cmd is known exactly only
+# when it is above this floor.
+#
+# Not a part of clippy package: nothing but stdlib is imported before exec
+
+# Wrapper failed, cmd was not started
+EXIT_SETUP_FAILED = 127
+
+
+def _read_spec(fd):
+    with os.fdopen(fd, "rb") as f:
+        data = f.read()
+    if not data:
+        raise RuntimeError("run spec was not received")
+    return json.loads(data.decode("utf-8"))
+
+
+def _drop_privileges(uid, gid):
+    os.setgroups([])
+    os.setresgid(gid, gid, gid)
+    os.setresuid(uid, uid, uid)
+
+
+def _report_rss(fd):
+    with os.fdopen(fd, "w") as f:
+        f.write(str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def main(argv):
+    fd, rss_fd, cmd = int(argv[1]), int(argv[2]), argv[3:]
+    try:
+        spec = _read_spec(fd)
+        for limit, soft, hard in spec["rlimits"]:
+            resource.setrlimit(limit, (soft, hard))
+        if spec["user"] is not None:
+            _drop_privileges(*spec["user"])
+
+        # Ignored by python interpreter, ignored dispositions survive exec
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        signal.signal(signal.SIGXFSZ, signal.SIG_DFL)
+
+        _report_rss(rss_fd)
+        os.execvp(cmd[0], cmd)
+    except (OSError, ValueError, KeyError, RuntimeError) as error:
+        sys.stderr.write("clippy: cannot start {}: {}\n".format(cmd, error))
+        sys.stderr.flush()
+        os._exit(EXIT_SETUP_FAILED)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -6,9 +6,7 @@ import os
 import shutil
 import subprocess
 import shlex
-from distutils import dir_util
-
-import git
+import time
 
 from .exceptions import ToolNotFound, ClientError
 
@@ -35,6 +33,20 @@ def locate_binary(possible_names):
     return None
 
 
+# Use toolchain cache if provided
+def locate_tool(possible_names, toolchain=None):
+    if toolchain:
+        return toolchain.locate(possible_names)
+    return locate_binary(possible_names)
+
+
+# First line of `{binary} --version` output
+def tool_version(binary):
+    output = subprocess.check_output([binary, "--version"])
+    lines = output.splitlines()
+    return lines[0].strip().decode("utf-8")
+
+
 def check_tool(name):
     binary = which(name)
     if not binary:
@@ -65,13 +77,6 @@ def mkdir(dir, parents=False):
     cmd.append(dir)
     subprocess.check_call(cmd)
 
-def make_target_command(target):
-    cmd = ["make"]
-    if "CLIPPY_CI" not in os.environ:
-        cmd.extend(["-j", str(os.cpu_count())])
-    cmd.append(target)
-    return cmd
-
 def glob_expand(patterns):
     files = set()
     for pattern in patterns:
@@ -118,7 +123,7 @@ def copy_files(source_dir, dest_dir, names, clear_dest=False, make_dirs=False):
             if os.path.isdir(source_path):
                 dest_path = os.path.join(dest_dir, name)
                 if os.path.exists(dest_path):
-                    dir_util.remove_tree(dest_path)
+                    shutil.rmtree(dest_path)
 
     # Copy
     for name in names:
@@ -126,7 +131,7 @@ def copy_files(source_dir, dest_dir, names, clear_dest=False, make_dirs=False):
         dest_path = os.path.join(dest_dir, name)
         if os.path.isdir(source_path):
             # Copy directory
-            dir_util.copy_tree(source_path, dest_path)
+            shutil.copytree(source_path, dest_path, dirs_exist_ok=True)
         else:
             # Copy file
 
@@ -188,6 +193,8 @@ def check_gitlab(url):
         "Expected gitlab.com repository, provided: '{}'".format(url))
 
 def is_git_repo(path):
+    import git
+
     try:
         _ = git.Repo(path).git_dir
         return True
@@ -229,16 +236,16 @@ class StopWatch:
 
     @staticmethod
     def _now():
-        return datetime.datetime.now()
+        return time.monotonic()
 
     def reset(self):
         self.start = self._now()
 
     def elapsed(self):
-        return self._now() - self.start
+        return datetime.timedelta(seconds=self.elapsed_seconds())
 
     def elapsed_seconds(self):
-        return self.elapsed().total_seconds()
+        return self._now() - self.start
 
 def split_args(args):
     if args:
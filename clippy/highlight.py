@@ -1,20 +1,40 @@
 import logging
 import sys
 
-try:
-    from termcolor import colored
-except ImportError:
-    logging.warning("'termcolor' module not found")
-
-    def colored(text, *args, **kwargs):
-        return text
-
-if sys.stderr.isatty():
-    style = colored
-else:
-    # disable coloring if not attached to terminal
-    def style(text, *args, **kwargs):
-        return text
+_style = None
+
+
+# termcolor is imported on first use, coloring is disabled
+# if not attached to terminal
+def _styler():
+    global _style
+
+    if _style is None:
+        if sys.stderr.isatty():
+            try:
+                from termcolor import colored
+                _style = colored
+            except ImportError:
+                logging.warning("'termcolor' module not found")
+                _style = _no_style
+        else:
+            _style = _no_style
+
+    return _style
+
+
+# Terminal may change, e.g. in resident daemon
+def reset():
+    global _style
+    _style = None
+
+
+def _no_style(text, *args, **kwargs):
+    return text
+
+
+def style(text, *args, **kwargs):
+    return _styler()(text, *args, **kwargs)
 
 
 # TODO(Lipovsky): support coloring schemes
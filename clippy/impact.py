@@ -0,0 +1,335 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+
+from . import build_tool
+from . import helpers
+
+# Change-based test selection: `clippy test --affected`
+#
+# Inputs of a target are sources and headers of its objects and of objects
+# of targets it depends on:
+#   target dependencies and sources - CMake file API (codemodel-v2),
+#   headers - depfiles (*.o.d with Unix Makefiles, `ninja -t deps` with Ninja).
+# Inputs inside course repository are hashed by content; system headers,
+# compiler and flags are covered by cmake stamp of the profile (see Build._cmake_stamp).
+#
+# Fingerprint of a target is recorded after green run. Unit (profile, target, args)
+# is skipped while fingerprint of its target is unchanged. Without dependency
+# information (profile not configured or built yet) the target is considered affected.
+
+FILE_API_QUERY = os.path.join(".cmake", "api", "v1", "query", "codemodel-v2")
+FILE_API_REPLY = os.path.join(".cmake", "api", "v1", "reply")
+
+# Entries older than that are dropped on save
+MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+
+_DEPFILE_TOKEN = re.compile(r"(?:\\ |\S)+")
+
+
+# Before cmake configure: CMake writes codemodel reply on each configure
+def write_query(build_dir):
+    path = os.path.join(build_dir, FILE_API_QUERY)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not os.path.exists(path):
+        open(path, "w").close()
+
+
+class _CodeModel:
+    def __init__(self, build_dir):
+        reply_dir = os.path.join(build_dir, FILE_API_REPLY)
+        indices = sorted(name for name in os.listdir(reply_dir) if name.startswith("index-"))
+        if not indices:
+            raise OSError("No CMake file API reply in {}".format(reply_dir))
+
+        index = helpers.load_json(os.path.join(reply_dir, indices[-1]))
+        codemodel = helpers.load_json(
+            os.path.join(reply_dir, index["reply"]["codemodel-v2"]["jsonFile"]))
+
+        self.build_dir = build_dir
+        self.reply_dir = reply_dir
+        self.source_dir = codemodel["paths"]["source"]
+        # Single-config generators only
+        targets = codemodel["configurations"][0]["targets"]
+        self.by_name = {target["name"]: target for target in targets}
+        self.by_id = {target["id"]: target for target in targets}
+        self.details = {}
+
+    def _target(self, target):
+        name = target["name"]
+        if name not in self.details:
+            self.details[name] = helpers.load_json(os.path.join(self.reply_dir, target["jsonFile"]))
+        return self.details[name]
+
+    # Target and targets it depends on, transitively
+    def closure(self, name):
+        names = []
+        stack = [self.by_name[name]]
+        while stack:
+            target = stack.pop()
+            if target["name"] in names:
+                continue
+            names.append(target["name"])
+            for dependency in self._target(target).get("dependencies", []):
+                stack.append(self.by_id[dependency["id"]])
+        return names
+
+    def sources(self, name):
+        return [
+            os.path.join(self.source_dir, source["path"])
+            for source in self._target(self.by_name[name]).get("sources", [])
+        ]
+
+    # {artifact path relative to build directory: target name}
+    def artifacts(self):
+        artifacts = {}
+        for name, target in self.by_name.items():
+            for artifact in self._target(target).get("artifacts", []):
+                path = artifact["path"]
+                if os.path.isabs(path):
+                    path = os.path.relpath(path, self.build_dir)
+                artifacts[os.path.normpath(path)] = name
+        return artifacts
+
+    # Directory of target objects and depfiles, relative to build directory:
+    # targets of tasks/<topic>/<task>/CMakeLists.txt keep them in
+    # tasks/<topic>/<task>/CMakeFiles/<name>.dir
+    def object_dir(self, name):
+        build = self._target(self.by_name[name]).get("paths", {}).get("build", ".")
+        return os.path.normpath(os.path.join(build, "CMakeFiles", name + ".dir"))
+
+
+# {artifact path relative to build_dir: target name}, empty without codemodel
+def target_artifacts(build_dir):
+    try:
+        return _CodeModel(build_dir).artifacts()
+    except (OSError, ValueError, KeyError) as error:
+        logging.debug("No CMake codemodel in {}: {}".format(build_dir, error))
+        return {}
+
+
+def _parse_depfile(path):
+    with open(path, "r", errors="replace") as f:
+        content = f.read().replace("\\\n", " ")
+
+    inputs = []
+    for line in content.splitlines():
+        if ": " not in line:
+            continue
+        deps = line.split(": ", 1)[1]
+        inputs.extend(token.replace("\\ ", " ") for token in _DEPFILE_TOKEN.findall(deps))
+    return inputs
+
+
+# CMake < 3.20 keeps dependencies of all objects in depend.make
+def _make_inputs(build_dir, object_dir):
+    object_dir = os.path.join(build_dir, object_dir)
+    depfiles = [path for path in helpers.dir_files(object_dir) if path.endswith(".o.d")]
+    if not depfiles:
+        depfiles = [
+            path for path in [os.path.join(object_dir, "depend.make")] if os.path.exists(path)]
+
+    inputs = []
+    for path in depfiles:
+        inputs.extend(_parse_depfile(path))
+    return inputs or None
+
+
+# {object: [inputs]} from .ninja_deps, paths relative to build_dir
+def _ninja_deps(build_dir):
+    output = subprocess.check_output(
+        [build_tool.Ninja.binary, "-C", build_dir, "-t", "deps"],
+        stderr=subprocess.DEVNULL).decode("utf-8", errors="replace")
+
+    deps = {}
+    current = None
+    for line in output.splitlines():
+        if not line.strip():
+            current = None
+        elif line.startswith((" ", "\t")):
+            if current is not None:
+                current.append(line.strip())
+        else:
+            current = deps.setdefault(line.split(": #deps", 1)[0], [])
+    return deps
+
+
+def _ninja_inputs(object_dir, ninja_deps):
+    prefix = object_dir.replace(os.sep, "/") + "/"
+    inputs = []
+    found = False
+    for obj, obj_inputs in ninja_deps.items():
+        if obj.startswith(prefix):
+            found = True
+            inputs.extend(obj_inputs)
+    return inputs if found else None
+
+
+class ImpactIndex:
+    def __init__(self, path, repo_dir):
+        self.path = path
+        self.repo_dir = os.path.realpath(repo_dir)
+        self.lock = threading.Lock()
+        self.dirty = False
+        # build_dir -> (stamp, data), dependency information is reused until rebuild
+        self.models = {}
+        self.ninja_deps = {}
+        self._load()
+
+    def _load(self):
+        self.green = {}
+        self.digests = {}
+
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            data = helpers.load_json(self.path)
+            self.green = data["green"]
+            self.digests = data["digests"]
+        except (OSError, ValueError, KeyError, TypeError):
+            logging.debug("Ignore broken impact index: {}".format(self.path))
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        now = time.time()
+        with self.lock:
+            green = {
+                key: entry for key, entry in self.green.items()
+                if now - entry["time"] < MAX_AGE_SECONDS
+            }
+            digests = {
+                path: entry for path, entry in self.digests.items()
+                if os.path.exists(path)
+            }
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(temp_path, "w") as f:
+                json.dump({"green": green, "digests": digests}, f)
+            os.replace(temp_path, self.path)
+            self.dirty = False
+        except OSError as error:
+            logging.debug("Cannot save impact index: {}".format(error))
+
+    # Content digest, reused while file (inode, size, mtime) has not changed
+    def _digest(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None  # removed input
+        stamp = [st.st_ino, st.st_size, st.st_mtime_ns]
+
+        with self.lock:
+            entry = self.digests.get(path)
+        if entry is not None and entry["stamp"] == stamp:
+            return entry["sha256"]
+
+        with open(path, "rb") as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+
+        with self.lock:
+            self.digests[path] = {"stamp": stamp, "sha256": sha256}
+            self.dirty = True
+        return sha256
+
+    def _in_repo(self, path):
+        return path.startswith(self.repo_dir + os.sep)
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    @staticmethod
+    def _cached(cache, build_dir, stamp, load):
+        entry = cache.get(build_dir)
+        if entry is None or entry[0] != stamp:
+            entry = (stamp, load())
+            cache[build_dir] = entry
+        return entry[1]
+
+    def _model(self, build_dir):
+        stamp = self._mtime(os.path.join(build_dir, FILE_API_REPLY))
+        return self._cached(self.models, build_dir, stamp, lambda: _CodeModel(build_dir))
+
+    def _ninja(self, build_dir):
+        if not isinstance(build_tool.detect(build_dir), build_tool.Ninja):
+            return None
+        stamp = self._mtime(os.path.join(build_dir, ".ninja_deps"))
+        return self._cached(self.ninja_deps, build_dir, stamp, lambda: _ninja_deps(build_dir))
+
+    # Input files of target or None if dependency information is not available
+    def _inputs(self, build_dir, target):
+        model = self._model(build_dir)
+        if target not in model.by_name:
+            return None
+
+        ninja_deps = self._ninja(build_dir)
+
+        inputs = set()
+        for name in model.closure(target):
+            sources = model.sources(name)
+            object_dir = model.object_dir(name)
+            if ninja_deps is not None:
+                headers = _ninja_inputs(object_dir, ninja_deps)
+            else:
+                headers = _make_inputs(build_dir, object_dir)
+            if headers is None and any(helpers.is_cpp_file(path) or path.endswith(".c") for path in sources):
+                return None  # not compiled yet
+            inputs.update(sources)
+            inputs.update(headers or [])
+
+        paths = set()
+        for path in inputs:
+            if not os.path.isabs(path):
+                path = os.path.join(build_dir, path)
+            paths.add(os.path.realpath(path))
+        return sorted(path for path in paths if self._in_repo(path))
+
+    # Digest of target inputs and profile cmake stamp or None
+    def fingerprint(self, build_dir, target, cmake_stamp):
+        if cmake_stamp is None:
+            return None
+        try:
+            inputs = self._inputs(build_dir, target)
+        except (OSError, ValueError, KeyError, subprocess.CalledProcessError) as error:
+            logging.debug("No dependency information for {}: {}".format(target, error))
+            return None
+        if inputs is None:
+            return None
+
+        data = {
+            "cmake": cmake_stamp,
+            "inputs": [[os.path.relpath(path, self.repo_dir), self._digest(path)] for path in inputs],
+        }
+        return hashlib.sha256(json.dumps(data).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def unit_key(task, profile, target, args):
+        data = [task, profile, target, list(args)]
+        return hashlib.sha256(json.dumps(data).encode("utf-8")).hexdigest()
+
+    def unchanged(self, key, fingerprint):
+        if fingerprint is None:
+            return False
+        with self.lock:
+            entry = self.green.get(key)
+        return entry is not None and entry["fingerprint"] == fingerprint
+
+    def record_green(self, key, fingerprint):
+        if fingerprint is None:
+            return
+        with self.lock:
+            self.green[key] = {"time": time.time(), "fingerprint": fingerprint}
+            self.dirty = True
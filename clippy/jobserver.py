@@ -0,0 +1,60 @@
+import os
+import re
+import subprocess
+
+from . import helpers
+
+# GNU make jobserver: pipe with job tokens shared by concurrent make
+# invocations, so that all of them together stay within one job budget
+#
+# Every make invocation has one implicit job slot, so for N concurrent
+# invocations and budget B the pipe holds B - N tokens
+
+# MAKEFLAGS option name: --jobserver-auth since GNU make 4.2, --jobserver-fds before
+AUTH_OPTION = "--jobserver-auth"
+LEGACY_AUTH_OPTION = "--jobserver-fds"
+AUTH_OPTION_SINCE = (4, 2)
+
+
+def _auth_option(make_binary):
+    try:
+        version = helpers.tool_version(make_binary)
+    except (OSError, subprocess.CalledProcessError):
+        return AUTH_OPTION
+    match = re.search(r"(\d+)\.(\d+)", version)
+    if match is None:
+        return AUTH_OPTION
+    if (int(match.group(1)), int(match.group(2))) < AUTH_OPTION_SINCE:
+        return LEGACY_AUTH_OPTION
+    return AUTH_OPTION
+
+
+class JobServer:
+    def __init__(self, tokens):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_inheritable(self.read_fd, True)
+        os.set_inheritable(self.write_fd, True)
+        if tokens > 0:
+            os.write(self.write_fd, b"+" * tokens)
+        self.auth_option = None
+
+    # subprocess kwargs for make client (make should be run without -j)
+    def make_kwargs(self, make_binary="make", env=None):
+        if self.auth_option is None:
+            self.auth_option = _auth_option(make_binary)
+        env = dict(env if env is not None else os.environ)
+        env["MAKEFLAGS"] = " -j {}={},{}".format(self.auth_option, self.read_fd, self.write_fd)
+        return {
+            "env": env,
+            "pass_fds": (self.read_fd, self.write_fd),
+        }
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,109 @@
+import resource
+import signal
+
+from .exceptions import ClientError
+
+# Resource limits for user code ("limits" in .clippy.json, overridden by task.json)
+#
+# {
+#   "timeout_s": 60,      - wall-clock time, process group is killed
+#   "cpu_s": 60,          - RLIMIT_CPU
+#   "memory_mb": 4096,    - RLIMIT_AS (address space, not usable with sanitizers)
+#   "open_files": 256,    - RLIMIT_NOFILE
+#   "processes": 64,      - pids.max with cgroup backend, otherwise RLIMIT_NPROC
+#                           in CI sandbox only (it counts all processes of the user)
+#   "cpus": 1.5           - CPU bandwidth, cgroup backend only
+# }
+#
+# With cgroup v2 backend (see cgroups.py) memory and processes are
+# limited by leaf cgroup of the run instead of rlimits.
+# Rlimits are applied by exec wrapper of user code (see exec_user_code.py).
+
+FIELDS = ["timeout_s", "cpu_s", "memory_mb", "open_files", "processes", "cpus"]
+
+# Counts, the rest may be fractional
+INT_FIELDS = ["memory_mb", "open_files", "processes"]
+
+# Grace period between SIGXCPU (soft limit) and SIGKILL (hard limit)
+CPU_GRACE_S = 1
+
+
+def _check_value(task_name, name, value):
+    types = (int,) if name in INT_FIELDS else (int, float)
+    if isinstance(value, bool) or not isinstance(value, types) or not 0 < value < float("inf"):
+        raise ClientError("Limit '{}' for task {} should be positive {}, got {!r}".format(
+            name, task_name, "integer" if name in INT_FIELDS else "number", value))
+
+
+class Limits:
+    def __init__(self, timeout_s=None, cpu_s=None, memory_mb=None, open_files=None, processes=None,
+                 cpus=None):
+        self.timeout_s = timeout_s
+        self.cpu_s = cpu_s
+        self.memory_mb = memory_mb
+        self.open_files = open_files
+        self.processes = processes
+        self.cpus = cpus
+
+    # task_name: for error messages, settings: later override earlier
+    @staticmethod
+    def from_settings(task_name, *settings):
+        values = {}
+        for setting in settings:
+            if not setting:
+                continue
+            if not isinstance(setting, dict):
+                raise ClientError("'limits' for task {} should be object with fields {}".format(
+                    task_name, FIELDS))
+            for name, value in setting.items():
+                if name not in FIELDS:
+                    raise ClientError("Unknown limit '{}' for task {}, expected one of {}".format(
+                        name, task_name, FIELDS))
+                _check_value(task_name, name, value)
+                values[name] = value
+        return Limits(**values)
+
+    def __bool__(self):
+        return any(getattr(self, name) is not None for name in FIELDS)
+
+    # [[resource, soft, hard], ...] for exec wrapper of user code
+    # cgroup: run is in leaf cgroup limiting memory and processes
+    # sandbox: run is in CI sandbox under its own user
+    def rlimits(self, cgroup=False, sandbox=False):
+        rlimits = []
+        if self.cpu_s is not None:
+            cpu_s = int(self.cpu_s)
+            rlimits.append([resource.RLIMIT_CPU, cpu_s, cpu_s + CPU_GRACE_S])
+        if self.memory_mb is not None and not cgroup:
+            memory = int(self.memory_mb) * 1024 * 1024
+            rlimits.append([resource.RLIMIT_AS, memory, memory])
+        if self.open_files is not None:
+            rlimits.append([resource.RLIMIT_NOFILE, int(self.open_files), int(self.open_files)])
+        if self.processes is not None and not cgroup and sandbox:
+            rlimits.append([resource.RLIMIT_NPROC, int(self.processes), int(self.processes)])
+        return rlimits
+
+    # Description of exceeded limit or None
+    # exit_code: subprocess convention, -N for signal N
+    # usage: cgroups.Usage of leaf cgroup or None
+    def violation(self, exit_code, timed_out, cpu_time_s, usage=None):
+        if timed_out:
+            return "wall-clock timeout of {} s exceeded".format(self.timeout_s)
+
+        # SIGXCPU is sent on soft limit only, SIGKILL may come from anywhere.
+        # Kernel accounts CPU time in ticks, so rusage may be slightly below the limit
+        if self.cpu_s is not None:
+            if exit_code == -signal.SIGXCPU:
+                return "CPU time limit of {} s exceeded".format(self.cpu_s)
+            if exit_code == -signal.SIGKILL and cpu_time_s >= int(self.cpu_s) + CPU_GRACE_S - 0.1:
+                return "CPU time limit of {} s exceeded".format(self.cpu_s)
+
+        # RLIMIT_AS leaves no trace: failed allocation ends like any other
+        # abort or crash, so its exit code is reported as is
+        if usage is not None:
+            if usage.oom_kills:
+                return "memory limit of {} MB exceeded".format(self.memory_mb)
+            if usage.pids_max_events and exit_code != 0:
+                return "process limit of {} exceeded".format(self.processes)
+
+        return None
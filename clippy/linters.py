@@ -10,8 +10,8 @@ class ClangFormat(object):
         self.binary = binary
 
     @classmethod
-    def locate(cls, names):
-        binary = helpers.locate_binary(names)
+    def locate(cls, names, toolchain=None):
+        binary = helpers.locate_tool(names, toolchain)
         if not binary:
             raise ToolNotFound(
                 "'clang-format' tool not found. See https://clang.llvm.org/docs/ClangFormat.html")
@@ -51,8 +51,8 @@ class ClangTidy(object):
         self.compiler_options = None
 
     @classmethod
-    def locate(cls, names):
-        binary = helpers.locate_binary(names)
+    def locate(cls, names, toolchain=None):
+        binary = helpers.locate_tool(names, toolchain)
         if not binary:
             raise ToolNotFound(
                 "'clang-tidy' tool not found. See http://clang.llvm.org/extra/clang-tidy/")
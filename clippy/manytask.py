@@ -66,4 +66,5 @@ def _tests():
     assert last_name == "Invanova-Petrova"
     assert user_name == "test-123"
 
-_tests()
+if __name__ == "__main__":
+    _tests()
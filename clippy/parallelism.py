@@ -0,0 +1,203 @@
+import logging
+import math
+import os
+
+from .exceptions import ClientError
+
+# Parallelism policy for builds and test runs
+#
+# Usable CPUs respect CPU affinity and cgroup (v1 / v2) CPU quota, so
+# containers are not oversubscribed. Build jobs are also bounded by
+# available memory per compile job.
+#
+# CLIPPY_JOBS or "jobs" in .clippy.json override computed number of build
+# jobs and of concurrent processes (test runs, stress runs, shards, cmake)
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+DEFAULT_MEMORY_PER_JOB_MB = 1024
+
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _affinity_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# {controller: path} from /proc/self/cgroup, "" key for cgroup v2
+def _own_cgroups():
+    cgroups = {}
+    content = _read("/proc/self/cgroup") or ""
+    for line in content.splitlines():
+        parts = line.split(":", 2)
+        if len(parts) != 3:
+            continue
+        _, controllers, path = parts
+        for controller in controllers.split(","):
+            cgroups[controller] = path
+    return cgroups
+
+
+# Own cgroup directory and its ancestors (limits are inherited)
+def _cgroup_dirs(mount, path):
+    dirs = []
+    while True:
+        dirs.append(os.path.join(mount, path.lstrip("/")))
+        if path in ("", "/"):
+            break
+        path = os.path.dirname(path)
+    return dirs
+
+
+def _cgroup_v2_quota(cgroups):
+    if "" not in cgroups:
+        return None
+
+    quotas = []
+    for dir in _cgroup_dirs(CGROUP_ROOT, cgroups[""]):
+        content = _read(os.path.join(dir, "cpu.max"))
+        if not content:
+            continue
+        quota, period = (content.split() + ["100000"])[:2]
+        if quota != "max":
+            quotas.append(int(quota) / int(period))
+    return min(quotas) if quotas else None
+
+
+def _cgroup_v1_quota(cgroups):
+    if "cpu" not in cgroups:
+        return None
+
+    for mount in [os.path.join(CGROUP_ROOT, "cpu,cpuacct"), os.path.join(CGROUP_ROOT, "cpu")]:
+        for dir in _cgroup_dirs(mount, cgroups["cpu"]):
+            quota = _read(os.path.join(dir, "cpu.cfs_quota_us"))
+            period = _read(os.path.join(dir, "cpu.cfs_period_us"))
+            if quota and period and int(quota) > 0:
+                return int(quota) / int(period)
+    return None
+
+
+# CPU quota (in CPUs) or None if not limited
+def cpu_quota():
+    cgroups = _own_cgroups()
+    try:
+        quota = _cgroup_v2_quota(cgroups)
+        if quota is None:
+            quota = _cgroup_v1_quota(cgroups)
+        return quota
+    except ValueError as error:
+        logging.debug("Cannot parse cgroup CPU quota: {}".format(error))
+        return None
+
+
+_usable_cpus = None
+
+
+def usable_cpus():
+    global _usable_cpus
+
+    if _usable_cpus is None:
+        cpus = _affinity_cpus()
+        quota = cpu_quota()
+        if quota is not None:
+            cpus = min(cpus, max(1, math.ceil(quota)))
+        _usable_cpus = cpus
+
+    return _usable_cpus
+
+
+def _meminfo_available_mb():
+    content = _read("/proc/meminfo") or ""
+    for line in content.splitlines():
+        if line.startswith("MemAvailable:"):
+            return int(line.split()[1]) // 1024
+    return None
+
+
+def _cgroup_available_mb(cgroups):
+    available = []
+
+    if "" in cgroups:
+        for dir in _cgroup_dirs(CGROUP_ROOT, cgroups[""]):
+            limit = _read(os.path.join(dir, "memory.max"))
+            usage = _read(os.path.join(dir, "memory.current"))
+            if limit and usage and limit != "max":
+                available.append((int(limit) - int(usage)) // (1024 * 1024))
+
+    if "memory" in cgroups:
+        for mount in [os.path.join(CGROUP_ROOT, "memory")]:
+            dir = os.path.join(mount, cgroups["memory"].lstrip("/"))
+            limit = _read(os.path.join(dir, "memory.limit_in_bytes"))
+            usage = _read(os.path.join(dir, "memory.usage_in_bytes"))
+            # Unlimited is reported as huge number
+            if limit and usage and int(limit) < (1 << 62):
+                available.append((int(limit) - int(usage)) // (1024 * 1024))
+
+    return min(available) if available else None
+
+
+# Available memory, MB, or None if unknown
+def available_memory_mb():
+    candidates = []
+    try:
+        candidates.append(_meminfo_available_mb())
+        candidates.append(_cgroup_available_mb(_own_cgroups()))
+    except ValueError as error:
+        logging.debug("Cannot parse available memory: {}".format(error))
+
+    candidates = [mb for mb in candidates if mb is not None]
+    return min(candidates) if candidates else None
+
+
+def _positive_int(value, source):
+    try:
+        jobs = int(value)
+    except (TypeError, ValueError):
+        jobs = 0
+    if jobs < 1:
+        raise ClientError("{} should be a positive number of jobs, got '{}'".format(source, value))
+    return jobs
+
+
+def _override(config):
+    if "CLIPPY_JOBS" in os.environ:
+        return _positive_int(os.environ["CLIPPY_JOBS"], "CLIPPY_JOBS")
+    if config is not None and config.has("jobs"):
+        return _positive_int(config.get("jobs"), "'jobs' in .clippy.json")
+    return None
+
+
+# Number of concurrent processes other than compile jobs
+def jobs(config=None):
+    override = _override(config)
+    if override is not None:
+        return override
+    return usable_cpus()
+
+
+# Number of concurrent compile jobs
+def build_jobs(config=None):
+    jobs = _override(config)
+    if jobs is not None:
+        return jobs
+
+    jobs = usable_cpus()
+
+    memory_per_job = DEFAULT_MEMORY_PER_JOB_MB
+    if config is not None:
+        memory_per_job = config.get_or("memory_per_job_mb", default=memory_per_job)
+
+    available = available_memory_mb()
+    if available is not None and memory_per_job > 0:
+        jobs = min(jobs, max(1, available // memory_per_job))
+
+    return jobs
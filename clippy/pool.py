@@ -0,0 +1,93 @@
+import concurrent.futures
+import logging
+
+from . import helpers
+from . import highlight
+from .echo import echo
+
+# Bounded pool of concurrent jobs (configuration, builds, test runs)
+#
+# Job is a function returning exit code, 0 means success
+
+
+class Job:
+    def __init__(self, name, fn, log_path=None):
+        self.name = name
+        self.fn = fn
+        self.log_path = log_path
+
+
+class JobResult:
+    def __init__(self, job, exit_code, elapsed, error=None):
+        self.job = job
+        self.exit_code = exit_code
+        self.elapsed = elapsed
+        self.error = error
+
+    @property
+    def name(self):
+        return self.job.name
+
+    @property
+    def ok(self):
+        return self.error is None and self.exit_code == 0
+
+
+def _run_job(job):
+    stop_watch = helpers.StopWatch()
+    try:
+        exit_code = job.fn()
+        return JobResult(job, exit_code, stop_watch.elapsed_seconds())
+    except BaseException as error:
+        logging.debug("Job {} failed".format(job.name), exc_info=True)
+        return JobResult(job, None, stop_watch.elapsed_seconds(), error=str(error) or type(error).__name__)
+
+
+# Returns results in the order of jobs
+def run_jobs(jobs, workers):
+    workers = max(1, min(workers, len(jobs)))
+
+    if workers == 1:
+        return [_run_job(job) for job in jobs]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_run_job, jobs))
+
+
+def log_tail(path, lines):
+    try:
+        with open(path, "rb") as f:
+            content = f.read().decode("utf-8", errors="replace")
+    except OSError:
+        return None
+    return "\n".join(content.splitlines()[-lines:])
+
+
+def print_summary(results, tail_lines=20):
+    width = max(len(result.name) for result in results)
+
+    for result in results:
+        if result.ok:
+            status = highlight.success("OK")
+        elif result.error is not None:
+            status = highlight.error("ERROR ({})".format(result.error))
+        else:
+            status = highlight.error("FAILED (exit code {})".format(result.exit_code))
+
+        line = "{}  {}  {:.2f} s".format(result.name.ljust(width), status, result.elapsed)
+        if result.job.log_path:
+            line += ", log: {}".format(highlight.path(result.job.log_path))
+        echo.echo(line)
+
+    for result in results:
+        if result.ok or not result.job.log_path:
+            continue
+        tail = log_tail(result.job.log_path, tail_lines)
+        if tail:
+            echo.blank_line()
+            echo.error("{} log tail:".format(result.name))
+            echo.write(tail)
+
+
+def failed(results):
+    return [result.name for result in results if not result.ok]
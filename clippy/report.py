@@ -0,0 +1,163 @@
+import json
+import os
+import time
+
+from .exceptions import ClientError
+
+# Structured test report: `clippy test --report junit.xml|results.json`
+#
+# One record per run unit (task, group, profile, target, args[, shard | seed]):
+# exit status, wall time, user / system CPU time and peak RSS of the test process.
+# Peak RSS survives fork and exec: max_rss_floor_kb is peak RSS of the process
+# before exec (clippy at spawn, exec wrapper of user code), peak RSS not exceeding
+# it is an upper bound only.
+# With cgroup backend (see cgroups.py) memory.peak and CPU time of all processes
+# of the run are reported too
+
+FORMATS = {
+    ".xml": "junit",
+    ".json": "json",
+}
+
+# Unit fields reported as <property> of JUnit test case
+JUNIT_PROPERTIES = [
+    "group", "exit_code", "user_cpu_s", "system_cpu_s", "max_rss_kb", "max_rss_floor_kb",
+    "cgroup_memory_peak_kb", "cgroup_cpu_s",
+]
+
+
+class UnitRecord:
+    def __init__(self, task, group, profile, target, args, result=None, shard=None, cached=False,
+                 seed=None):
+        self.task = task
+        self.group = group
+        self.profile = profile
+        self.target = target
+        self.args = list(args)
+        self.shard = shard
+        self.seed = seed
+        self.cached = cached
+        # call.RunResult or None for cached units
+        self.result = result
+
+    @property
+    def name(self):
+        name = " ".join([self.target] + self.args)
+        if self.shard is not None:
+            name += " [shard {}]".format(self.shard)
+        if self.seed is not None:
+            name += " [seed {}]".format(self.seed)
+        return name
+
+    @property
+    def passed(self):
+        return self.cached or self.result.exit_code == 0
+
+    def to_json(self):
+        data = {
+            "task": self.task,
+            "group": self.group,
+            "profile": self.profile,
+            "target": self.target,
+            "args": self.args,
+            "shard": self.shard,
+            "seed": self.seed,
+            "cached": self.cached,
+            "passed": self.passed,
+        }
+        if self.result is not None:
+            data.update({
+                "exit_code": self.result.exit_code,
+                "wall_time_s": self.result.elapsed,
+                "user_cpu_s": self.result.user_cpu_s,
+                "system_cpu_s": self.result.system_cpu_s,
+                "max_rss_kb": self.result.max_rss_kb,
+                "max_rss_floor_kb": self.result.max_rss_floor_kb,
+                "limit": self.result.limit,
+                "cgroup_memory_peak_kb": None,
+                "cgroup_cpu_s": None,
+            })
+            usage = self.result.cgroup_usage
+            if usage is not None:
+                data["cgroup_memory_peak_kb"] = usage.memory_peak_kb
+                data["cgroup_cpu_s"] = usage.cpu_user_s + usage.cpu_system_s
+        return data
+
+
+class TestReport:
+    def __init__(self, path):
+        self.path = path
+        self.format = self._format(path)
+        self.records = []
+        self.started = time.time()
+
+    @staticmethod
+    def _format(path):
+        _, ext = os.path.splitext(path)
+        if ext not in FORMATS:
+            raise ClientError("Unsupported report format '{}', expected one of {}".format(
+                path, list(FORMATS.keys())))
+        return FORMATS[ext]
+
+    def add(self, record):
+        self.records.append(record)
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+        if self.format == "junit":
+            content = self._junit()
+        else:
+            content = json.dumps({
+                "started": self.started,
+                "units": [record.to_json() for record in self.records],
+            }, indent=4)
+
+        with open(self.path, "w") as f:
+            f.write(content)
+
+    def _junit(self):
+        from xml.etree import ElementTree
+
+        suites = ElementTree.Element("testsuites")
+
+        # Test suite per task and profile
+        by_suite = {}
+        for record in self.records:
+            by_suite.setdefault("{}.{}".format(record.task, record.profile), []).append(record)
+
+        for suite_name, records in by_suite.items():
+            elapsed = sum(r.result.elapsed for r in records if r.result is not None)
+            suite = ElementTree.SubElement(suites, "testsuite", {
+                "name": suite_name,
+                "tests": str(len(records)),
+                "failures": str(len([r for r in records if not r.passed])),
+                "skipped": str(len([r for r in records if r.cached])),
+                "time": "{:.3f}".format(elapsed),
+            })
+
+            for record in records:
+                case = ElementTree.SubElement(suite, "testcase", {
+                    "classname": suite_name,
+                    "name": record.name,
+                    "time": "{:.3f}".format(record.result.elapsed if record.result else 0.0),
+                })
+
+                if record.cached:
+                    ElementTree.SubElement(case, "skipped", {"message": "cached pass"})
+                    continue
+
+                if not record.passed:
+                    message = "exit code {}".format(record.result.exit_code)
+                    if record.result.limit:
+                        message += ", " + record.result.limit
+                    ElementTree.SubElement(case, "failure", {"message": message})
+
+                properties = ElementTree.SubElement(case, "properties")
+                data = record.to_json()
+                for name in JUNIT_PROPERTIES:
+                    ElementTree.SubElement(properties, "property", {
+                        "name": name, "value": str(data[name])})
+
+        return ElementTree.tostring(suites, encoding="unicode")
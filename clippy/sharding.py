@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+
+from .exceptions import ClientError
+from . import sandbox
+
+# Sharding of test binaries into concurrent processes ("sharding" in task.json)
+#
+# {
+#   "targets": ["unit_test"],   - sharded targets, default: all
+#   "shards": 4 | "auto",       - number of processes, "auto": see parallelism.jobs
+#   "protocol": "gtest" | "list",
+#   "list_args": [...],         - list protocol: prints test names, one per line
+#   "filter_args": [...],       - list protocol: runs subset, "{tests}" is replaced
+#   "separator": ","            - with names joined by separator
+# }
+#
+# gtest protocol: GTEST_TOTAL_SHARDS / GTEST_SHARD_INDEX environment variables,
+# binary touches GTEST_SHARD_STATUS_FILE if it supports sharding. Status files
+# are created in temporary directory writable by user code: in CI sandbox
+# tests run as separate user, who cannot write to build directory
+
+PROTOCOLS = ["gtest", "list"]
+
+TESTS_PLACEHOLDER = "{tests}"
+
+
+def _make_status_dir():
+    path = tempfile.mkdtemp(prefix="clippy-shard-status-")
+    user = sandbox.sandbox_user() if "CLIPPY_CI" in os.environ else None
+    if user is not None:
+        os.chown(path, *user)
+    return path
+
+
+class Shard:
+    def __init__(self, index, total, args, env, status_file=None):
+        self.index = index
+        self.total = total
+        self.args = args
+        self.env = env
+        self.status_file = status_file
+
+    @property
+    def name(self):
+        return "[{}/{}]".format(self.index + 1, self.total)
+
+
+class Sharding:
+    def __init__(self, conf):
+        if not isinstance(conf, dict):
+            raise ClientError("'sharding' in task.json should be object")
+
+        self.targets = conf.get("targets")
+        self.count = conf.get("shards", "auto")
+        self.protocol = conf.get("protocol", "gtest")
+        self.list_args = conf.get("list_args", [])
+        self.filter_args = conf.get("filter_args", [])
+        self.separator = conf.get("separator", ",")
+
+        if self.protocol not in PROTOCOLS:
+            raise ClientError("Unsupported sharding protocol '{}', expected one of {}".format(
+                self.protocol, PROTOCOLS))
+
+        if self.protocol == "list" and (
+                not self.list_args or not any(TESTS_PLACEHOLDER in arg for arg in self.filter_args)):
+            raise ClientError(
+                "Sharding protocol 'list' requires 'list_args' and 'filter_args' with '{}'".format(
+                    TESTS_PLACEHOLDER))
+
+    def applies_to(self, target_name):
+        return self.targets is None or target_name in self.targets
+
+    # jobs: number of concurrent processes, shard count for "auto"
+    def shard_count(self, jobs):
+        if self.count == "auto":
+            return jobs
+        return int(self.count)
+
+    # count: see shard_count
+    # list_tests: function (args) -> output of binary with args
+    def shards(self, count, args, list_tests):
+        if self.protocol == "gtest":
+            status_dir = _make_status_dir()
+            return [self._gtest_shard(index, count, args, status_dir) for index in range(count)]
+
+        names = [line.strip() for line in list_tests(self.list_args).splitlines() if line.strip()]
+        count = max(1, min(count, len(names)))
+        return [
+            Shard(index, count, args + self._filter(names[index::count]), {})
+            for index in range(count)
+        ]
+
+    @staticmethod
+    def _gtest_shard(index, count, args, status_dir):
+        status_file = os.path.join(status_dir, "shard-{}".format(index))
+
+        env = {
+            "GTEST_TOTAL_SHARDS": str(count),
+            "GTEST_SHARD_INDEX": str(index),
+            "GTEST_SHARD_STATUS_FILE": status_file,
+        }
+        return Shard(index, count, args, env, status_file)
+
+    def _filter(self, names):
+        tests = self.separator.join(names)
+        return [arg.replace(TESTS_PLACEHOLDER, tests) for arg in self.filter_args]
+
+
+# False if gtest protocol was used, but binary ignored it
+def sharding_supported(shards):
+    status_files = [shard.status_file for shard in shards if shard.status_file]
+    if not status_files:
+        return True
+    return any(os.path.exists(path) for path in status_files)
+
+
+def remove_status_files(shards):
+    for status_dir in set(os.path.dirname(shard.status_file) for shard in shards if shard.status_file):
+        shutil.rmtree(status_dir, ignore_errors=True)
@@ -4,16 +4,13 @@ import re
 import shutil
 import subprocess
 
-import click
-import gitlab
-import git
-
 from . import helpers
 from . import highlight
 from . import manytask
 from .echo import echo
 from .exceptions import ClientError
 from .config import Config
+from .trace import tracer
 
 
 CONFIG_TEMPLATE = {
@@ -90,8 +87,7 @@ class Solutions(object):
         return template
 
     @staticmethod
-    def open(tasks_repo, config):
-        tasks_repo_dir = tasks_repo.working_tree_dir
+    def open(tasks_repo_dir, config):
         task_ci_config = os.path.join(tasks_repo_dir, config.get("task_ci_config"))
 
         link_path = os.path.join(tasks_repo_dir, "client/.solutions")
@@ -133,18 +129,21 @@ class Solutions(object):
     @property
     def remote(self):
         self._check_attached()
+        import git
         git_repo = git.Repo(self.repo_dir)
         return git_repo.remotes.origin.url
 
     def _git(self, cmd, **kwargs):
         self._check_attached()
         echo.echo("Running git: {}".format(cmd))
-        subprocess.check_call(["git"] + cmd, **kwargs)
+        with tracer.process(["git"] + cmd):
+            subprocess.check_call(["git"] + cmd, **kwargs)
 
     def _git_output(self, cmd, **kwargs):
         self._check_attached()
         echo.echo("Running git: {}".format(cmd))
-        return subprocess.check_output(["git"] + cmd, **kwargs)
+        with tracer.process(["git"] + cmd):
+            return subprocess.check_output(["git"] + cmd, **kwargs)
 
     @staticmethod
     def _task_branch_name(task):
@@ -289,6 +288,8 @@ class Solutions(object):
 
         # Create Gitlab client
 
+        import gitlab
+
         token = self.config.get("gitlab.token")
         gitlab_client = gitlab.Gitlab(
             "https://gitlab.com", private_token=token)
@@ -364,6 +365,7 @@ class Solutions(object):
                 "Cannot find task directory '{}' in '{}'".format(
                     task_dir, git_target))
 
+        import click
         if force or click.confirm(
                 "Apply solutions to task {}?".format(task.fullname)):
             echo.echo("Applying solution from solutions repo...")
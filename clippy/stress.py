@@ -0,0 +1,164 @@
+import os
+import random
+import threading
+
+from . import highlight
+from . import parallelism
+from . import pool
+from .call import call_to_log_user_code, user_code_env
+from .echo import echo
+from .exceptions import ClientError
+from .trace import tracer
+
+# Repeat / stress mode: `clippy test --repeat N`, `clippy target --repeat N`
+#
+# Built binary runs N times on J workers (default: usable CPUs).
+# Run i gets seed = base seed + i in CLIPPY_SEED environment variable and,
+# with seed_arg template (e.g. "--seed={seed}"), as an extra argument.
+#
+# Logs of passed runs are removed, failed runs keep seed and output in
+# build/logs/stress-<profile>-<target>-<seed>.log. With stop_on_failure runs
+# that have not started yet are skipped after the first failure.
+
+SEED_ENV = "CLIPPY_SEED"
+
+SEED_PLACEHOLDER = "{seed}"
+
+# Failed runs listed in summary
+MAX_LISTED_FAILURES = 10
+
+
+class StressOptions:
+    # config: .clippy.json for default number of jobs, see parallelism.jobs
+    def __init__(self, runs, jobs=None, seed=None, seed_arg=None, stop_on_failure=False, config=None):
+        if runs < 1:
+            raise ClientError("--repeat should be positive, got {}".format(runs))
+        if seed_arg is not None and SEED_PLACEHOLDER not in seed_arg:
+            raise ClientError("--seed-arg should contain '{}', got '{}'".format(SEED_PLACEHOLDER, seed_arg))
+
+        self.runs = runs
+        self.jobs = jobs or parallelism.jobs(config)
+        self.seed = seed if seed is not None else random.randrange(1 << 31)
+        self.seed_arg = seed_arg
+        self.stop_on_failure = stop_on_failure
+
+    def seed_args(self, seed):
+        if self.seed_arg is None:
+            return []
+        return [self.seed_arg.replace(SEED_PLACEHOLDER, str(seed))]
+
+
+class StressRun:
+    def __init__(self, seed, log_path):
+        self.seed = seed
+        self.log_path = log_path
+        # call.RunResult, None if run was skipped
+        self.result = None
+
+    @property
+    def failed(self):
+        return self.result is not None and self.result.exit_code != 0
+
+
+def _percentile(sorted_values, q):
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+class StressResult:
+    def __init__(self, name, runs):
+        self.name = name
+        self.runs = runs
+
+    @property
+    def completed(self):
+        return [run for run in self.runs if run.result is not None]
+
+    @property
+    def failed(self):
+        return [run for run in self.runs if run.failed]
+
+    @property
+    def failure_rate(self):
+        return len(self.failed) / max(1, len(self.completed))
+
+    def print_summary(self, tail_lines=20):
+        completed = self.completed
+        failed = self.failed
+        skipped = len(self.runs) - len(completed)
+
+        echo.echo("{}: {} of {} run(s) failed ({:.2%}){}".format(
+            highlight.smth(self.name), len(failed), len(completed), self.failure_rate,
+            ", {} skipped after failure".format(skipped) if skipped else ""))
+
+        if completed:
+            times = sorted(run.result.elapsed for run in completed)
+            echo.echo(
+                "Time: min {:.3f} s, median {:.3f} s, p90 {:.3f} s, p99 {:.3f} s, max {:.3f} s".format(
+                    times[0], _percentile(times, 0.5), _percentile(times, 0.9), _percentile(times, 0.99),
+                    times[-1]))
+
+        for run in failed[:MAX_LISTED_FAILURES]:
+            line = "seed {}: exit code {}".format(run.seed, run.result.exit_code)
+            if run.result.limit:
+                line += ", " + run.result.limit
+            echo.echo(highlight.error(line) + ", log: {}".format(highlight.path(run.log_path)))
+        if len(failed) > MAX_LISTED_FAILURES:
+            echo.echo("... and {} more".format(len(failed) - MAX_LISTED_FAILURES))
+
+        if failed:
+            tail = pool.log_tail(failed[0].log_path, tail_lines)
+            if tail:
+                echo.blank_line()
+                echo.error("Seed {} log tail:".format(failed[0].seed))
+                echo.write(tail)
+
+
+# Runs cmd options.runs times, returns StressResult
+# log_prefix: path prefix of run logs
+# record: function (call.RunResult, seed) or None
+def run(name, cmd, options, log_prefix, limits=None, record=None, **kwargs):
+    stopped = threading.Event()
+
+    def job(stress_run):
+        def fn():
+            if stopped.is_set():
+                return 0
+
+            with tracer.span("run", target=name, seed=stress_run.seed):
+                result = call_to_log_user_code(
+                    cmd + options.seed_args(stress_run.seed), stress_run.log_path, limits=limits,
+                    env=user_code_env({SEED_ENV: str(stress_run.seed)}), **kwargs)
+            stress_run.result = result
+            if record is not None:
+                record(result, stress_run.seed)
+
+            if result.exit_code == 0:
+                os.remove(stress_run.log_path)
+            elif options.stop_on_failure:
+                stopped.set()
+            return result.exit_code
+
+        return pool.Job("{} [seed {}]".format(name, stress_run.seed), fn, stress_run.log_path)
+
+    runs = [
+        StressRun(seed, "{}-{}.log".format(log_prefix, seed))
+        for seed in range(options.seed, options.seed + options.runs)
+    ]
+
+    echo.echo("Run {} {} time(s) in {} worker(s), seeds {}..{}".format(
+        highlight.smth(name), options.runs, min(options.jobs, options.runs),
+        options.seed, options.seed + options.runs - 1))
+
+    pool.run_jobs([job(stress_run) for stress_run in runs], options.jobs)
+
+    result = StressResult(name, runs)
+    result.print_summary()
+    return result
+
+
+def check(result):
+    if result.failed:
+        raise ClientError("{} failed {} of {} run(s), seeds: {}".format(
+            result.name, len(result.failed), len(result.completed),
+            [run.seed for run in result.failed[:MAX_LISTED_FAILURES]]))
@@ -1,10 +1,13 @@
+import json
 import logging
 import os
 import subprocess
 
 from .censor import CensorRule
 from .exceptions import ClientError
+from .sharding import Sharding
 from . import helpers
+from .trace import tracer
 
 
 parent = os.path.dirname
@@ -80,6 +83,19 @@ class TaskConfig(object):
             rules.append(CensorRule(rule_json))
         return rules
 
+    # Resource limits for user code (dict), see limits.py
+    @property
+    def limits(self):
+        return self._attr_value("limits", required=False)
+
+    # Sharding of test binaries or None, see sharding.py
+    @property
+    def sharding(self):
+        conf = self._attr_value("sharding", required=False)
+        if not conf:
+            return None
+        return Sharding(conf)
+
     @property
     def test_perf(self):
         return self._attr_value("test_perf", required=False)
@@ -110,11 +126,13 @@ class TaskConfig(object):
 # --------------------------------------------------------------------
 
 class Task(object):
-    def __init__(self, dir, topic, name, conf):
+    def __init__(self, dir, topic, name, conf, files=None):
         self.dir = dir
         self.topic = topic
         self.name = name
         self.conf = conf
+        # Resolved lint / solution files, see TaskIndex
+        self.files = files
 
     @property
     def fullname(self):
@@ -144,25 +162,148 @@ class Task(object):
 
     @property
     def all_files_to_lint(self):
+        if self.files is not None:
+            return self.files["lint"]
         return helpers.cpp_files(
             helpers.all_files(self.dir, self.conf.lint_files))
 
     @property
     def all_solution_files(self):
+        if self.files is not None:
+            return self.files["solution"]
         return helpers.cpp_files(
             helpers.all_files(self.dir, self.conf.solution_files))
 
 # --------------------------------------------------------------------
 
+# Persistent index of tasks
+#
+# Entry for a task holds parsed task.json and resolved lint / solution files.
+# Entry is invalidated by task.json mtime, resolved files - by mtimes
+# of the directories they were collected from
+
+class TaskIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.dirty = False
+        self._load()
+
+    def _load(self):
+        self.entries = {}
+
+        if self.path is None or not os.path.exists(self.path):
+            return
+
+        try:
+            self.entries = helpers.load_json(self.path)["tasks"]
+        except (OSError, ValueError, KeyError, TypeError):
+            logging.debug("Ignore broken task index: {}".format(self.path))
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump({"tasks": self.entries}, f)
+            os.replace(temp_path, self.path)
+            self.dirty = False
+        except OSError as error:
+            logging.debug("Cannot save task index: {}".format(error))
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    # Directories that resolved files were collected from
+    @staticmethod
+    def _dirs_stamp(task_dir, names):
+        stamp = {}
+        for name in names:
+            path = os.path.join(task_dir, name)
+            if os.path.isdir(path):
+                for dir_path, _, _ in os.walk(path):
+                    stamp[dir_path] = TaskIndex._mtime(dir_path)
+            else:
+                dir_path = os.path.dirname(path)
+                stamp[dir_path] = TaskIndex._mtime(dir_path)
+        return stamp
+
+    def _stamp_valid(self, stamp):
+        for path, mtime in stamp.items():
+            if self._mtime(path) != mtime:
+                return False
+        return True
+
+    @staticmethod
+    def _resolve_files(task_dir, conf):
+        lint_names = conf.lint_files or []
+        # Theory tasks have no solution files
+        solution_names = conf.solution_files if conf._has_attr("submit_files") else []
+
+        # task.json lists the files, so it is a part of the stamp too
+        stamp = TaskIndex._dirs_stamp(task_dir, lint_names + solution_names)
+        conf_path = os.path.join(task_dir, "task.json")
+        stamp[conf_path] = TaskIndex._mtime(conf_path)
+
+        return {
+            "lint": helpers.cpp_files(helpers.all_files(task_dir, lint_names)),
+            "solution": helpers.cpp_files(helpers.all_files(task_dir, solution_names)),
+            "stamp": stamp,
+        }
+
+    def load_task(self, dir, topic, name):
+        conf_path = os.path.join(dir, "task.json")
+        conf_mtime = self._mtime(conf_path)
+
+        key = "{}/{}".format(topic, name)
+        entry = self.entries.get(key)
+
+        if entry and entry["dir"] == dir and entry["conf_mtime"] == conf_mtime:
+            conf = TaskConfig(entry["conf"])
+        else:
+            conf = TaskConfig.load_from(conf_path)
+            entry = {
+                "dir": dir,
+                "conf_mtime": conf_mtime,
+                "conf": conf.json_conf,
+                "files": None,
+            }
+            self.entries[key] = entry
+            self.dirty = True
+
+        files = entry["files"]
+        # Stamps written before task.json was stamped are resolved again
+        if files is None or conf_path not in files["stamp"] or not self._stamp_valid(files["stamp"]):
+            files = self._resolve_files(dir, conf)
+            entry["files"] = files
+            self.dirty = True
+
+        return Task(dir, topic, name, conf, files)
+
+    def forget_missing(self, keys):
+        for key in list(self.entries.keys()):
+            if key not in keys:
+                del self.entries[key]
+                self.dirty = True
+
+# --------------------------------------------------------------------
+
 # Tasks "repository" (tasks directory in course repo)
 
 class Tasks(object):
-    def __init__(self, git_repo):
-        self.root_dir = self.tasks_root_directory(git_repo)
+    def __init__(self, repo_dir, index_path=None):
+        self.root_dir = self.tasks_root_directory(repo_dir)
+        self.index = TaskIndex(index_path)
 
     @staticmethod
-    def tasks_root_directory(git_repo):
-        return os.path.join(git_repo.working_tree_dir, 'tasks')
+    def tasks_root_directory(repo_dir):
+        return os.path.join(repo_dir, 'tasks')
 
     def _find_task_dir(self, start_dir):
         return helpers.climb("task.json", start_dir, steps=4)
@@ -184,12 +325,53 @@ class Tasks(object):
 
         # definitely task directory
 
-        conf = TaskConfig.load_from(task_conf_path)
-
         topic_name = os.path.basename(parent(dir))
         task_name = os.path.basename(dir)
 
-        return Task(dir, topic_name, task_name, conf)
+        with tracer.span("task config", task="{}/{}".format(topic_name, task_name)):
+            task = self.index.load_task(dir, topic_name, task_name)
+            self.index.save()
+        return task
 
     def current_dir_task(self):
         return self.get_dir_task(os.getcwd())
+
+    @staticmethod
+    def _subdirectories(dir):
+        try:
+            return sorted(helpers.get_immediate_subdirectories(dir))
+        except OSError as error:
+            raise ClientError("Cannot list tasks in {}: {}".format(dir, error.strerror))
+
+    # Single scan of tasks directory, broken tasks are skipped
+    def list(self, topic=None):
+        if not os.path.isdir(self.root_dir):
+            raise ClientError("Tasks directory not found: {}".format(self.root_dir))
+        if topic and not os.path.isdir(os.path.join(self.root_dir, topic)):
+            raise ClientError("Topic '{}' not found: {}".format(topic, os.path.join(self.root_dir, topic)))
+
+        tasks = []
+        keys = set()
+
+        for topic_dir in self._subdirectories(self.root_dir):
+            topic_name = os.path.basename(topic_dir)
+
+            for task_dir in self._subdirectories(topic_dir):
+                if not os.path.exists(os.path.join(task_dir, "task.json")):
+                    continue
+
+                task_name = os.path.basename(task_dir)
+                keys.add("{}/{}".format(topic_name, task_name))
+
+                if topic and topic_name != topic:
+                    continue
+
+                try:
+                    tasks.append(self.index.load_task(task_dir, topic_name, task_name))
+                except ClientError as error:
+                    logging.warning(str(error))
+
+        self.index.forget_missing(keys)
+        self.index.save()
+
+        return tasks
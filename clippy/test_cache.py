@@ -0,0 +1,103 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from . import helpers
+
+
+# Cache of passed test runs
+#
+# Key: sha256 of built test binary + arguments + profile.
+# Run is skipped while key hits, i.e. binary was not changed by rebuild.
+# Binary digests are reused while binary (inode, size, mtime) has not changed
+
+# Entries older than that are dropped on save
+MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+
+
+class TestResultCache:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dirty = False
+        self._load()
+
+    def _load(self):
+        self.results = {}
+        self.digests = {}
+
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            data = helpers.load_json(self.path)
+            self.results = data["results"]
+            self.digests = data["digests"]
+        except (OSError, ValueError, KeyError, TypeError):
+            logging.debug("Ignore broken test result cache: {}".format(self.path))
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        now = time.time()
+        with self.lock:
+            results = {
+                key: result for key, result in self.results.items()
+                if now - result["time"] < MAX_AGE_SECONDS
+            }
+            digests = {
+                path: entry for path, entry in self.digests.items()
+                if os.path.exists(path)
+            }
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(temp_path, "w") as f:
+                json.dump({"results": results, "digests": digests}, f)
+            os.replace(temp_path, self.path)
+            self.dirty = False
+        except OSError as error:
+            logging.debug("Cannot save test result cache: {}".format(error))
+
+    @staticmethod
+    def _binary_stamp(binary):
+        st = os.stat(binary)
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def _digest(self, binary):
+        stamp = self._binary_stamp(binary)
+
+        with self.lock:
+            entry = self.digests.get(binary)
+        if entry is not None and entry["stamp"] == stamp:
+            return entry["sha256"]
+
+        digest = hashlib.sha256()
+        with open(binary, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()
+
+        with self.lock:
+            self.digests[binary] = {"stamp": stamp, "sha256": sha256}
+            self.dirty = True
+        return sha256
+
+    def key(self, binary, args, profile):
+        data = [self._digest(binary), list(args), profile]
+        return hashlib.sha256(json.dumps(data).encode("utf-8")).hexdigest()
+
+    # Returns cached result {"time", "elapsed"} or None
+    def lookup(self, key):
+        with self.lock:
+            return self.results.get(key)
+
+    def record_pass(self, key, elapsed):
+        with self.lock:
+            self.results[key] = {"time": time.time(), "elapsed": elapsed}
+            self.dirty = True
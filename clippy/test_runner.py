@@ -1,16 +1,30 @@
-from .call import check_call, check_call_user_code
+from .call import (check_call_user_code, check_output_user_code, call_user_code,
+                   call_to_log_user_code, user_code_env)
 from .echo import echo
+from .exceptions import ClientError
+from .limits import Limits
+from .report import UnitRecord
 from .tasks import TaskConfig
 from . import highlight
 from . import helpers
+from . import parallelism
+from . import pool
+from . import sharding
+from . import stress
+from .trace import tracer
 
 import os
 import datetime
+import subprocess
+import sys
 
 class TaskTargets:
-    def __init__(self, task, build):
+    # stress: stress.StressOptions for repeated runs or None
+    def __init__(self, task, build, limits=None, stress=None):
         self.task = task
         self.build = build
+        self.limits = limits
+        self.stress = stress
 
     def _binary(self, build_dir, target):
         return os.path.join(build_dir, "tasks", self.task.fullname, "bin", target)
@@ -21,10 +35,11 @@ class TaskTargets:
 
         target = self.task._target(target_name)
 
-        with self.build.profile(profile) as build_dir:
-            check_call(helpers.make_target_command(target))
+        build_dir = self.build.profile_dir(profile)
+        with tracer.span("build", target=target, profile=profile):
+            self.build.build_targets(build_dir, [target])
 
-            return self._binary(build_dir, target)
+        return self._binary(build_dir, target)
 
     def run(self, target_name, profile, args):
         #echo.echo("Build and run task target {} in profile {}".format(
@@ -38,7 +53,17 @@ class TaskTargets:
                 highlight.smth(target_name), args))
 
             cmd = [binary] + args
-            check_call_user_code(cmd)
+            if self.stress is not None:
+                log_prefix = os.path.join(
+                    self.build.path, "logs", "stress-{}-{}".format(profile, self.task._target(target_name)))
+                result = stress.run(
+                    target_name, cmd, self.stress, log_prefix, limits=self.limits,
+                    cwd=self.build.profile_dir(profile))
+                stress.check(result)
+                return
+
+            with tracer.span("run", target=target_name, profile=profile):
+                check_call_user_code(cmd, limits=self.limits, cwd=self.build.profile_dir(profile))
 
     def debug(self, target_name, profile, args):
         # 1) Build
@@ -53,59 +78,364 @@ class TaskTargets:
 
 
 class TestRunner:
-    def __init__(self, task, build):
+    # cache: TestResultCache or None, use_cache: skip runs that passed before
+    # report: report.TestReport or None
+    # limits: "limits" settings from .clippy.json, overridden by task config
+    # stress: stress.StressOptions, each target runs repeatedly, bypassing cache
+    # impact: impact.ImpactIndex, units with unchanged inputs since green run are not built and run
+    def __init__(self, task, build, cache=None, use_cache=True, report=None, limits=None, stress=None,
+                 impact=None):
         self.task = task
         self.build = build
+        self.cache = cache
+        self.use_cache = use_cache
+        self.report = report
+        self.limits_settings = limits
+        self.limits = None
+        self.sharding = None
+        self.stress = stress
+        self.impact = impact
+        self.impact_profiles = set()
 
     def _binary(self, build_dir, target):
         return os.path.join(build_dir, "tasks", self.task.fullname, "bin", target)
 
-    def _run_targets(self, task_targets, args, build_dir):
+    def _cache_key(self, binary, args, profile_name):
+        if self.cache is None or self.stress is not None:
+            return None
+        try:
+            return self.cache.key(binary, args, profile_name)
+        except OSError:
+            return None  # not built, run reports error
+
+    def _cached(self, key):
+        return self.use_cache and key is not None and self.cache.lookup(key) is not None
+
+    def _record_pass(self, key, elapsed):
+        if key is not None:
+            self.cache.record_pass(key, elapsed)
+
+    # Change-based selection, see impact.py
+
+    def _fingerprint(self, build_dir, profile_name, target):
+        if self.impact is None:
+            return None
+        if profile_name not in self.impact_profiles:
+            # Build scripts configured before CMake file API query are stale
+            self.build.cmake_profile(profile_name)
+            self.impact_profiles.add(profile_name)
+        return self.impact.fingerprint(build_dir, target, self.build.cmake_stamp(profile_name))
+
+    def _impact_key(self, profile_name, name, args):
+        return self.impact.unit_key(self.task.fullname, profile_name, name, args)
+
+    def _unaffected(self, group_index, profile_name, name, args):
+        if self.impact is None:
+            return False
+
+        target = self.task._target(name)
+        fingerprint = self._fingerprint(self.build.profile_dir(profile_name), profile_name, target)
+        if not self.impact.unchanged(self._impact_key(profile_name, name, args), fingerprint):
+            return False
+
+        self._recorder(group_index, profile_name, name, args)(None, cached=True)
+        return True
+
+    def _record_green(self, profile_name, name, args, fingerprint):
+        if self.impact is not None:
+            self.impact.record_green(self._impact_key(profile_name, name, args), fingerprint)
+
+    # Returns function (call.RunResult, shard=None) adding unit record to report
+    def _recorder(self, group_index, profile_name, target_name, args):
+        def record(result, shard=None, cached=False, seed=None):
+            if self.report is not None:
+                self.report.add(UnitRecord(
+                    self.task.fullname, group_index, profile_name, target_name, args,
+                    result=result, shard=shard, cached=cached, seed=seed))
+        return record
+
+    def _run_targets(self, group_index, task_targets, args, build_dir, profile_name):
+        unaffected = [
+            name for name in task_targets if self._unaffected(group_index, profile_name, name, args)]
+        for name in unaffected:
+            echo.echo("Target {}: {}".format(
+                highlight.smth(name), highlight.success("unaffected, inputs not changed since green run")))
+
+        task_targets = [name for name in task_targets if name not in unaffected]
+        if not task_targets:
+            return
+
         make_targets = [self.task._target(name) for name in task_targets]
 
-        for name, target in zip(task_targets, make_targets):
-            with echo.timed("Target {}".format(highlight.smth(name))):
-                # Build
-                check_call(helpers.make_target_command(target))
+        # Build all targets with one build tool invocation:
+        # dependency graph is scanned once, independent targets are built in parallel
+        with echo.timed("Build {}".format(highlight.smth(task_targets))):
+            with tracer.span("build", targets=make_targets):
+                self.build.build_targets(build_dir, list(dict.fromkeys(make_targets)))
 
-                # Run
+        for name, target in zip(task_targets, make_targets):
+            binary = self._binary(build_dir, target)
+            key = self._cache_key(binary, args, profile_name)
+            record = self._recorder(group_index, profile_name, name, args)
+            fingerprint = self._fingerprint(build_dir, profile_name, target)
 
-                binary = self._binary(build_dir, target)
+            if self._cached(key):
+                record(None, cached=True)
+                self._record_green(profile_name, name, args, fingerprint)
+                echo.echo("Target {}: {}".format(
+                    highlight.smth(name), highlight.success("cached pass, not changed since last run")))
+                continue
 
+            with echo.timed("Target {}".format(highlight.smth(name))):
                 if args:
                     echo.echo("Run target {} with arguments {}".format(
                         highlight.smth(target), highlight.smth(args)))
                 else:
                     echo.echo("Run target {}".format(highlight.smth(target)))
 
-                check_call_user_code([binary] + args)
+                stop_watch = helpers.StopWatch()
+                log_prefix = "test-{}-{}".format(profile_name, target)
+                if self.stress is not None:
+                    self._run_stress(name, binary, args, build_dir, profile_name, target, record)
+                    continue
+
+                shards = self._shards(name, binary, args, build_dir)
+                if shards:
+                    self._run_shards(name, binary, shards, build_dir, log_prefix, record)
+                else:
+                    with tracer.span("run", target=target, args=args):
+                        result = call_user_code([binary] + args, limits=self.limits, cwd=build_dir)
+                    record(result)
+                    if result.exit_code != 0:
+                        sys.exit(1)
+                self._record_pass(key, stop_watch.elapsed_seconds())
+                self._record_green(profile_name, name, args, fingerprint)
+
+    # Repeated runs, see stress.py
+
+    def _run_stress(self, name, binary, args, build_dir, profile_name, target, record):
+        log_prefix = os.path.join(self.build.path, "logs", "stress-{}-{}".format(profile_name, target))
+        result = stress.run(
+            name, [binary] + args, self.stress, log_prefix, limits=self.limits,
+            record=lambda run_result, seed: record(run_result, seed=seed), cwd=build_dir)
+        stress.check(result)
+
+    # Sharding
+
+    # Returns list of Shard or None if target is not sharded
+    def _shards(self, name, binary, args, build_dir):
+        if self.sharding is None or not self.sharding.applies_to(name):
+            return None
+        count = self.sharding.shard_count(parallelism.jobs(self.build.config))
+        if count < 2:
+            return None
+
+        def list_tests(list_args):
+            try:
+                return check_output_user_code(
+                    [binary] + list_args, limits=self.limits, cwd=build_dir).decode("utf-8")
+            except subprocess.CalledProcessError as error:
+                raise ClientError("Cannot list tests of target {}: {}".format(name, error))
+
+        return self.sharding.shards(count, args, list_tests)
+
+    # record: function (call.RunResult), see _recorder
+    def _run_job(self, job_name, cmd, env, log_path, build_dir, record, **span_args):
+        def run():
+            with tracer.span("run", **span_args):
+                result = call_to_log_user_code(
+                    cmd, log_path, limits=self.limits, cwd=build_dir, env=user_code_env(env))
+            record(result)
+            return result.exit_code
 
-    def _run_tests_with_profile(self, targets, args, profile_name):
-        with self.build.profile(profile_name) as build_dir:
+        return pool.Job(job_name, run, log_path)
+
+    def _shard_jobs(self, name, binary, shards, build_dir, log_prefix, record):
+        def shard_record(shard):
+            return lambda result: record(result, shard=shard.index)
+
+        return [
+            self._run_job(
+                "{} {}".format(name, shard.name),
+                [binary] + shard.args,
+                shard.env,
+                os.path.join(self.build.path, "logs", "{}-shard-{}.log".format(log_prefix, shard.index)),
+                build_dir,
+                shard_record(shard),
+                target=name, shard=shard.index, args=shard.args)
+            for shard in shards
+        ]
+
+    @staticmethod
+    def _finish_shards(name, shards):
+        if not sharding.sharding_supported(shards):
+            echo.note("Target {} ignores GTEST_TOTAL_SHARDS: every shard ran all tests".format(name))
+        sharding.remove_status_files(shards)
+
+    def _run_shards(self, name, binary, shards, build_dir, log_prefix, record):
+        echo.echo("Run target {} in {} shards".format(highlight.smth(name), len(shards)))
+
+        jobs = self._shard_jobs(name, binary, shards, build_dir, log_prefix, record)
+        results = pool.run_jobs(jobs, len(shards))
+        pool.print_summary(results)
+        self._finish_shards(name, shards)
+
+        failed = pool.failed(results)
+        if failed:
+            raise ClientError("Target {} failed in shards: {}".format(name, failed))
+
+    def _run_tests_with_profile(self, group_index, targets, args, profile_name):
+        build_dir = self.build.profile_dir(profile_name)
+
+        with tracer.span("test profile", profile=profile_name):
             echo.echo("Test targets {} in profile {}".format(
                 highlight.smth(targets), highlight.smth(profile_name)))
 
-            self._run_targets(targets, args, build_dir)
+            self._run_targets(group_index, targets, args, build_dir, profile_name)
 
-    def _run_test_group(self, group):
+    def _run_test_group(self, group_index, group):
         for profile in group.profiles:
-            self._run_tests_with_profile(group.targets, group.args, profile)
+            self._run_tests_with_profile(group_index, group.targets, group.args, profile)
+
+    # --parallel: (group, profile, target) units on worker pool
+
+    # units: [(group index, group, profile, target name)]
+    def _build_all(self, units):
+        # Profile -> targets of all units, profiles are built concurrently
+        by_profile = {}
+        for _, _, profile, name in units:
+            targets = by_profile.setdefault(profile, [])
+            target = self.task._target(name)
+            if target not in targets:
+                targets.append(target)
+
+        self.build.build_concurrently(
+            [(self.build.find_profile(profile), targets) for profile, targets in by_profile.items()],
+            "test-build")
+
+    @staticmethod
+    def _unit_name(group, profile, name):
+        return " ".join([profile, name] + group.args)
+
+    # Returns ([jobs], shards or None, cache key)
+    def _unit_jobs(self, index, group_index, group, profile, name):
+        build_dir = self.build.profile_dir(profile)
+        target = self.task._target(name)
+        binary = self._binary(build_dir, target)
+        key = self._cache_key(binary, group.args, profile)
+        unit_name = self._unit_name(group, profile, name)
+        log_prefix = "test-{}-{}-{}".format(index, profile, target)
+        record = self._recorder(group_index, profile, name, group.args)
+
+        if self._cached(key):
+            record(None, cached=True)
+            return [], None, key
+
+        shards = self._shards(name, binary, group.args, build_dir)
+        if shards:
+            jobs = self._shard_jobs(unit_name, binary, shards, build_dir, log_prefix, record)
+            return jobs, shards, key
+
+        job = self._run_job(
+            unit_name, [binary] + group.args, {}, os.path.join(self.build.path, "logs", log_prefix + ".log"),
+            build_dir, record, target=target, profile=profile, args=group.args)
+        return [job], None, key
+
+    def _run_parallel(self, groups):
+        units = [
+            (group_index, group, profile, name)
+            for group_index, group in enumerate(groups)
+            for profile in group.profiles for name in group.targets
+        ]
+
+        unaffected = [
+            self._unit_name(group, profile, name) for group_index, group, profile, name in units
+            if self._unaffected(group_index, profile, name, group.args)]
+        units = [unit for unit in units if self._unit_name(*unit[1:]) not in unaffected]
+
+        if units:
+            with echo.timed("Build"), tracer.span("build"):
+                self._build_all(units)
+
+        jobs = []
+        cached = []
+        unit_jobs = []  # (unit, jobs, shards, cache key, fingerprint)
+        for index, unit in enumerate(units):
+            _, group, profile, name = unit
+            unit_name = self._unit_name(group, profile, name)
+            fingerprint = self._fingerprint(
+                self.build.profile_dir(profile), profile, self.task._target(name))
+            this_jobs, shards, key = self._unit_jobs(index, *unit)
+            if not this_jobs:
+                cached.append(unit_name)
+                self._record_green(profile, name, group.args, fingerprint)
+                continue
+            jobs.extend(this_jobs)
+            unit_jobs.append((unit, this_jobs, shards, key, fingerprint))
+
+        workers = parallelism.jobs(self.build.config)
+        echo.echo("Running {} test unit(s) in {} process(es), {} cached, {} worker(s)".format(
+            len(unit_jobs), len(jobs), len(cached), workers))
+
+        results = pool.run_jobs(jobs, workers) if jobs else []
+        by_job = {id(result.job): result for result in results}
+
+        # Unit passes if all its shards passed
+        for unit, this_jobs, shards, key, fingerprint in unit_jobs:
+            _, group, profile, name = unit
+            unit_results = [by_job[id(job)] for job in this_jobs]
+            if all(result.ok for result in unit_results):
+                self._record_pass(key, max(result.elapsed for result in unit_results))
+                self._record_green(profile, name, group.args, fingerprint)
+            if shards:
+                self._finish_shards(self._unit_name(group, profile, name), shards)
+
+        echo.blank_line()
+        for name in unaffected:
+            echo.echo("{}  {}".format(name, highlight.success("UNAFFECTED")))
+        for name in cached:
+            echo.echo("{}  {}".format(name, highlight.success("CACHED")))
+        if results:
+            pool.print_summary(results)
+
+        failed = pool.failed(results)
+        if failed:
+            raise ClientError("Tests failed: {}".format(failed))
 
     def _load_custom_config(self, config_path):
         return TaskConfig.load_from(config_path)
 
-    def run_tests(self, config_path):
+    def run_tests(self, config_path, parallel=False):
         if config_path is None:
             config = self.task.conf
         else:
             echo.echo("Load custom tests configuration from {}".format(highlight.path(config_path)))
             config = self._load_custom_config(config_path)
 
-        for g in config.tests:
-            self._run_test_group(g);
+        self.sharding = config.sharding
+        self.limits = Limits.from_settings(self.task.fullname, self.limits_settings, config.limits)
+
+        if parallel and self.stress is not None:
+            raise ClientError("--parallel cannot be combined with --repeat: repeated runs use --jobs workers")
+
+        try:
+            if parallel:
+                self._run_parallel(config.tests)
+            else:
+                for index, g in enumerate(config.tests):
+                    self._run_test_group(index, g);
+        finally:
+            if self.cache is not None:
+                self.cache.save()
+            if self.impact is not None:
+                self.impact.save()
+            if self.report is not None:
+                self.report.save()
+                echo.echo("Test report: {}".format(highlight.path(self.report.path)))
 
         echo.echo("All {}/{} tests completed!".format(
             highlight.topic(self.task.topic), highlight.task(self.task.name)))
 
-def create_test_runner(task, build):
-    return TestRunner(task, build)
+def create_test_runner(task, build, cache=None, use_cache=True, report=None, limits=None, stress=None,
+                       impact=None):
+    return TestRunner(task, build, cache, use_cache, report, limits, stress, impact)
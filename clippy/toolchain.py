@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+
+from . import helpers
+
+
+# On-disk cache of located tools (compilers, linters) and their versions
+#
+# Located binary is reused while PATH and the list of candidate names
+# are the same and the binary itself (inode, mtime) has not changed
+
+class Toolchain:
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self._load()
+
+    def _load(self):
+        self.binaries = {}
+        self.versions = {}
+
+        if not os.path.exists(self.cache_path):
+            return
+
+        try:
+            data = helpers.load_json(self.cache_path)
+            self.binaries = data["binaries"]
+            self.versions = data["versions"]
+        except (OSError, ValueError, KeyError, TypeError):
+            logging.debug("Ignore broken toolchain cache: {}".format(self.cache_path))
+
+    def _save(self):
+        data = {
+            "binaries": self.binaries,
+            "versions": self.versions,
+        }
+
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            temp_path = self.cache_path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(data, f, indent=4, sort_keys=True)
+            os.replace(temp_path, self.cache_path)
+        except OSError as error:
+            logging.debug("Cannot save toolchain cache: {}".format(error))
+
+    @staticmethod
+    def _binary_stamp(binary):
+        try:
+            st = os.stat(binary)
+        except OSError:
+            return None
+        return [st.st_ino, st.st_mtime_ns]
+
+    @staticmethod
+    def _locate_key(names):
+        return json.dumps([os.environ.get("PATH", ""), list(names)])
+
+    def locate(self, names):
+        key = self._locate_key(names)
+
+        cached = self.binaries.get(key)
+        if cached and cached["stamp"] == self._binary_stamp(cached["binary"]):
+            return cached["binary"]
+
+        binary = helpers.locate_binary(names)
+        if binary is None:
+            return None
+
+        self.binaries[key] = {
+            "binary": binary,
+            "stamp": self._binary_stamp(binary),
+        }
+        self._save()
+
+        return binary
+
+    def version(self, binary):
+        stamp = self._binary_stamp(binary)
+
+        cached = self.versions.get(binary)
+        if cached and cached["stamp"] == stamp:
+            return cached["version"]
+
+        version = helpers.tool_version(binary)
+
+        self.versions[binary] = {
+            "version": version,
+            "stamp": stamp,
+        }
+        self._save()
+
+        return version
@@ -0,0 +1,83 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+# Span tracing of clippy phases (`--trace PATH` or CLIPPY_TRACE=PATH)
+#
+# Spans record monotonic wall time and thread CPU time and are exported
+# in Chrome trace event format (chrome://tracing, Perfetto)
+
+
+class Tracer:
+    def __init__(self):
+        self.path = None
+        self.events = []
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def start(self, path):
+        self.path = os.path.abspath(path)
+        self.pid = os.getpid()
+        self.events = []
+
+    # Yields dict of span arguments, caller can add results to it
+    @contextlib.contextmanager
+    def span(self, name, category="clippy", **args):
+        if not self.enabled:
+            yield {}
+            return
+
+        start = time.monotonic_ns()
+        start_cpu = time.thread_time_ns()
+        try:
+            yield args
+        finally:
+            args["cpu_ms"] = (time.thread_time_ns() - start_cpu) / 1e6
+            self._add({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start / 1000,
+                "dur": (time.monotonic_ns() - start) / 1000,
+                "pid": self.pid,
+                "tid": threading.get_native_id(),
+                "args": args,
+            })
+
+    # Span for subprocess: argv and exit code. Resource usage is added by
+    # callers that wait for the process itself (see call.run_and_measure):
+    # RUSAGE_CHILDREN is shared by processes that run concurrently
+    @contextlib.contextmanager
+    def process(self, cmd, **args):
+        if not self.enabled:
+            yield {}
+            return
+
+        with self.span(os.path.basename(cmd[0]), category="subprocess", argv=list(cmd), **args) as span:
+            yield span
+
+    def _add(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def save(self):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            events = list(self.events)
+
+        try:
+            with open(self.path, "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        except OSError as error:
+            logging.warning("Cannot write trace to {}: {}".format(self.path, error))
+
+
+tracer = Tracer()
@@ -0,0 +1,273 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import signal
+import sys
+import time
+import traceback
+
+from . import helpers
+from . import highlight
+from .echo import echo
+from .exceptions import ClientError
+
+# Watch mode: `clippy test --watch`, `clippy target --watch`
+#
+# Watches task files (submit_files + lint_files) with inotify or, where it is
+# not available, by polling mtimes. After a change and DEBOUNCE_S of quiet
+# the iteration in progress is cancelled and a new one starts.
+#
+# Each iteration runs in a forked child of the watching process, so bootstrap,
+# located toolchain and task config stay warm. Rebuild is incremental and
+# unchanged test binaries are skipped by test result cache.
+
+DEBOUNCE_S = 0.3
+
+POLL_INTERVAL_S = 0.5
+
+# Cancelled iteration gets SIGINT (test processes are cleaned up on
+# KeyboardInterrupt), then SIGKILL if it is still running after this time
+CANCEL_TIMEOUT_S = 5.0
+
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+
+_IN_EVENTS = (
+    _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE)
+
+
+# inotify through libc, None if not available
+class _Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = set()
+
+    @staticmethod
+    def create():
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            return _Inotify()
+        except (OSError, AttributeError) as error:
+            logging.debug("inotify is not available: {}".format(error))
+            return None
+
+    # Editors often save by rename, so directories are watched, not files
+    def watch_dirs(self, dirs):
+        for dir in dirs - self.dirs:
+            if self.libc.inotify_add_watch(self.fd, os.fsencode(dir), _IN_EVENTS) >= 0:
+                self.dirs.add(dir)
+
+    # True if there were events during timeout
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+
+        # Drain events, their content does not matter: snapshot is compared anyway
+        while True:
+            try:
+                if not os.read(self.fd, 64 * 1024):
+                    break
+            except BlockingIOError:
+                break
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    # paths: files and directories to watch
+    def __init__(self, paths):
+        self.paths = paths
+        self.inotify = _Inotify.create()
+        self.snapshot = self._snapshot()
+
+    @property
+    def backend(self):
+        return "inotify" if self.inotify else "polling"
+
+    def _files(self):
+        return helpers.all_files("", [path for path in self.paths if os.path.exists(path)])
+
+    def _snapshot(self):
+        snapshot = {}
+        for path in self._files():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_mtime_ns, st.st_size)
+
+        if self.inotify:
+            dirs = set()
+            for path in self.paths:
+                if os.path.isdir(path):
+                    dirs.update(dir_path for dir_path, _, _ in os.walk(path))
+                else:
+                    dirs.add(os.path.dirname(path))
+            self.inotify.watch_dirs(dirs)
+
+        return snapshot
+
+    def _wait(self, timeout):
+        if self.inotify:
+            return self.inotify.wait(timeout)
+        time.sleep(min(timeout, POLL_INTERVAL_S))
+        return True
+
+    # Changed files or empty list if nothing changed during timeout
+    def changes(self, timeout):
+        if not self._wait(timeout):
+            return []
+
+        snapshot = self._snapshot()
+        changed = sorted(
+            path for path in set(snapshot) | set(self.snapshot)
+            if snapshot.get(path) != self.snapshot.get(path))
+        self.snapshot = snapshot
+        return changed
+
+    # Waits until there are no changes for DEBOUNCE_S
+    def settle(self):
+        while self.changes(DEBOUNCE_S):
+            pass
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+
+
+class _Iteration:
+    def __init__(self, run):
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        self.pid = os.fork()
+        if self.pid == 0:
+            self._child(run)
+        self.exit_code = None
+
+    @staticmethod
+    def _child(run):
+        exit_code = 1
+        try:
+            # Own process group: cancellation reaches build tools too
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            # Not in foreground process group, must not read terminal
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.close(devnull)
+
+            run()
+            exit_code = 0
+        except SystemExit as exit:
+            if isinstance(exit.code, int):
+                exit_code = exit.code
+            elif exit.code is None:
+                exit_code = 0
+        except KeyboardInterrupt:
+            pass
+        except ClientError as error:
+            echo.error(str(error))
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(exit_code)
+
+    def poll(self):
+        if self.exit_code is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid != 0:
+                self.exit_code = os.waitstatus_to_exitcode(status)
+        return self.exit_code
+
+    def _signal(self, signum):
+        try:
+            os.killpg(self.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def cancel(self):
+        if self.poll() is not None:
+            return
+
+        self._signal(signal.SIGINT)
+        deadline = time.monotonic() + CANCEL_TIMEOUT_S
+        while time.monotonic() < deadline:
+            if self.poll() is not None:
+                break
+            time.sleep(0.05)
+        else:
+            self._signal(signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+            self.exit_code = -signal.SIGKILL
+
+        # Leftovers in iteration process group
+        self._signal(signal.SIGKILL)
+
+
+def _report(iteration):
+    if iteration.exit_code == 0:
+        echo.success("Iteration passed")
+    else:
+        echo.error("Iteration failed, exit code {}".format(iteration.exit_code))
+
+
+# paths: task files and directories to watch
+# run: runs one iteration in-process, failures are reported with
+# SystemExit / ClientError like regular commands do
+def watch(paths, run):
+    watcher = Watcher(paths)
+    echo.note("Watching {} files ({}), press Ctrl-C to exit".format(
+        len(watcher.snapshot), watcher.backend))
+
+    iteration = None
+    try:
+        while True:
+            iteration = _Iteration(run)
+
+            reported = False
+            while True:
+                changed = watcher.changes(POLL_INTERVAL_S)
+                if changed:
+                    break
+
+                if not reported and iteration.poll() is not None:
+                    _report(iteration)
+                    echo.note("Waiting for changes...")
+                    reported = True
+
+            watcher.settle()
+
+            if iteration.poll() is None:
+                echo.note("Cancelling iteration in progress")
+                iteration.cancel()
+            elif not reported:
+                _report(iteration)
+
+            echo.separator_line()
+            echo.note("Changed: {}".format(", ".join(highlight.path(path) for path in changed[:5])))
+    finally:
+        if iteration is not None:
+            iteration.cancel()
+        watcher.close()